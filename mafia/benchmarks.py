@@ -0,0 +1,78 @@
+import itertools
+import timeit
+
+from mafia.common import Role, Winner
+from mafia.game import MafiaGame
+from mafia.voting import Voting
+
+
+PLAYER_COUNTS = [8, 100, 1000]
+REPEAT = 5
+NUMBER = 2000
+
+
+def is_game_finished_by_filter(game: MafiaGame) -> Winner:  # How win was checked before role counters
+    def get_players_by_role(role: Role) -> list[str]:
+        return list(filter(lambda player: game.player_role[player] == role, game.players))
+
+    mafia_count = len(get_players_by_role(Role.MAFIA))
+    if mafia_count == 0:
+        return Winner.CIVILIANS
+    civilians_count = len(get_players_by_role(Role.CIVILIAN)) + len(get_players_by_role(Role.COMMISSAR))
+    if civilians_count <= mafia_count:
+        return Winner.MAFIA
+    return Winner.NONE
+
+
+def get_winner_by_histogram(voting: Voting) -> str or None:  # How winner was found before live tallies
+    candidate_votes = {}
+    for candidate in voting.votes.values():
+        candidate_votes[candidate] = candidate_votes.get(candidate, 0) + 1
+        if candidate is not None and candidate_votes[candidate] >= voting.get_majority():
+            return candidate
+    return None
+
+
+def measure(func, *args, number: int = NUMBER) -> float:  # Best time of a single call in microseconds
+    return min(timeit.repeat(lambda: func(*args), repeat=REPEAT, number=number)) / number * 1e6
+
+
+def bench_win_check():
+    print('Check of game end:')
+    print(f'{"players":>8} {"filter":>10} {"counters":>10}')
+    for player_count in PLAYER_COUNTS:
+        game = MafiaGame([f'player_{i}' for i in range(player_count)])
+        game.kill(game.get_players_by_role(Role.CIVILIAN)[0])
+        assert is_game_finished_by_filter(game) == game.is_game_finished()
+        filter_time = measure(is_game_finished_by_filter, game)
+        counters_time = measure(game.is_game_finished)
+        print(f'{player_count:>8} {filter_time:8.2f}us {counters_time:8.2f}us')
+
+
+def bench_vote():  # Vote is changed, and winner is checked after it, as clients would see after every vote
+    print('Vote and check of winner:')
+    print(f'{"players":>8} {"histogram":>10} {"tallies":>10}')
+    for player_count in PLAYER_COUNTS:
+        players = [f'player_{i}' for i in range(player_count)]
+        voting = Voting(players)
+        for i, player in enumerate(players):
+            voting.vote(player, players[i % 3])
+        assert get_winner_by_histogram(voting) == voting.get_winner()
+        candidates = itertools.cycle(players)
+
+        def vote_by_histogram():
+            voting.vote(players[0], next(candidates))
+            return get_winner_by_histogram(voting)
+
+        def vote_by_tallies():
+            voting.vote(players[0], next(candidates))
+            return voting.get_winner()
+
+        histogram_time = measure(vote_by_histogram)
+        tallies_time = measure(vote_by_tallies)
+        print(f'{player_count:>8} {histogram_time:8.2f}us {tallies_time:8.2f}us')
+
+
+if __name__ == '__main__':
+    bench_win_check()
+    bench_vote()
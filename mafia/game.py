@@ -1,4 +1,5 @@
 import random
+import time
 from mafia.common import *
 from mafia_service_pb2 import *
 from mafia.voting import Voting
@@ -13,10 +14,14 @@ def get_roles(players_count):
 
 
 class MafiaGame:
-    players: list[str]
+    ROLES = (Role.CIVILIAN, Role.MAFIA, Role.COMMISSAR)
+    players: dict[str, None]  # Alive players, in order of joining, so that killing one takes constant time
     player_role: dict[str, int]
+    role_players: dict[int, dict[str, None]]  # Alive players of each role, ordered as players
 
     finished: set[str]
+    # Phase with voting is finished once those who did not finish cannot change its result, and commissar finished
+    finish_decided_phases: bool
     phase: bool
     can_execute: bool
 
@@ -26,17 +31,24 @@ class MafiaGame:
     investigated: set[str]
     done_investigation: bool
 
-    def __init__(self, players: list[str]):
-        self.players = players
+    start_time: float
+
+    def __init__(self, players: list[str], finish_decided_phases: bool = False):
+        self.players = dict.fromkeys(players)
         roles = get_roles(len(players))
-        self.player_role = {self.players[i]: roles[i] for i in range(len(players))}
+        self.player_role = {players[i]: roles[i] for i in range(len(players))}
+        self.role_players = {role: {} for role in self.ROLES}
+        for player, role in self.player_role.items():
+            self.role_players[role][player] = None
         self.finished = set()
+        self.finish_decided_phases = finish_decided_phases
         self.investigated = set()
         self.dead = set()
         self.done_investigation = False
         self.phase = Phase.DAY
         self.can_execute = False
         self.execute_voting = Voting(self.players)
+        self.start_time = time.monotonic()
 
     def is_allowed(self, name: str, command: CommandMessage, phase: Phase):
         if phase != self.phase:
@@ -53,7 +65,7 @@ class MafiaGame:
                 return False, 'You are not allowed to investigate since you are not commissar'
             elif self.phase != Phase.NIGHT:
                 return False, 'You cannot investigate since it is day'
-            elif command.suspect not in self.players:
+            elif not self.is_alive(command.suspect):
                 return False, 'You cannot investigate player that does not exist!'
             elif self.done_investigation:
                 return False, 'You cannot investigate since you already investigated this night'
@@ -92,6 +104,7 @@ class MafiaGame:
     def process_command(self, command: CommandMessage) -> InfoMessage:
         if command.type == CommandType.FINISH:
             self.finished.add(command.name)
+            self.execute_voting.finish(command.name)
             return InfoMessage(type=InfoType.PLAYER_FINISH, name=command.name)
         elif command.type == CommandType.INVESTIGATE:
             suspect = command.suspect
@@ -113,7 +126,11 @@ class MafiaGame:
             assert False, f'Found unknown command type: {command.type}'
 
     def is_phase_finished(self):
-        return len(self.finished) == len(self.players)
+        if len(self.finished) == len(self.players):
+            return True
+        has_voting = self.phase == Phase.NIGHT or self.can_execute
+        return self.finish_decided_phases and has_voting and self.execute_voting.is_decided() and \
+            all(commissar in self.finished for commissar in self.role_players[Role.COMMISSAR])
 
     def finish_phase(self):
         if self.phase == Phase.DAY:
@@ -142,17 +159,27 @@ class MafiaGame:
             yield InfoMessage(type=InfoType.END, winner=winner)
 
     def is_game_finished(self):
-        mafia_count = len(self.get_players_by_role(Role.MAFIA))
+        mafia_count = self.count_players_by_role(Role.MAFIA)
         if mafia_count == 0:
             return Winner.CIVILIANS
-        civilians_count = len(self.get_players_by_role(Role.CIVILIAN)) + len(self.get_players_by_role(Role.COMMISSAR))
+        civilians_count = self.count_players_by_role(Role.CIVILIAN) + self.count_players_by_role(Role.COMMISSAR)
         if civilians_count <= mafia_count:
             return Winner.MAFIA
         return Winner.NONE
 
+    def get_results(self, winner: Winner) -> dict[str, bool]:  # Whether each player, dead or alive, has won
+        return {player: (role == Role.MAFIA) == winner for player, role in self.player_role.items()}
+
+    def get_duration(self) -> int:
+        return int(time.monotonic() - self.start_time)
+
     def kill(self, player: str):
         self.dead.add(player)
-        self.players.remove(player)
+        del self.players[player]
+        del self.role_players[self.player_role[player]][player]
+
+    def is_alive(self, player: str) -> bool:
+        return player in self.player_role and player not in self.dead
 
     def get_role(self, player: str) -> int:
         return self.player_role[player]
@@ -161,4 +188,7 @@ class MafiaGame:
         return self.player_role[player] == role
 
     def get_players_by_role(self, role: Role) -> list[str]:
-        return list(filter(lambda player: self.player_role[player] == role, self.players))
+        return list(self.role_players[role])
+
+    def count_players_by_role(self, role: Role) -> int:
+        return len(self.role_players[role])
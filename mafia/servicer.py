@@ -15,22 +15,28 @@ class Servicer(MafiaServicer):
     night_civilian_queue: SubscriberQueue
     night_mafia_queue: SubscriberQueue
     night_commissar_queue: SubscriberQueue
+    night_queue: dict[int, SubscriberQueue]  # Of each role
 
-    def __init__(self, names: list[str], room_server):
+    def __init__(self, names: list[str], room_server, finish_decided_phases: bool = False):
         self.names = names
-        self.mafia_game = MafiaGame(names)
+        self.mafia_game = MafiaGame(names, finish_decided_phases)
         self.day_queue = SubscriberQueue(names)
         self.day_finished = set()
         self.night_civilian_queue = SubscriberQueue(self.mafia_game.get_players_by_role(Role.CIVILIAN))
         self.night_mafia_queue = SubscriberQueue(self.mafia_game.get_players_by_role(Role.MAFIA))
         self.night_commissar_queue = SubscriberQueue(self.mafia_game.get_players_by_role(Role.COMMISSAR))
+        self.night_queue = {
+            Role.CIVILIAN: self.night_civilian_queue,
+            Role.MAFIA: self.night_mafia_queue,
+            Role.COMMISSAR: self.night_commissar_queue,
+        }
         self.night_finished = set(self.mafia_game.get_players_by_role(Role.CIVILIAN))
         self.room_server = room_server
         self.room_server.notify_mafia(self.mafia_game.get_players_by_role(Role.MAFIA))
 
     def start_game(self, request: NameMessage, context):
         return GameStartedMessage(
-            list=self.mafia_game.players,
+            list=list(self.mafia_game.players),
             role=self.mafia_game.get_role(request.name)
         )
 
@@ -45,6 +51,8 @@ class Servicer(MafiaServicer):
         if self.mafia_game.is_phase_finished():
             for info in self.mafia_game.finish_phase():
                 self.day_queue.put(info)
+                if info.type == InfoType.END:
+                    self.submit_results(info.winner)
         return DummyMessage()
 
     def listen_day(self, request: NameMessage, context) -> InfoMessage:  # stream
@@ -67,30 +75,25 @@ class Servicer(MafiaServicer):
             return DummyMessage(error=reason)
 
         info = self.mafia_game.process_command(request)
-        if self.mafia_game.is_role(request.name, Role.CIVILIAN):
-            self.night_civilian_queue.put(info)
-        elif self.mafia_game.is_role(request.name, Role.MAFIA):
-            self.night_mafia_queue.put(info)
-        elif self.mafia_game.is_role(request.name, Role.COMMISSAR):
-            self.night_commissar_queue.put(info)
+        self.night_queue[self.mafia_game.get_role(request.name)].put(info)
 
         if self.mafia_game.is_phase_finished():
             for info in self.mafia_game.finish_phase():
                 self.night_civilian_queue.put(info)
                 self.night_mafia_queue.put(info)
                 self.night_commissar_queue.put(info)
+                if info.type == InfoType.END:
+                    self.submit_results(info.winner)
         return DummyMessage()
 
+    def submit_results(self, winner: Winner):
+        self.room_server.notify_results(self.mafia_game.get_duration(), self.mafia_game.get_results(winner))
+
     def listen_night(self, request: NameMessage, context):
         yield InfoMessage(type=InfoType.START)
+        queue = self.night_queue[self.mafia_game.get_role(request.name)]  # Role of a player never changes
         while True:
-            msg = None
-            if self.mafia_game.is_role(request.name, Role.CIVILIAN):
-                msg = self.night_civilian_queue.get(request.name)
-            elif self.mafia_game.is_role(request.name, Role.MAFIA):
-                msg = self.night_mafia_queue.get(request.name)
-            elif self.mafia_game.is_role(request.name, Role.COMMISSAR):
-                msg = self.night_commissar_queue.get(request.name)
+            msg = queue.get(request.name)
             if msg.type == InfoType.MURDERED:
                 self.room_server.notify_dead(msg.name)
             yield msg
@@ -102,8 +105,8 @@ class Servicer(MafiaServicer):
                 break
 
 
-def build_server(players: list[str], port, room_server):
+def build_server(players: list[str], port, room_server, finish_decided_phases: bool = False):
     server = grpc.server(futures.ThreadPoolExecutor(max_workers=len(players) + 1))
-    add_MafiaServicer_to_server(Servicer(players, room_server), server)
+    add_MafiaServicer_to_server(Servicer(players, room_server, finish_decided_phases), server)
     server.add_insecure_port(f'[::]:{port}')
     return server
@@ -29,6 +29,36 @@ def test_voting():
     assert voting.get_winner() is None
 
 
+def test_voting_tallies():
+    voting = Voting(['a', 'b', 'c', 'd', 'e'])
+    assert voting.get_leader() is None and voting.get_margin() == 0
+    voting.vote('a', 'c')
+    voting.vote('b', 'c')
+    voting.vote('c', 'd')
+    assert voting.get_leader() == 'c' and voting.get_margin() == 1 and voting.get_tally('c') == 2
+    voting.vote('b', 'd')  # Changed vote is taken from previous candidate
+    assert voting.get_tally('c') == 1 and voting.get_leader() == 'd' and voting.get_margin() == 1
+    voting.vote('a', None)
+    assert voting.get_margin() == 2 and voting.get_winner() is None
+    voting.vote('d', 'd')
+    assert voting.get_winner() == 'd' and voting.get_margin() == 3
+
+    assert not voting.is_decided()
+    for voter in ['b', 'c']:
+        voting.finish(voter)
+    assert not voting.is_decided()
+    voting.finish('d')
+    assert voting.is_decided()  # Three of five votes for d cannot be changed anymore
+    voting.vote('d', 'a')
+    assert voting.get_winner() == 'd'
+
+    voting = Voting(['a', 'b', 'c', 'd'])
+    for voter, candidate in [('a', 'b'), ('b', 'c'), ('c', 'd')]:
+        voting.vote(voter, candidate)
+        voting.finish(voter)
+    assert voting.is_decided() and voting.get_winner() is None  # Nobody can get three votes of four anymore
+
+
 def test_roles():
     players = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']
     game = MafiaGame(players)
@@ -52,6 +82,81 @@ def test_roles():
         assert game.is_role(civilian, Role.CIVILIAN)
 
 
+def test_role_counters():
+    players = [f'player_{i}' for i in range(9)]
+    game = MafiaGame(players)
+    mafias = game.get_players_by_role(Role.MAFIA)
+    civilians = game.get_players_by_role(Role.CIVILIAN)
+    assert [game.count_players_by_role(role) for role in MafiaGame.ROLES] == [5, 3, 1]
+    assert mafias == [player for player in players if game.is_role(player, Role.MAFIA)]
+
+    game.kill(civilians[0])
+    assert game.count_players_by_role(Role.CIVILIAN) == 4
+    assert game.get_players_by_role(Role.CIVILIAN) == civilians[1:]
+    assert not game.is_alive(civilians[0]) and game.is_alive(civilians[1]) and not game.is_alive('nobody')
+    assert list(game.players) == [player for player in players if player != civilians[0]]
+    game.kill(civilians[1])
+    assert game.is_game_finished() == Winner.NONE
+    game.kill(civilians[2])
+    assert game.is_game_finished() == Winner.MAFIA
+    for mafia in mafias:
+        game.kill(mafia)
+    assert game.count_players_by_role(Role.MAFIA) == 0
+    assert game.is_game_finished() == Winner.CIVILIANS
+
+
+def play_decided_day(finish_decided_phases):
+    players = [f'player_{i}' for i in range(7)]
+    game = MafiaGame(players, finish_decided_phases)
+    for _ in range(2):  # Executions are only allowed from the second day
+        for _ in game.finish_phase():
+            pass
+    commissar = game.get_players_by_role(Role.COMMISSAR)[0]
+    target = game.get_players_by_role(Role.CIVILIAN)[0]
+    voters = [commissar] + [player for player in players if player not in (commissar, target)][:3]
+    for i, voter in enumerate(voters):
+        assert game.is_allowed(voter, CommandMessage(type=CommandType.EXECUTE, name=voter, suspect=target),
+                               Phase.DAY)[0]
+        game.process_command(CommandMessage(type=CommandType.EXECUTE, name=voter, suspect=target))
+        game.process_command(CommandMessage(type=CommandType.FINISH, name=voter))
+        if i < len(voters) - 1:
+            assert not game.is_phase_finished()  # Other three players could still outvote the target
+    return game, target
+
+
+def play_decided_night(finish_decided_phases):
+    players = [f'player_{i}' for i in range(9)]
+    game = MafiaGame(players, finish_decided_phases)
+    for _ in game.finish_phase():
+        pass
+    mafias = game.get_players_by_role(Role.MAFIA)
+    assert len(mafias) == 3
+    commissar = game.get_players_by_role(Role.COMMISSAR)[0]
+    target = game.get_players_by_role(Role.CIVILIAN)[0]
+    game.process_command(CommandMessage(type=CommandType.FINISH, name=commissar))
+    for mafia in mafias[:2]:
+        game.process_command(CommandMessage(type=CommandType.MURDER, name=mafia, suspect=target))
+        assert not game.is_phase_finished()
+        game.process_command(CommandMessage(type=CommandType.FINISH, name=mafia))
+    return game, target
+
+
+def test_finish_decided_phase():
+    game, target = play_decided_day(True)
+    assert game.is_phase_finished()
+    executed = next(game.finish_phase())
+    assert executed.type == InfoType.EXECUTED and executed.name == target
+    game, _ = play_decided_day(False)
+    assert not game.is_phase_finished()
+
+    game, target = play_decided_night(True)
+    assert game.is_phase_finished()
+    murdered = next(game.finish_phase())
+    assert murdered.type == InfoType.MURDERED and murdered.name == target
+    game, _ = play_decided_night(False)
+    assert not game.is_phase_finished()
+
+
 def test_finish():
     players = ['a', 'b', 'c', 'd']
     game = MafiaGame(players)
@@ -127,9 +232,9 @@ def test_murder():
     for player in players:
         finish_msg = CommandMessage(type=CommandType.FINISH, name=player)
         if player == commissar:
-            assert not game.is_allowed(player, finish_msg, Phase.DAY)
+            assert not game.is_allowed(player, finish_msg, Phase.DAY)[0]
         else:
-            assert game.is_allowed(player, finish_msg, Phase.DAY)
+            assert game.is_allowed(player, finish_msg, Phase.DAY)[0]
             game.process_command(finish_msg)
     assert game.is_phase_finished()
 
@@ -182,6 +287,7 @@ def test_civilian_victory():
     assert messages[0].role == Role.MAFIA
     assert messages[1].type == InfoType.END
     assert messages[1].winner == Winner.CIVILIANS
+    assert game.get_results(Winner.CIVILIANS) == {player: player != mafia for player in ['a', 'b', 'c', 'd']}
 
 
 def test_mafia_victory():
@@ -207,3 +313,4 @@ def test_mafia_victory():
     assert messages[0].role == Role.CIVILIAN
     assert messages[1].type == InfoType.END
     assert messages[1].winner == Winner.MAFIA
+    assert game.get_results(Winner.MAFIA) == {player: player == mafia for player in ['a', 'b', 'c', 'd']}
@@ -1,17 +1,90 @@
 class Voting:
     votes: dict[str, str]
+    tallies: dict[str, int]  # Votes for each candidate, that has any
+    candidates_by_tally: dict[int, set[str]]
+    top_tally: int
+    runner_up_tally: int  # Most votes of a candidate other than leader, equal to top_tally on a tie
+    final: set[str]  # Voters that cannot change their votes anymore
+    final_tallies: dict[str, int]
+    top_final_tally: int
 
     def __init__(self, voters: list[str]):
         self.votes = {voter: None for voter in voters}
+        self.tallies = {}
+        self.candidates_by_tally = {}
+        self.top_tally = 0
+        self.runner_up_tally = 0
+        self.final = set()
+        self.final_tallies = {}
+        self.top_final_tally = 0
 
     def vote(self, voter: str, candidate: str or None):
+        if voter in self.final:
+            return
+        old_candidate = self.votes.get(voter)
         self.votes[voter] = candidate
+        if old_candidate == candidate:
+            return
+        old_top, old_runner_up = self.top_tally, self.runner_up_tally
+        if old_candidate is not None:
+            self.move(old_candidate, -1)
+        if candidate is not None:
+            self.move(candidate, 1)
+        self.update_runner_up(old_top, old_runner_up)
+
+    def move(self, candidate: str, delta: int):
+        tally = self.tallies.get(candidate, 0)
+        if tally > 0:
+            self.candidates_by_tally[tally].discard(candidate)
+        tally += delta
+        if tally > 0:
+            self.tallies[candidate] = tally
+            self.candidates_by_tally.setdefault(tally, set()).add(candidate)
+        else:
+            del self.tallies[candidate]
+        # Tallies only change by one, so top tally moves by at most one as well
+        if tally > self.top_tally:
+            self.top_tally = tally
+        elif not self.candidates_by_tally.get(self.top_tally):
+            self.top_tally -= 1
+
+    def update_runner_up(self, old_top: int, old_runner_up: int):
+        if len(self.candidates_by_tally.get(self.top_tally, ())) > 1:
+            self.runner_up_tally = self.top_tally
+            return
+        # Every tally changed by at most one, so runner-up is next to either old leader or old runner-up
+        possible = {old_top, old_top - 1, old_runner_up + 1, old_runner_up, old_runner_up - 1}
+        self.runner_up_tally = max((tally for tally in possible
+                                    if 0 < tally < self.top_tally and self.candidates_by_tally.get(tally)), default=0)
+
+    def finish(self, voter: str):  # Vote of this voter is final, e.g. since phase is finished for this voter
+        if voter not in self.votes or voter in self.final:
+            return
+        self.final.add(voter)
+        candidate = self.votes[voter]
+        if candidate is not None:
+            self.final_tallies[candidate] = self.final_tallies.get(candidate, 0) + 1
+            self.top_final_tally = max(self.top_final_tally, self.final_tallies[candidate])
+
+    def get_majority(self) -> int:
+        return len(self.votes) // 2 + 1  # 5 -> 3, 6 -> 4, 7 -> 4, ...
+
+    def get_tally(self, candidate: str) -> int:
+        return self.tallies.get(candidate, 0)
+
+    def get_leader(self) -> str or None:  # Candidate with most votes, unless there is a tie
+        if self.top_tally == 0 or self.runner_up_tally == self.top_tally:
+            return None
+        return next(iter(self.candidates_by_tally[self.top_tally]))
+
+    def get_margin(self) -> int:  # Votes by which leader is ahead of runner-up
+        return self.top_tally - self.runner_up_tally
 
     def get_winner(self):
-        candidate_votes = {}
-        majority = len(self.votes) // 2 + 1  # 5 -> 3, 6 -> 4, 7 -> 4, ...
-        for candidate in self.votes.values():
-            candidate_votes[candidate] = candidate_votes.get(candidate, 0) + 1
-            if candidate_votes[candidate] >= majority:
-                return candidate
+        if self.top_tally >= self.get_majority():
+            return self.get_leader()
         return None
+
+    def is_decided(self) -> bool:  # Whether votes that can still change would not change the winner
+        open_votes = len(self.votes) - len(self.final)
+        return self.top_final_tally >= self.get_majority() or self.top_final_tally + open_votes < self.get_majority()
@@ -1,110 +1,169 @@
-import base64
-import secrets
+import os
 import sqlite3
-import threading
 
-from flask import Flask, request, render_template_string, make_response
-from rest.profile_dao import Profile, ProfileDao
-from rest.pdf_report import generate_pdf_via_queue
-from hashlib import sha256
 import jwt
+from flask import Blueprint, Flask, current_app, request, render_template, make_response, jsonify
+from rest.auth import get_hash, load_secret, verify_session
+from rest.profile_dao import Profile, ProfileDao
+from rest.pdf_report import ReportStatus, get_report_client
+from rest.report_cache import ReportCache, get_report_key
+from rest.session_cache import SessionCache
+from rest.page_loader import setup_templates
+from rest.static_assets import StaticAsset, guess_image_type, send_cached
+
+
+STATIC_ASSETS = ('ico.png', 'favicon.ico')
+AVATAR_MAX_AGE = 365 * 24 * 60 * 60  # Avatar links contain its hash, so their contents never change
+
+
+class AppState:  # Kept by each worker process, while everything they must agree on is in the database
+    dao: ProfileDao
+    secret: str
+    session_cache: SessionCache
+    report_cache: ReportCache
+    static_assets: dict[str, StaticAsset]
+
+    def __init__(self, dao: ProfileDao, secret: str, report_cache: ReportCache, static_dir: str):
+        self.dao = dao
+        self.secret = secret
+        self.session_cache = SessionCache()
+        self.report_cache = report_cache
+        self.static_assets = {name: StaticAsset(os.path.join(static_dir, name)) for name in STATIC_ASSETS}
 
 
-app = Flask(__name__)
-dao = ProfileDao()
-secret = secrets.token_hex(16)
+pages = Blueprint('pages', __name__)
 
 
-def get_hash(password):
-    return sha256(password.encode()).hexdigest()
+def create_app(db_path: str = ProfileDao.DB_PATH, secret: str or None = None,
+               report_dir: str = ReportCache.DIRECTORY) -> Flask:
+    app = Flask(__name__)
+    setup_templates(app)
+    app.extensions['rest_mafia'] = AppState(ProfileDao(db_path), load_secret() if secret is None else secret,
+                                            ReportCache(report_dir), os.path.join(app.root_path, app.template_folder))
+    app.register_blueprint(pages)
+    return app
+
+
+def get_state() -> AppState:
+    return current_app.extensions['rest_mafia']
 
 
 def get_login_if_authorized():
     if 'jwt' in request.cookies:
+        state = get_state()
         jwt_token = request.cookies['jwt']
-        try:
-            login_pass = jwt.decode(jwt_token, secret, algorithms=["HS256"])
-        except jwt.DecodeError:
+        session = state.session_cache.get(jwt_token)
+        # Password may have been changed through another worker, so token is only trusted while it is the same
+        if session is not None and state.dao.lookup_auth(session[0]) == session[1]:
+            return session[0]
+        session = verify_session(state.dao, state.secret, jwt_token)
+        if session is None:
+            state.session_cache.invalidate(jwt_token)
             return None
-        if 'login' in login_pass and 'password' in login_pass:
-            login_profile = dao.lookup_profile(login_pass['login'])
-            if login_profile is not None and login_profile.password == get_hash(login_pass['password']):
-                return login_profile.login
+        state.session_cache.put(jwt_token, *session)
+        return session[0]
     return None
 
 
 def render_page(page, authorized_login=None, use_param=False, **context):
-    template = open('rest/templates/base.html').read().replace('{main}', open(f'rest/templates/{page}').read())
     context['authorized_login'] = authorized_login if use_param else get_login_if_authorized()
-    return render_template_string(template, **context)
+    return render_template(page, **context)
 
 
-@app.route('/')
+@pages.route('/')
 def index():
     return render_page('index.html')
 
 
-@app.route('/all_profiles')
+MAX_PAGE_SIZE = 200
+
+
+def get_logins_page():  # Page requested by ?after=<login>&prefix=<prefix>&limit=<count>
+    limit = min(max(request.args.get('limit', ProfileDao.PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    return get_state().dao.get_logins_page(request.args.get('after'), request.args.get('prefix', ''), limit)
+
+
+@pages.route('/all_profiles')
 def all_profiles():
-    return render_page('all_profiles.html', all_profiles=dao.get_all_logins())
+    logins, next_login = get_logins_page()
+    return render_page('all_profiles.html', all_profiles=logins, next_login=next_login,
+                       prefix=request.args.get('prefix', ''))
+
 
+@pages.route('/all_profiles.json')
+def all_profiles_json():
+    logins, next_login = get_logins_page()
+    return jsonify(logins=logins, next=next_login)
 
-@app.route('/register', methods=['GET'])
+
+@pages.route('/register', methods=['GET'])
 def register_get():
     if get_login_if_authorized() is not None:
         return render_page('response.html', reason='You cannot register since you are already logged in'), 403
     return render_page('register.html')
 
 
-@app.route('/register', methods=['POST'])
+@pages.route('/register', methods=['POST'])
 def register_post():
     if get_login_if_authorized() is not None:
         return render_page('response.html', reason='You cannot register since you are already logged in'), 403
 
     new_profile = Profile(login=request.form['login'], password=get_hash(request.form['password']))
     try:
-        dao.insert_profile(new_profile)
+        get_state().dao.insert_profile(new_profile)
     except sqlite3.IntegrityError:
         return render_page('response.html', reason='Registration failed, since such user already exists'), 400
     return render_page('response.html', reason='Registration is complete!')
 
 
-@app.route('/authorize', methods=['GET'])
+@pages.route('/authorize', methods=['GET'])
 def authorize():
     if get_login_if_authorized() is not None:
         return render_page('response.html', reason='You cannot authorize since you are already logged in'), 403
     return render_page('authorize.html')
 
 
-@app.route('/authorize', methods=['POST'])
+@pages.route('/authorize', methods=['POST'])
 def authorize_post():
     if get_login_if_authorized() is not None:
         return render_page('response.html', reason='You cannot authorize since you are already logged in'), 403
 
     login, password = request.form['login'], get_hash(request.form['password'])
-    cur_profile = dao.lookup_profile(login)
-    if cur_profile is None:
+    profile_password = get_state().dao.lookup_auth(login)
+    if profile_password is None:
         return render_page('response.html', reason='No such profile exists'), 400
-    if cur_profile.password != password:
+    if profile_password != password:
         return render_page('response.html', reason='Password is incorrect'), 400
 
-    jwt_token = jwt.encode({'login': login, 'password': request.form['password']}, secret, algorithm="HS256")
+    jwt_token = jwt.encode({'login': login, 'password': request.form['password']}, get_state().secret,
+                           algorithm="HS256")
     resp = make_response(render_page('response.html', login, True, reason='Authorization successful!',
                                      text=f'Your JWT token to play game: {jwt_token}'))
     resp.set_cookie('jwt', jwt_token)
     return resp
 
 
-@app.route('/profile/<string:login>')
+@pages.route('/profile/<string:login>')
 def profile(login):
-    cur_profile = dao.lookup_profile(login)
+    cur_profile = get_state().dao.lookup_summary(login)
     if cur_profile is None:
         return render_page('response.html', reason='No such profile exists'), 400
-    base64image = base64.b64encode(cur_profile.image).decode()
-    return render_page('profile.html', **vars(cur_profile), base64image=base64image)
+    return render_page('profile.html', **vars(cur_profile))
+
+
+@pages.route('/avatar/<string:login>')
+def avatar(login):
+    found = get_state().dao.lookup_avatar(login)
+    if found is None:
+        return render_page('response.html', reason='No such profile exists'), 404
+    avatar_hash, image = found
+    if request.args.get('v') == avatar_hash:
+        return send_cached(image, guess_image_type(image), avatar_hash, AVATAR_MAX_AGE, immutable=True)
+    # Unversioned links may show another avatar later, so browsers revalidate them with the hash
+    return send_cached(image, guess_image_type(image), avatar_hash, 0)
 
 
-@app.route('/edit/<string:login>', methods=['GET'])
+@pages.route('/edit/<string:login>', methods=['GET'])
 def edit(login):
     if login is None or login == '':
         return render_page('response.html', reason='Invalid login'), 400
@@ -113,7 +172,7 @@ def edit(login):
     return render_page('edit.html', login=login)
 
 
-@app.route('/edit/<string:login>', methods=['POST'])
+@pages.route('/edit/<string:login>', methods=['POST'])
 def edit_post(login):
     if login is None or login == '':
         return render_page('response.html', reason='Invalid login'), 400
@@ -125,62 +184,103 @@ def edit_post(login):
     image = request.files['image'].stream.read() if 'image' in request.files else None
     gender = request.form['gender'] if request.form['gender'] else None
     mail = request.form['mail'] if request.form['mail'] else None
-    dao.modify_profile(login, password=password, name=name, image=image, gender=gender, mail=mail)
+    get_state().dao.modify_profile(login, password=password, name=name, image=image, gender=gender, mail=mail)
+    if password is not None:
+        get_state().session_cache.invalidate_login(login)
     return render_page('response.html', reason='Profile updated')
 
 
-def submit_game_result(login, total_time, won):
-    dao.finish_game(login, total_time, won)
-
-
-@app.route('/logout')
+@pages.route('/logout')
 def logout():
     if get_login_if_authorized() is None:
         return render_page('response.html', reason='You are already logged out')
+    get_state().session_cache.invalidate(request.cookies['jwt'])
     resp = make_response(render_page('response.html', None, True, reason='You have successfully logged out'))
     resp.set_cookie('jwt', '')
     return resp
 
 
-available_pdfs = {}
-login_thread = {}
+def get_report_status(state, key) -> ReportStatus or None:  # None if report was never requested
+    if key in state.report_cache:
+        return ReportStatus.READY
+    failed = state.dao.lookup_report_failed(key)
+    if failed is None:
+        return None
+    return ReportStatus.FAILED if failed else ReportStatus.PENDING
 
 
-def create_report(cur_profile):
-    available_pdfs[cur_profile.login] = generate_pdf_via_queue(cur_profile)
+def request_report(state, key, login):
+    # Avatar is only loaded once report is rendered, and profile may have changed since its key was taken
+    cur_profile = state.dao.lookup_profile(login)
+    if cur_profile is None or get_report_key(cur_profile) != key:
+        raise ValueError('Profile changed while its report was requested')
+    future = get_report_client().request(cur_profile)
+    future.add_done_callback(lambda done: store_report(state, key, done))
 
 
-@app.route('/report/<string:login>')
+def store_report(state, key, future):  # Called by consumer thread of report client, once report is done
+    try:
+        state.report_cache.put(key, future.result())
+    except Exception as err:
+        print(f'ERROR: Report {key} could not be generated: {err!r}')
+        state.dao.fail_report(key)
+    else:
+        state.dao.finish_report(key)
+
+
+REPORT_MESSAGES = {
+    ReportStatus.PENDING: 'Generating report for {login}...',
+    ReportStatus.READY: 'Report for {login} is ready',
+    ReportStatus.FAILED: 'Report for {login} could not be generated, open this link again to retry',
+}
+
+
+@pages.route('/report/<string:login>')
 def generate_report(login):
-    cur_profile = dao.lookup_profile(login)
+    state = get_state()
+    cur_profile = state.dao.lookup_summary(login)
     if cur_profile is None:
         return render_page('response.html', reason='No such profile exists!')
-    if login in login_thread:
-        login_thread[login].join()
-    login_thread[login] = threading.Thread(target=create_report, args=(cur_profile,))
-    login_thread[login].start()
-    return render_page('response.html', reason=f'Generating report for {login}...',
+    key = get_report_key(cur_profile)
+    status = get_report_status(state, key)
+    # Report that is already being generated, possibly by another worker, is not generated twice
+    if status in (None, ReportStatus.FAILED):
+        status = ReportStatus.PENDING
+        if state.dao.start_report(key):
+            try:
+                request_report(state, key, login)
+            except Exception as err:
+                print(f'ERROR: Report {key} could not be requested: {err!r}')
+                state.dao.fail_report(key)
+                status = ReportStatus.FAILED
+    return render_page('response.html', reason=REPORT_MESSAGES[status].format(login=login),
                        text='Append .pdf to the end of this link to get a report!')
 
 
-@app.route('/report/<string:login>.pdf')
+@pages.route('/report/<string:login>.pdf')
 def generate_pdf(login):
-    if login not in available_pdfs:
+    state = get_state()
+    cur_profile = state.dao.lookup_summary(login)
+    # Report is only served while profile has the same contents as when it was generated
+    key = None if cur_profile is None else get_report_key(cur_profile)
+    pdf = None if key is None else state.report_cache.get(key)
+    if pdf is None:
+        status = None if key is None else get_report_status(state, key)
+        if status == ReportStatus.PENDING:
+            return render_page('response.html', reason='This report is still being generated'), 202
+        if status == ReportStatus.FAILED:
+            return render_page('response.html', reason='This report could not be generated'), 500
         return render_page('response.html', reason='This report is not available')
-    response = make_response(available_pdfs[login])
-    response.headers['Content-Type'] = 'application/pdf'
+    response = send_cached(pdf, 'application/pdf', key, 0)
     response.headers['Content-Disposition'] = f'inline; filename={login}.pdf'
     return response
 
 
-@app.route('/ico.png')
+@pages.route('/ico.png')
 def ico():
-    return open('rest/templates/ico.png', 'rb').read()
+    return get_state().static_assets['ico.png'].response()
 
 
-@app.route('/favicon.ico')
+@pages.route('/favicon.ico')
 def fav():
-    return open('rest/templates/favicon.ico', 'rb').read()
-
-
-app.run(host='0.0.0.0', port=80)
+    return get_state().static_assets['favicon.ico'].response()
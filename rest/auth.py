@@ -0,0 +1,51 @@
+import os
+import secrets
+from hashlib import sha256
+
+import jwt
+
+from rest.profile_dao import ProfileDao
+
+
+SECRET_ENV = 'REST_MAFIA_SECRET'
+SECRET_PATH = 'jwt_secret.key'
+
+
+def get_hash(password: str) -> str:
+    return sha256(password.encode()).hexdigest()
+
+
+def load_secret(path: str = SECRET_PATH) -> str:
+    # Web workers and voice server must sign and verify tokens with the same secret, so it is not made per process
+    if os.environ.get(SECRET_ENV):
+        return os.environ[SECRET_ENV]
+    if not os.path.exists(path):
+        # Written aside and linked into place, so that concurrently started processes agree on the first secret
+        temp_path = f'{path}.{os.getpid()}'
+        with os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as file:
+            file.write(secrets.token_hex(16))
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+    with open(path) as file:
+        return file.read().strip()
+
+
+def verify_session(dao: ProfileDao, secret: str, jwt_token: str) -> (str, str) or None:  # (login, password hash)
+    try:
+        login_pass = jwt.decode(jwt_token, secret, algorithms=["HS256"])
+    except jwt.DecodeError:
+        return None
+    if 'login' in login_pass and 'password' in login_pass:
+        password = dao.lookup_auth(login_pass['login'])
+        if password is not None and password == get_hash(login_pass['password']):
+            return login_pass['login'], password
+    return None
+
+
+def verify_token(dao: ProfileDao, secret: str, jwt_token: str) -> str or None:  # Login, if token is valid
+    session = verify_session(dao, secret, jwt_token)
+    return None if session is None else session[0]
@@ -0,0 +1,243 @@
+import multiprocessing
+import os
+import tempfile
+import sqlite3
+import threading
+import time
+
+from flask import Flask, render_template, render_template_string
+
+from rest.page_loader import setup_templates
+from rest.profile_dao import Profile, ProfileDao
+from rest import pdf_report, worker
+from rest.app import create_app
+from rest.profile_envelope import decode_profile, encode_profile
+from rest.report_cache import get_report_key
+
+
+DB_PATH = 'benchmark_profiles.db'
+PROFILE_COUNT = 1000
+THREAD_COUNT = 16
+LOOKUP_COUNT = 500  # By each thread
+REQUEST_COUNT = 2000
+GAME_COUNT = 200
+PLAYER_COUNT = 8  # In each game
+LISTED_PROFILE_COUNT = 100000
+PAGE_COUNT = 200
+REPORT_COUNT = 400
+UNCACHED_REPORT_COUNT = 10
+ENVELOPE_COUNT = 2000
+REPORT_REQUEST_COUNT = 2000
+REPORT_WAIT_TIMEOUT = 300  # Seconds
+
+
+def lookup_with_new_connection(login: str) -> Profile or None:  # How ProfileDao worked before connection pooling
+    connection = sqlite3.connect(DB_PATH)
+    connection.row_factory = sqlite3.Row
+    row = connection.execute('''SELECT Profiles.*, Avatars.image FROM Profiles
+        JOIN Avatars ON Avatars.hash = Profiles.avatar
+        WHERE login = ?''', (login,)).fetchone()
+    connection.close()
+    if row is None:
+        return None
+    profile = dict(row)
+    del profile['avatar']
+    return Profile(**profile)
+
+
+def run_threads(lookup, thread_count: int = THREAD_COUNT, lookup_count: int = LOOKUP_COUNT) -> float:
+    def lookup_many(offset: int):
+        for i in range(lookup_count):
+            assert lookup(f'login_{(offset + i) % PROFILE_COUNT}') is not None
+
+    threads = [threading.Thread(target=lookup_many, args=(i * lookup_count,)) for i in range(thread_count)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return thread_count * lookup_count / (time.perf_counter() - start)
+
+
+def bench_lookup_profile():
+    if os.path.exists(DB_PATH):
+        os.remove(DB_PATH)
+    dao = ProfileDao(DB_PATH)
+    for i in range(PROFILE_COUNT):
+        dao.insert_profile(Profile(f'login_{i}', 'password', image=b'\x00' * 10000))
+
+    print(f'lookup_profile from {THREAD_COUNT} threads:')
+    print(f'    new connection per call: {run_threads(lookup_with_new_connection):8.0f} lookups/s')
+    print(f'       pooled ProfileDao:    {run_threads(dao.lookup_profile):8.0f} lookups/s')
+    print(f'     pooled lookup_auth:     {run_threads(dao.lookup_auth):8.0f} lookups/s')
+    dao.close()
+    os.remove(DB_PATH)
+
+
+def finish_games_one_by_one(dao: ProfileDao, results: list[tuple[str, int, bool]]):
+    for login, total_time, won in results:
+        dao.finish_game(login, total_time, won)
+
+
+def bench_finish_games():
+    if os.path.exists(DB_PATH):
+        os.remove(DB_PATH)
+    dao = ProfileDao(DB_PATH)
+    for i in range(PROFILE_COUNT):
+        dao.insert_profile(Profile(f'login_{i}', 'password'))
+    games = [[(f'login_{(game * PLAYER_COUNT + i) % PROFILE_COUNT}', 600, i % 3 == 0) for i in range(PLAYER_COUNT)]
+             for game in range(GAME_COUNT)]
+
+    print(f'{GAME_COUNT} games of {PLAYER_COUNT} players finished from {THREAD_COUNT} threads:')
+    for name, finish in [('finish_game per player', lambda results: finish_games_one_by_one(dao, results)),
+                         ('finish_games per game', dao.finish_games)]:
+        def finish_many(thread: int):
+            for results in games[thread::THREAD_COUNT]:
+                finish(results)
+
+        threads = [threading.Thread(target=finish_many, args=(i,)) for i in range(THREAD_COUNT)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print(f'    {name}: {GAME_COUNT / (time.perf_counter() - start):8.0f} games/s')
+    dao.close()
+    os.remove(DB_PATH)
+
+
+def render_page_from_strings(page: str, **context) -> str:  # How pages were rendered before PageLoader
+    template = open('rest/templates/base.html').read().replace('{main}', open(f'rest/templates/{page}').read())
+    return render_template_string(template, **context)
+
+
+def bench_render_page(request_count: int = REQUEST_COUNT):
+    app = Flask('rest.app', root_path=os.path.abspath('rest'))
+    setup_templates(app)
+    app.add_url_rule('/strings', 'strings', lambda: render_page_from_strings('index.html', authorized_login=None))
+    app.add_url_rule('/loader', 'loader', lambda: render_template('index.html', authorized_login=None))
+    client = app.test_client()
+    assert client.get('/strings').data == client.get('/loader').data
+
+    print(f'GET / with {request_count} requests:')
+    for name, url in [('render_template_string', '/strings'), ('PageLoader', '/loader')]:
+        start = time.perf_counter()
+        for _ in range(request_count):
+            client.get(url)
+        print(f'    {name:>22}: {request_count / (time.perf_counter() - start):8.0f} requests/s')
+
+
+def bench_list_logins():
+    if os.path.exists(DB_PATH):
+        os.remove(DB_PATH)
+    dao = ProfileDao(DB_PATH)
+    with dao.pool.connection() as connection:
+        avatar = dao.store_avatar(connection, b'avatar')
+        connection.executemany("INSERT INTO Profiles VALUES (?, 'password', '', ?, '', '', 0, 0, 0, 0)",
+                               [(f'login_{i:06}', avatar) for i in range(LISTED_PROFILE_COUNT)])
+
+    print(f'Listing of {LISTED_PROFILE_COUNT} profiles:')
+    start = time.perf_counter()
+    for _ in range(PAGE_COUNT // 20):
+        dao.get_all_logins()
+    print(f'    whole table: {PAGE_COUNT // 20 / (time.perf_counter() - start):8.0f} pages/s')
+    start = time.perf_counter()
+    after = None
+    for _ in range(PAGE_COUNT):
+        _, after = dao.get_logins_page(after)
+    print(f'    keyset page: {PAGE_COUNT / (time.perf_counter() - start):8.0f} pages/s')
+    start = time.perf_counter()
+    for i in range(PAGE_COUNT):
+        dao.get_logins_page(prefix=f'login_0{i % 100:02}')
+    print(f'    prefix page: {PAGE_COUNT / (time.perf_counter() - start):8.0f} pages/s')
+    dao.close()
+    os.remove(DB_PATH)
+
+
+def make_pdf_without_cache(profile: Profile) -> bytes:  # How reports were rendered before avatars were cached
+    worker.parsed_images.clear()
+    return worker.make_pdf_by_profile(profile)
+
+
+def render_reports(profiles: list[Profile]) -> int:
+    return sum(len(worker.make_pdf_by_profile(profile)) > 0 for profile in profiles)
+
+
+def bench_render_reports(worker_count: int = os.cpu_count()):
+    profiles = [Profile(f'login_{i}', 'password', total_time=i) for i in range(REPORT_COUNT)]
+
+    print('Rendering of reports:')
+    start = time.perf_counter()
+    for profile in profiles[:UNCACHED_REPORT_COUNT]:
+        make_pdf_without_cache(profile)
+    print(f'    avatar parsed for every report: {UNCACHED_REPORT_COUNT / (time.perf_counter() - start):8.1f} reports/s')
+    start = time.perf_counter()
+    render_reports(profiles)
+    print(f'    avatar parsed once:             {REPORT_COUNT / (time.perf_counter() - start):8.1f} reports/s')
+    with multiprocessing.Pool(worker_count) as pool:
+        pool.map(render_reports, [profiles[:1]] * worker_count)  # Every process parses avatar once in advance
+        batches = [profiles[i::worker_count] for i in range(worker_count)]
+        start = time.perf_counter()
+        assert sum(pool.map(render_reports, batches)) == REPORT_COUNT
+        print(f'    {worker_count} worker processes:             '
+              f'{REPORT_COUNT / (time.perf_counter() - start):8.1f} reports/s')
+
+
+def bench_profile_envelope():
+    profile = Profile('login', 'password', 'name', image=os.urandom(100 * 1024), mail='mail@example.com')
+    legacy = str(vars(profile))  # How profiles were sent before the envelope
+    envelope = encode_profile(profile)
+    print(f'Profile with {len(profile.image)} bytes of avatar:')
+    print(f'    repr: {len(legacy):8} bytes, envelope: {len(envelope):8} bytes')
+
+    start = time.perf_counter()
+    for _ in range(ENVELOPE_COUNT // 20):
+        Profile(**eval(str(vars(profile))))
+    print(f'    repr and eval:     {ENVELOPE_COUNT // 20 / (time.perf_counter() - start):8.0f} profiles/s')
+    start = time.perf_counter()
+    for _ in range(ENVELOPE_COUNT):
+        decode_profile(encode_profile(profile))
+    print(f'    encode and decode: {ENVELOPE_COUNT / (time.perf_counter() - start):8.0f} profiles/s')
+
+
+def bench_report_requests(transport: str, request_count: int = REPORT_REQUEST_COUNT):
+    directory = tempfile.mkdtemp()
+    app = create_app(os.path.join(directory, 'profiles.db'), '0' * 32, os.path.join(directory, 'reports'))
+    state = app.extensions['rest_mafia']
+    profiles = [Profile(f'login_{i}', 'password', total_time=i) for i in range(request_count)]
+    for profile in profiles:
+        state.dao.insert_profile(profile)
+    keys = [get_report_key(profile) for profile in profiles]
+
+    print(f'GET /report/<login> of {request_count} profiles through {transport}:')
+    os.environ[pdf_report.TRANSPORT_ENV] = transport
+    pdf_report.client = None
+    try:
+        pdf_report.get_report_client()
+    except Exception as err:
+        print(f'    skipped, since transport is not available: {err!r}')
+        return
+    client = app.test_client()
+    start = time.perf_counter()
+    for profile in profiles:
+        assert client.get(f'/report/{profile.login}').status_code == 200
+    requested = time.perf_counter()
+    print(f'    requested: {request_count / (requested - start):8.0f} requests/s')
+    while not all(key in state.report_cache for key in keys):
+        assert time.perf_counter() - start < REPORT_WAIT_TIMEOUT, 'Reports were not generated in time'
+        time.sleep(0.05)
+    print(f'    generated: {request_count / (time.perf_counter() - start):8.0f} reports/s')
+    pdf_report.get_report_client().close()
+    pdf_report.client = None
+    state.dao.close()
+
+
+if __name__ == '__main__':
+    bench_lookup_profile()
+    bench_finish_games()
+    bench_render_page()
+    bench_list_logins()
+    bench_render_reports()
+    bench_profile_envelope()
+    for report_transport in pdf_report.TRANSPORTS:
+        bench_report_requests(report_transport)
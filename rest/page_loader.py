@@ -0,0 +1,28 @@
+import os
+
+import jinja2
+from flask import Flask
+
+
+class PageLoader(jinja2.FileSystemLoader):  # Every page is rendered inside base.html, in place of its {main}
+    BASE_TEMPLATE = 'base.html'
+    MAIN_PLACEHOLDER = '{main}'
+
+    def get_source(self, environment: jinja2.Environment, template: str) -> (str, str, callable):
+        base, _, base_uptodate = super().get_source(environment, self.BASE_TEMPLATE)
+        page, path, page_uptodate = super().get_source(environment, template)
+        # Once composed, page is only loaded again if auto_reload is on and one of both files was modified
+        return base.replace(self.MAIN_PLACEHOLDER, page), path, lambda: base_uptodate() and page_uptodate()
+
+    def list_pages(self) -> list[str]:
+        return [template for template in self.list_templates()
+                if template.endswith('.html') and template != self.BASE_TEMPLATE]
+
+
+def setup_templates(app: Flask, bytecode_cache_dir: str or None = None):
+    loader = PageLoader(os.path.join(app.root_path, app.template_folder))
+    app.jinja_env.loader = loader
+    # Compiled pages are also kept on disk, so that restarted servers do not compile them again
+    app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_cache_dir)
+    for page in loader.list_pages():
+        app.jinja_env.get_template(page)
@@ -1,55 +1,203 @@
-import pika
+import enum
+import functools
+import os
+import threading
+import time
 import uuid
-from time import sleep
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pika
+
+from rest.profile_envelope import CONTENT_TYPE, QUEUE_NAME, encode_profile
+
+
+class ReportStatus(enum.Enum):
+    PENDING = 'pending'
+    READY = 'ready'
+    FAILED = 'failed'
+
+
+class ReportClient:  # Transport of report requests from website to workers
+    TIMEOUT = 60  # Seconds, after which report that was not generated is failed
+    POLL_INTERVAL = 1  # Seconds between checks of timed out requests
+
+    def request(self, profile) -> Future:  # Completed with pdf, or with an exception if report failed
+        raise NotImplementedError('request is not defined!')
+
+    def is_alive(self) -> bool:
+        return True
+
+    def close(self):
+        pass
+
+
+class LocalReportClient(ReportClient):  # Renders reports in processes of this host, without a broker
+    executor: ProcessPoolExecutor
+    broken: bool  # Set once a process of the pool died, after which pool fails every report
+    deadlines: dict[Future, float]  # Future of a report, which is returned to caller -> its deadline
+    lock: threading.Lock
+    closed: threading.Event
+    reaper: threading.Thread
 
+    def __init__(self, worker_count: int = os.cpu_count()):
+        from rest.worker import render_report  # Worker code is only needed by website if it renders reports itself
+        self.render_report = render_report
+        self.executor = ProcessPoolExecutor(worker_count)
+        self.broken = False
+        self.deadlines = {}
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        # Render that hangs would keep its report pending, so it is failed once it is late, as over RabbitMQ
+        self.reaper = threading.Thread(target=self.reap, daemon=True)
+        self.reaper.start()
 
-class QueueReader:
-    QUEUE_NAME = 'pdf_queue'
+    def request(self, profile) -> Future:
+        future = Future()
+        with self.lock:
+            self.deadlines[future] = time.monotonic() + self.TIMEOUT
+        try:
+            # Profile is sent in the same envelope as over RabbitMQ, since it is cheaper to pickle than Profile itself
+            rendering = self.executor.submit(self.render_report, encode_profile(profile))
+        except BrokenProcessPool:
+            self.broken = True
+            with self.lock:
+                del self.deadlines[future]
+            raise
+        rendering.add_done_callback(functools.partial(self.on_rendered, future))
+        return future
 
-    corr_id: str
-    response: str or None
+    def on_rendered(self, future: Future, rendering: Future):
+        if isinstance(rendering.exception(), BrokenProcessPool):
+            self.broken = True
+        with self.lock:
+            if self.deadlines.pop(future, None) is None:
+                return  # Already failed, since it was late
+        if rendering.exception() is not None:
+            future.set_exception(rendering.exception())
+        else:
+            future.set_result(rendering.result())
 
-    def __init__(self):
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters('localhost', heartbeat=0))
+    def reap(self):
+        while not self.closed.wait(self.POLL_INTERVAL):
+            now = time.monotonic()
+            with self.lock:
+                expired = [future for future, deadline in self.deadlines.items() if deadline <= now]
+                for future in expired:
+                    del self.deadlines[future]
+            for future in expired:
+                future.set_exception(TimeoutError('Report was not generated in time'))
+
+    def is_alive(self) -> bool:
+        return not self.broken
+
+    def close(self):
+        self.closed.set()
+        self.executor.shutdown(cancel_futures=True)
+
+
+class PikaReportClient(ReportClient):  # Sends requests over one RabbitMQ channel, matches replies by correlation id
+    connection: pika.BlockingConnection
+    channel: pika.adapters.blocking_connection.BlockingChannel
+    callback_queue: str
+    requests: dict[str, tuple[Future, float]]  # correlation id -> (future of a report, deadline)
+    lock: threading.Lock
+    consumer: threading.Thread
+
+    def __init__(self, host: str = 'localhost'):
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host, heartbeat=0))
         self.channel = self.connection.channel()
         result = self.channel.queue_declare(queue='', exclusive=True, durable=True)
         self.callback_queue = result.method.queue
+        self.channel.basic_consume(queue=self.callback_queue, on_message_callback=self.on_response, auto_ack=True)
+        self.requests = {}
+        self.lock = threading.Lock()
+        # Connection is not thread-safe, so only this thread uses it, while others pass callbacks to it
+        self.consumer = threading.Thread(target=self.consume, daemon=True)
+        self.consumer.start()
 
-        self.channel.basic_consume(
-            queue=self.callback_queue,
-            on_message_callback=self.on_response,
-            auto_ack=True)
-        self.response = None
+    def consume(self):
+        try:
+            while True:
+                self.connection.process_data_events(time_limit=self.POLL_INTERVAL)
+                self.fail_expired()
+        except pika.exceptions.AMQPError as err:
+            self.fail_all(err)
 
     def on_response(self, _, __, props, body):
-        if self.corr_id == props.correlation_id:
-            self.response = body
+        with self.lock:
+            future, _ = self.requests.pop(props.correlation_id, (None, None))
+        if future is not None:
+            future.set_result(body)
+
+    def fail_expired(self):
+        now = time.monotonic()
+        with self.lock:
+            expired = [corr_id for corr_id, (_, deadline) in self.requests.items() if deadline <= now]
+            futures = [self.requests.pop(corr_id)[0] for corr_id in expired]
+        for future in futures:
+            future.set_exception(TimeoutError('Report was not generated in time'))
 
-    def generate_pdf(self, profile) -> str:
-        self.corr_id = str(uuid.uuid4())
-        self.response = None
+    def fail_all(self, err: Exception):
+        with self.lock:
+            futures = [future for future, _ in self.requests.values()]
+            self.requests.clear()
+        for future in futures:
+            future.set_exception(err)
+
+    def request(self, profile) -> Future:  # Completed with pdf by consumer thread
+        corr_id = str(uuid.uuid4())
+        future = Future()
+        with self.lock:
+            self.requests[corr_id] = (future, time.monotonic() + self.TIMEOUT)
+        body = encode_profile(profile)
+        try:
+            self.connection.add_callback_threadsafe(lambda: self.publish(corr_id, body))
+        except pika.exceptions.AMQPError as err:
+            with self.lock:
+                self.requests.pop(corr_id, None)
+            future.set_exception(err)
+        return future
+
+    def publish(self, corr_id: str, body: bytes):
         self.channel.basic_publish(
             exchange='',
-            routing_key=self.QUEUE_NAME,
+            routing_key=QUEUE_NAME,
             properties=pika.BasicProperties(
                 reply_to=self.callback_queue,
                 delivery_mode=2,
-                correlation_id=self.corr_id,
+                correlation_id=corr_id,
+                content_type=CONTENT_TYPE,
             ),
-            body=str(vars(profile)))
+            body=body)
+
+    def is_alive(self) -> bool:
+        return self.consumer.is_alive()
+
+
+TRANSPORT_ENV = 'REST_MAFIA_REPORT_TRANSPORT'
+TRANSPORTS = {
+    'rabbitmq': PikaReportClient,
+    'local': LocalReportClient,
+}
+
 
-        while self.response is None:
-            self.connection.process_data_events()
-            sleep(0.1)
-        assert self.response is not None
-        return self.response
+def make_report_client(transport: str or None = None) -> ReportClient:
+    transport = transport or os.environ.get(TRANSPORT_ENV, 'rabbitmq')
+    if transport not in TRANSPORTS:
+        raise ValueError(f'Unknown report transport {transport}, expected one of {", ".join(TRANSPORTS)}')
+    return TRANSPORTS[transport]()
 
 
-reader = None
+client = None
+client_lock = threading.Lock()
 
 
-def generate_pdf_via_queue(profile):
-    global reader
-    if reader is None:
-        reader = QueueReader()
-    return reader.generate_pdf(profile)
+def get_report_client() -> ReportClient:
+    global client
+    with client_lock:
+        if client is None or not client.is_alive():
+            if client is not None:
+                client.close()
+            client = make_report_client()
+        return client
@@ -1,11 +1,31 @@
+import contextlib
+import functools
+import hashlib
+import queue
 import sqlite3
+import threading
+import time
+
+
+DEFAULT_AVATAR_PATH = 'rest/templates/default_avatar.png'
+
+
+@functools.cache
+def get_default_avatar() -> bytes:  # Read once, since every new profile starts with it
+    with open(DEFAULT_AVATAR_PATH, 'rb') as file:
+        return file.read()
+
+
+def get_avatar_hash(image: bytes) -> str:
+    return hashlib.sha256(image).hexdigest()
 
 
 class Profile:
     login: str
     password: str
     name: str
-    image: str
+    image: bytes
+    avatar: str  # Hash of the image, under which it is served
     gender: str
     mail: str
     total_time: int
@@ -14,11 +34,12 @@ class Profile:
     lose_count: int
 
     def __init__(self, login, password, name='', image=None, gender='', mail='',
-                 total_time=0, session_count=0, win_count=0, lose_count=0):
+                 total_time=0, session_count=0, win_count=0, lose_count=0, avatar=None):
         self.login = login
         self.password = password
         self.name = name
-        self.image = open('rest/templates/default_avatar.png', 'rb').read() if image is None else image
+        self.image = get_default_avatar() if image is None else image
+        self.avatar = get_avatar_hash(self.image) if avatar is None else avatar
         self.gender = gender
         self.mail = mail
         self.total_time = total_time
@@ -27,91 +48,307 @@ class Profile:
         self.lose_count = lose_count
 
 
+class ProfileSummary:  # Profile without password and image, e.g. for its page, which links to the avatar instead
+    login: str
+    name: str
+    avatar: str
+    gender: str
+    mail: str
+    total_time: int
+    session_count: int
+    win_count: int
+    lose_count: int
+
+    def __init__(self, login, name='', avatar='', gender='', mail='',
+                 total_time=0, session_count=0, win_count=0, lose_count=0):
+        self.login = login
+        self.name = name
+        self.avatar = avatar
+        self.gender = gender
+        self.mail = mail
+        self.total_time = total_time
+        self.session_count = session_count
+        self.win_count = win_count
+        self.lose_count = lose_count
+
+
+class ConnectionPool:
+    POOL_SIZE = 8
+    BUSY_TIMEOUT = 5  # Seconds to wait for a lock held by another connection
+    CACHED_STATEMENTS = 64  # Prepared statements kept by each connection
+
+    db_path: str
+    size: int
+    connections: list[sqlite3.Connection]  # Every connection opened by this pool
+    idle: queue.LifoQueue  # Recently used connections are reused first, since their pages are still cached
+    lock: threading.Lock
+    closed: bool
+
+    def __init__(self, db_path: str, size: int = POOL_SIZE):
+        self.db_path = db_path
+        self.size = size
+        self.connections = []
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def connect(self) -> sqlite3.Connection:
+        # Connections are shared between threads, but only one thread holds a connection at a time
+        connection = sqlite3.connect(self.db_path, timeout=self.BUSY_TIMEOUT, check_same_thread=False,
+                                     cached_statements=self.CACHED_STATEMENTS)
+        connection.row_factory = sqlite3.Row
+        # Readers do not block the writer in WAL mode, and commits do not wait for fsync of the whole database
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def acquire(self) -> sqlite3.Connection:
+        with self.lock:
+            if self.closed:
+                raise sqlite3.ProgrammingError('Cannot operate on a closed connection pool.')
+            if self.idle.empty() and len(self.connections) < self.size:
+                connection = self.connect()
+                self.connections.append(connection)
+                return connection
+        connection = self.idle.get()
+        if connection is None or self.closed:
+            self.idle.put(None)  # Wakes up the next thread that waits for a connection of a closed pool
+            raise sqlite3.ProgrammingError('Cannot operate on a closed connection pool.')
+        return connection
+
+    def release(self, connection: sqlite3.Connection):
+        self.idle.put(connection)
+
+    @contextlib.contextmanager
+    def connection(self) -> sqlite3.Connection:  # Commits once block is done, or rolls back if it raised
+        connection = self.acquire()
+        try:
+            with connection:
+                yield connection
+        finally:
+            self.release(connection)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            for connection in self.connections:
+                connection.close()
+            self.connections.clear()
+        self.idle.put(None)  # Threads that wait for a connection raise instead, one after another
+
+
 class ProfileDao:
     DB_PATH = 'profiles.db'
+    PROFILES_COLUMNS = '''(
+        "login" STRING PRIMARY KEY,
+        "password" STRING NOT NULL,  -- Actually sha256 of a real password
+        "name" STRING NOT NULL,
+        "avatar" STRING NOT NULL REFERENCES "Avatars" ("hash"),
+        "gender" STRING NOT NULL,
+        "mail" STRING NOT NULL,
+        "total_time" INTEGER NOT NULL,
+        "session_count" INTEGER NOT NULL,
+        "win_count" INTEGER NOT NULL,
+        "lose_count" INTEGER NOT NULL
+    )'''
 
-    def __init__(self):
-        connection = sqlite3.connect(self.DB_PATH)
-        connection.row_factory = sqlite3.Row
+    pool: ConnectionPool
 
-        connection.cursor().execute('''CREATE TABLE IF NOT EXISTS "Profiles" (
-            "login" STRING PRIMARY KEY,
-            "password" STRING NOT NULL,  -- Actually sha256 of a real password
-            "name" STRING NOT NULL,
-            "image" BLOB NOT NULL,
-            "gender" STRING NOT NULL,
-            "mail" STRING NOT NULL,
-            "total_time" INTEGER NOT NULL,
-            "session_count" INTEGER NOT NULL,
-            "win_count" INTEGER NOT NULL,
-            "lose_count" INTEGER NOT NULL
-        );''')
-        connection.commit()
+    def __init__(self, db_path: str = DB_PATH, pool_size: int = ConnectionPool.POOL_SIZE):
+        self.pool = ConnectionPool(db_path, pool_size)
+        with self.pool.connection() as connection:
+            # Avatars are kept apart from profiles, so that lookups which do not need them stay small
+            connection.execute('''CREATE TABLE IF NOT EXISTS "Avatars" (
+                "hash" STRING PRIMARY KEY,  -- sha256 of an image, so that equal avatars are stored once
+                "image" BLOB NOT NULL
+            );''')
+            connection.execute(f'CREATE TABLE IF NOT EXISTS "Profiles" {self.PROFILES_COLUMNS}')
+            # Reports that are being generated by some web worker or failed to, by keys of their contents
+            connection.execute('''CREATE TABLE IF NOT EXISTS "ReportRequests" (
+                "key" STRING PRIMARY KEY,
+                "requested" REAL NOT NULL,
+                "failed" INTEGER NOT NULL DEFAULT 0
+            );''')
+            self.migrate_images(connection)
+            self.migrate_reports(connection)
 
-    def get_all_logins(self) -> list[str]:
-        connection = sqlite3.connect(self.DB_PATH)
-        connection.row_factory = sqlite3.Row
+    @staticmethod
+    def get_old_profiles_columns(connection: sqlite3.Connection) -> dict[str, sqlite3.Row] or None:
+        # Of databases that stored images inside profiles, or got a nullable avatar column once they were migrated
+        columns = {row['name']: row for row in connection.execute('PRAGMA table_info("Profiles")')}
+        return None if 'image' not in columns and columns['avatar']['notnull'] else columns
+
+    def migrate_images(self, connection: sqlite3.Connection):
+        if self.get_old_profiles_columns(connection) is None:
+            return
+        # Every worker migrates once it starts, so the whole rebuild is a single transaction. Workers that start
+        # meanwhile wait for it and then find schema migrated, and a crash midway leaves the old schema intact
+        connection.execute('BEGIN IMMEDIATE')
+        columns = self.get_old_profiles_columns(connection)
+        if columns is None:
+            return
+        # SQLite cannot make a column NOT NULL, so profiles are copied into a new table
+        connection.execute('ALTER TABLE Profiles RENAME TO "OldProfiles"')
+        connection.execute(f'CREATE TABLE "Profiles" {self.PROFILES_COLUMNS}')
+        default_avatar = self.store_avatar(connection, get_default_avatar())
+        if 'image' in columns:
+            rows = connection.execute('SELECT * FROM OldProfiles').fetchall()
+        else:
+            rows = connection.execute('''SELECT OldProfiles.*, Avatars.hash AS stored_avatar FROM OldProfiles
+                LEFT JOIN Avatars ON Avatars.hash = OldProfiles.avatar''').fetchall()
+        for row in rows:
+            if 'image' in columns:
+                avatar = self.store_avatar(connection, row['image'])
+            else:
+                avatar = row['stored_avatar'] or default_avatar  # Profiles that lost their avatar get the default one
+            connection.execute('''INSERT INTO Profiles (login, password, name, avatar, gender, mail,
+                total_time, session_count, win_count, lose_count) VALUES (?,?,?,?,?,?,?,?,?,?)''', (
+                row['login'], row['password'], row['name'], avatar, row['gender'], row['mail'],
+                row['total_time'], row['session_count'], row['win_count'], row['lose_count']
+            ))
+        connection.execute('DROP TABLE "OldProfiles"')
+        self.remove_unused_avatar(connection, default_avatar)
+
+    @staticmethod
+    def migrate_reports(connection: sqlite3.Connection):  # Of databases that kept reports, which are on disk now
+        if connection.execute('''SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Reports' ''').fetchone():
+            connection.execute('DROP TABLE "Reports"')
 
-        cursor = connection.cursor()
-        cursor.execute('SELECT login FROM Profiles')
-        rows = cursor.fetchall()
-        cursor.close()
+    def close(self):
+        self.pool.close()
+
+    @staticmethod
+    def store_avatar(connection: sqlite3.Connection, image: bytes) -> str:
+        avatar = get_avatar_hash(image)
+        connection.execute('INSERT OR IGNORE INTO Avatars VALUES (?,?)', (avatar, image))
+        return avatar
+
+    @staticmethod
+    def remove_unused_avatar(connection: sqlite3.Connection, avatar: str):
+        connection.execute('''DELETE FROM Avatars
+            WHERE hash = ? AND NOT EXISTS (SELECT 1 FROM Profiles WHERE avatar = ?)''', (avatar, avatar))
+
+    def get_all_logins(self) -> list[str]:
+        with self.pool.connection() as connection:
+            rows = connection.execute('SELECT login FROM Profiles').fetchall()
         return [row['login'] for row in rows]
 
-    def insert_profile(self, profile: Profile) -> None:
-        connection = sqlite3.connect(self.DB_PATH)
-        connection.row_factory = sqlite3.Row
+    PAGE_SIZE = 50
 
-        connection.cursor().execute('INSERT INTO Profiles VALUES (?,?,?,?,?,?,?,?,?,?)', (
-            profile.login, profile.password, profile.name, profile.image, profile.gender, profile.mail,
-            profile.total_time, profile.session_count, profile.win_count, profile.lose_count
-        ))
-        connection.commit()
+    @staticmethod
+    def get_prefix_end(prefix: str) -> str:  # Least string that is greater than every string with this prefix
+        return prefix[:-1] + chr(ord(prefix[-1]) + 1)
 
-    def lookup_profile(self, login: str) -> Profile or None:
-        connection = sqlite3.connect(self.DB_PATH)
-        connection.row_factory = sqlite3.Row
+    def get_logins_page(self, after: str or None = None, prefix: str = '',
+                        limit: int = PAGE_SIZE) -> (list[str], str or None):  # (logins, login to continue after)
+        # Only ranges over the primary key are used, so that every page reads at most limit + 1 index entries
+        conditions, params = [], []
+        if after is not None:
+            conditions.append('login > ?')
+            params.append(after)
+        if prefix:
+            conditions.append('login >= ? AND login < ?')
+            params += [prefix, self.get_prefix_end(prefix)]
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        with self.pool.connection() as connection:
+            rows = connection.execute(f'SELECT login FROM Profiles {where} ORDER BY login LIMIT ?',
+                                      (*params, limit + 1)).fetchall()
+        logins = [row['login'] for row in rows[:limit]]
+        return logins, logins[-1] if len(rows) > limit else None
 
-        cursor = connection.cursor()
-        cursor.execute('SELECT * FROM Profiles WHERE "login"=?', (login,))
-        row = cursor.fetchone()
-        cursor.close()
+    def insert_profile(self, profile: Profile) -> None:
+        with self.pool.connection() as connection:
+            connection.execute('INSERT OR IGNORE INTO Avatars VALUES (?,?)', (profile.avatar, profile.image))
+            connection.execute('''INSERT INTO Profiles (login, password, name, avatar, gender, mail,
+                total_time, session_count, win_count, lose_count) VALUES (?,?,?,?,?,?,?,?,?,?)''', (
+                profile.login, profile.password, profile.name, profile.avatar, profile.gender, profile.mail,
+                profile.total_time, profile.session_count, profile.win_count, profile.lose_count
+            ))
+
+    def lookup_profile(self, login: str) -> Profile or None:
+        with self.pool.connection() as connection:
+            row = connection.execute('''SELECT Profiles.*, Avatars.image FROM Profiles
+                JOIN Avatars ON Avatars.hash = Profiles.avatar
+                WHERE login = ?''', (login,)).fetchone()
         if row is None:
             return None
-        return Profile(login=row['login'], password=row['password'], image=row['image'],
+        return Profile(login=row['login'], password=row['password'], image=row['image'], avatar=row['avatar'],
                        name=row['name'], gender=row['gender'], mail=row['mail'], total_time=row['total_time'],
                        session_count=row['session_count'], win_count=row['win_count'], lose_count=row['lose_count'])
 
-    def modify_profile(self, login: str, password=None, name=None, image=None, gender=None, mail=None) -> None:
-        connection = sqlite3.connect(self.DB_PATH)
-        connection.row_factory = sqlite3.Row
+    def lookup_auth(self, login: str) -> str or None:  # Password hash, which is all that authorization needs
+        with self.pool.connection() as connection:
+            row = connection.execute('SELECT password FROM Profiles WHERE login = ?', (login,)).fetchone()
+        return None if row is None else row['password']
+
+    def lookup_avatar(self, login: str) -> (str, bytes) or None:  # (hash, image) of an avatar of this login
+        with self.pool.connection() as connection:
+            row = connection.execute('''SELECT Avatars.hash, Avatars.image FROM Profiles
+                JOIN Avatars ON Avatars.hash = Profiles.avatar
+                WHERE login = ?''', (login,)).fetchone()
+        return None if row is None else (row['hash'], row['image'])
+
+    REPORT_TIMEOUT = 60  # Seconds, after which report that is still generated is requested again
+
+    def start_report(self, key: str) -> bool:  # Whether caller should generate it, since nobody else does
+        now = time.time()
+        with self.pool.connection() as connection:
+            cursor = connection.execute('''INSERT INTO ReportRequests (key, requested) VALUES (?, ?)
+                ON CONFLICT (key) DO UPDATE SET requested = excluded.requested, failed = 0
+                WHERE failed OR requested < ?''', (key, now, now - self.REPORT_TIMEOUT))
+        return cursor.rowcount == 1
 
-        profile = self.lookup_profile(login)
-        profile.password = profile.password if password is None else password
-        profile.name = profile.name if name is None else name
-        profile.image = profile.image if image is None else image
-        profile.gender = profile.gender if gender is None else gender
-        profile.mail = profile.mail if mail is None else mail
+    def fail_report(self, key: str) -> None:  # Failed report is generated again once it is requested
+        with self.pool.connection() as connection:
+            connection.execute('UPDATE ReportRequests SET failed = 1 WHERE key = ?', (key,))
 
-        connection.cursor().execute(
-            '''UPDATE Profiles
-            SET password = ?, name = ?, image = ?, gender = ?, mail = ?
-            WHERE login = ?''',
-            (profile.password, profile.name, profile.image, profile.gender, profile.mail, profile.login))
-        connection.commit()
+    def lookup_report_failed(self, key: str) -> bool or None:  # None if report is not being generated
+        with self.pool.connection() as connection:
+            row = connection.execute('SELECT failed, requested FROM ReportRequests WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        # Report that was not generated in time failed as well, e.g. since web worker that requested it was restarted
+        return bool(row['failed']) or row['requested'] < time.time() - self.REPORT_TIMEOUT
+
+    def finish_report(self, key: str) -> None:
+        with self.pool.connection() as connection:
+            connection.execute('DELETE FROM ReportRequests WHERE key = ?', (key,))
+
+    def lookup_summary(self, login: str) -> ProfileSummary or None:
+        with self.pool.connection() as connection:
+            row = connection.execute('''SELECT login, name, avatar, gender, mail,
+                total_time, session_count, win_count, lose_count
+                FROM Profiles WHERE login = ?''', (login,)).fetchone()
+        return None if row is None else ProfileSummary(**row)
+
+    def modify_profile(self, login: str, password=None, name=None, image=None, gender=None, mail=None) -> None:
+        with self.pool.connection() as connection:
+            old_avatar = None
+            avatar = None
+            if image is not None:
+                row = connection.execute('SELECT avatar FROM Profiles WHERE login = ?', (login,)).fetchone()
+                old_avatar = None if row is None else row['avatar']
+                avatar = self.store_avatar(connection, image)
+            # Fields that are None keep their values
+            connection.execute(
+                '''UPDATE Profiles
+                SET password = COALESCE(?, password), name = COALESCE(?, name), avatar = COALESCE(?, avatar),
+                    gender = COALESCE(?, gender), mail = COALESCE(?, mail)
+                WHERE login = ?''',
+                (password, name, avatar, gender, mail, login))
+            if old_avatar is not None and old_avatar != avatar:
+                self.remove_unused_avatar(connection, old_avatar)
+
+    # Counters are incremented by SQLite itself, so concurrent games cannot overwrite results of each other
+    FINISH_GAME_QUERY = '''UPDATE Profiles
+        SET total_time = total_time + ?, session_count = session_count + 1,
+            win_count = win_count + ?, lose_count = lose_count + ?
+        WHERE login = ?'''
 
     def finish_game(self, login: str, total_time: int, won: bool) -> None:
-        connection = sqlite3.connect(self.DB_PATH)
-        connection.row_factory = sqlite3.Row
+        self.finish_games([(login, total_time, won)])
 
-        profile = self.lookup_profile(login)
-        profile.total_time += total_time
-        profile.session_count += 1
-        profile.win_count += won
-        profile.lose_count += not won
-        connection.cursor().execute(
-            '''UPDATE Profiles
-            SET total_time = ?, session_count = ?, win_count = ?, lose_count = ?
-            WHERE login = ?''',
-            (profile.total_time, profile.session_count, profile.win_count, profile.lose_count, profile.login))
-        connection.commit()
+    def finish_games(self, results: list[tuple[str, int, bool]]) -> None:  # (login, total_time, won) in one transaction
+        with self.pool.connection() as connection:
+            connection.executemany(self.FINISH_GAME_QUERY, [(total_time, int(won), int(not won), login)
+                                                            for login, total_time, won in results])
@@ -0,0 +1,57 @@
+import struct
+
+from rest.profile_dao import Profile, get_default_avatar, get_avatar_hash
+
+
+QUEUE_NAME = 'pdf_queue'  # Of RabbitMQ, which website sends report requests to
+
+# Profile as it is sent to report workers: only fields printed in a report, in a fixed binary layout.
+# Header: version, flags, sha256 of avatar, total_time, session_count, win_count, lose_count.
+# Then login, name, gender and mail, each as length and UTF-8, and then raw avatar unless it is omitted
+CONTENT_TYPE = 'application/x-mafia-profile'
+VERSION = 1
+HAS_IMAGE = 1  # Otherwise avatar is the default one, which every worker already has
+HEADER = struct.Struct('>BB32s4q')
+STR_LENGTH = struct.Struct('>H')
+STR_FIELDS = ('login', 'name', 'gender', 'mail')
+
+
+def encode_profile(profile: Profile) -> bytes:
+    avatar = bytes.fromhex(profile.avatar)
+    has_image = profile.image != get_default_avatar()
+    parts = [HEADER.pack(VERSION, HAS_IMAGE if has_image else 0, avatar, profile.total_time,
+                         profile.session_count, profile.win_count, profile.lose_count)]
+    for field in STR_FIELDS:
+        value = getattr(profile, field).encode()
+        if len(value) > 0xFFFF:
+            raise ValueError(f'Field {field} is too long to be sent: {len(value)} bytes')
+        parts += [STR_LENGTH.pack(len(value)), value]
+    if has_image:
+        parts.append(profile.image)
+    return b''.join(parts)
+
+
+def decode_profile(data: bytes) -> Profile:
+    data = memoryview(data)
+    try:
+        version, flags, avatar, total_time, session_count, win_count, lose_count = HEADER.unpack_from(data)
+        if version != VERSION:
+            raise ValueError(f'Unknown version of profile envelope: {version}')
+        pos = HEADER.size
+        fields = {}
+        for field in STR_FIELDS:
+            length, = STR_LENGTH.unpack_from(data, pos)
+            pos += STR_LENGTH.size
+            if pos + length > len(data):
+                raise ValueError(f'Field {field} is truncated')
+            fields[field] = str(data[pos:pos + length], 'utf-8')
+            pos += length
+    except struct.error as err:
+        raise ValueError(f'Truncated profile envelope: {err}') from err
+
+    image = bytes(data[pos:]) if flags & HAS_IMAGE else get_default_avatar()
+    if get_avatar_hash(image) != avatar.hex():
+        raise ValueError('Avatar does not match its hash')
+    # Password is never sent to workers, since reports do not need it
+    return Profile(password='', image=image, avatar=avatar.hex(), total_time=total_time, session_count=session_count,
+                   win_count=win_count, lose_count=lose_count, **fields)
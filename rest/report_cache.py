@@ -0,0 +1,71 @@
+import hashlib
+import os
+
+from rest.profile_dao import Profile, ProfileSummary
+
+
+# Fields printed by worker.make_pdf_by_profile, so that report is only generated again once one of them changes
+REPORT_FIELDS = ('login', 'name', 'gender', 'mail', 'avatar', 'total_time', 'session_count', 'win_count', 'lose_count')
+
+
+def get_report_key(profile: Profile or ProfileSummary) -> str:
+    fields = '\0'.join(str(getattr(profile, field)) for field in REPORT_FIELDS)
+    return hashlib.sha256(fields.encode()).hexdigest()
+
+
+class ReportCache:  # Generated reports on disk, shared by every web worker and kept across restarts
+    DIRECTORY = 'reports'
+    MAX_SIZE = 256 * 1024 * 1024  # Bytes, after which least recently used reports are removed
+
+    directory: str
+    max_size: int
+
+    def __init__(self, directory: str = DIRECTORY, max_size: int = MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.pdf')
+
+    def get(self, key: str) -> bytes or None:
+        try:
+            with open(self.get_path(key), 'rb') as file:
+                pdf = file.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(self.get_path(key))  # Modification time is when report was used last
+        except FileNotFoundError:
+            pass
+        return pdf
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self.get_path(key))
+
+    def put(self, key: str, pdf: bytes):
+        # Written aside and moved into place, so that other workers never read a partial report
+        temp_path = f'{self.get_path(key)}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(pdf)
+        os.replace(temp_path, self.get_path(key))
+        self.evict()
+
+    def evict(self):
+        reports = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pdf'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                reports.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in reports)
+        for _, size, path in sorted(reports):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
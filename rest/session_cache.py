@@ -0,0 +1,71 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class SessionCache:  # Logins of verified JWT tokens, so that authorized page views do not decode them again
+    MAX_SIZE = 4096
+    TTL = 300  # Seconds, after which token is verified again
+
+    max_size: int
+    ttl: float
+    clock: callable
+    # token -> (login, password hash, expiration time), least recently used first. Password may be changed through
+    # another worker, whose invalidation this cache does not see, so callers compare the hash with the database
+    sessions: OrderedDict[str, tuple[str, str, float]]
+    login_tokens: dict[str, set[str]]
+    lock: threading.Lock
+    hit_count: int
+    miss_count: int
+
+    def __init__(self, max_size: int = MAX_SIZE, ttl: float = TTL, clock: callable = time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.sessions = OrderedDict()
+        self.login_tokens = {}
+        self.lock = threading.Lock()
+        self.hit_count = 0
+        self.miss_count = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, token: str) -> (str, str) or None:  # (login, password hash)
+        with self.lock:
+            session = self.sessions.get(token)
+            if session is not None and session[2] <= self.clock():
+                self.remove(token)
+                session = None
+            if session is None:
+                self.miss_count += 1
+                return None
+            self.sessions.move_to_end(token)
+            self.hit_count += 1
+            return session[0], session[1]
+
+    def put(self, token: str, login: str, password: str):
+        with self.lock:
+            if token in self.sessions:
+                self.remove(token)
+            self.sessions[token] = (login, password, self.clock() + self.ttl)
+            self.login_tokens.setdefault(login, set()).add(token)
+            while len(self.sessions) > self.max_size:
+                self.remove(next(iter(self.sessions)))
+
+    def invalidate(self, token: str):
+        with self.lock:
+            if token in self.sessions:
+                self.remove(token)
+
+    def invalidate_login(self, login: str):  # Once password is changed, old tokens of this login are not valid
+        with self.lock:
+            for token in list(self.login_tokens.get(login, ())):
+                self.remove(token)
+
+    def remove(self, token: str):
+        login, _, _ = self.sessions.pop(token)
+        tokens = self.login_tokens[login]
+        tokens.discard(token)
+        if not tokens:
+            del self.login_tokens[login]
@@ -0,0 +1,52 @@
+import datetime
+import hashlib
+import mimetypes
+import os
+
+from flask import Response, request
+
+
+ASSET_MAX_AGE = 7 * 24 * 60 * 60  # Seconds, for which browsers do not ask for assets again
+IMAGE_SIGNATURES = {
+    b'\x89PNG\r\n\x1a\n': 'image/png',
+    b'\xff\xd8\xff': 'image/jpeg',
+    b'GIF87a': 'image/gif',
+    b'GIF89a': 'image/gif',
+    b'\x00\x00\x01\x00': 'image/x-icon',
+}
+
+
+def guess_image_type(image: bytes) -> str:
+    for signature, mimetype in IMAGE_SIGNATURES.items():
+        if image.startswith(signature):
+            return mimetype
+    return 'application/octet-stream'
+
+
+class StaticAsset:  # File that is read once on startup and then served from memory
+    data: bytes
+    mimetype: str
+    etag: str
+    last_modified: datetime.datetime
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as file:
+            self.data = file.read()
+        self.mimetype = mimetypes.guess_type(path)[0] or guess_image_type(self.data)
+        self.etag = hashlib.sha256(self.data).hexdigest()
+        self.last_modified = datetime.datetime.fromtimestamp(os.path.getmtime(path), datetime.timezone.utc)
+
+    def response(self) -> Response:
+        return send_cached(self.data, self.mimetype, self.etag, ASSET_MAX_AGE, self.last_modified)
+
+
+def send_cached(data: bytes, mimetype: str, etag: str, max_age: int,
+                last_modified: datetime.datetime or None = None, immutable: bool = False) -> Response:
+    response = Response(data, mimetype=mimetype)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.immutable = immutable
+    # Turns into an empty 304 response if browser already has this version
+    return response.make_conditional(request)
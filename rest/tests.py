@@ -1,11 +1,31 @@
-from rest.profile_dao import Profile, ProfileDao
+from rest.profile_dao import Profile, ProfileDao, get_avatar_hash, get_default_avatar
+from rest.session_cache import SessionCache
+from rest.page_loader import PageLoader, setup_templates
+from rest.static_assets import StaticAsset
+from rest.auth import SECRET_ENV, load_secret
+import rest.app
+from rest.app import create_app
+from rest.report_cache import ReportCache, get_report_key
+from rest import worker
+from rest.profile_envelope import decode_profile, encode_profile
+from rest.pdf_report import LocalReportClient, make_report_client
 import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from flask import Flask, render_template
 
 
 def test_dao_init():
     if os.path.exists(ProfileDao.DB_PATH):
         os.remove(ProfileDao.DB_PATH)
-    ProfileDao()
+    ProfileDao().close()
     assert os.path.exists(ProfileDao.DB_PATH)
     assert len(open(ProfileDao.DB_PATH, 'rb').read()) > 0
     os.remove(ProfileDao.DB_PATH)
@@ -37,6 +57,7 @@ def test_dao_get_all_logins():
     dao.insert_profile(profile)
 
     assert set(dao.get_all_logins()) == {BASE_PROFILE.login, profile.login}
+    dao.close()
     os.remove(ProfileDao.DB_PATH)
 
 
@@ -48,6 +69,7 @@ def test_dao_get_profile():
 
     dao_profile = dao.lookup_profile(BASE_PROFILE.login)
     assert vars(dao_profile) == vars(BASE_PROFILE)
+    dao.close()
     os.remove(ProfileDao.DB_PATH)
 
 
@@ -63,6 +85,7 @@ def test_dao_modify_profile():
     assert new_profile.gender == 'Female'
     new_profile.mail, new_profile.gender = BASE_PROFILE.mail, BASE_PROFILE.gender
     assert vars(new_profile) == vars(BASE_PROFILE)
+    dao.close()
     os.remove(ProfileDao.DB_PATH)
 
 
@@ -85,4 +108,470 @@ def test_dao_finish_game():
     assert profile.session_count == BASE_PROFILE.session_count + 2
     assert profile.win_count == BASE_PROFILE.win_count + 1
     assert profile.lose_count == BASE_PROFILE.lose_count + 1
+    dao.close()
+    os.remove(ProfileDao.DB_PATH)
+
+
+def test_dao_finish_games():
+    if os.path.exists(ProfileDao.DB_PATH):
+        os.remove(ProfileDao.DB_PATH)
+    dao = ProfileDao()
+    logins = [f'player{i}' for i in range(5)]
+    for login in logins:
+        dao.insert_profile(Profile(login, 'password'))
+
+    threads = [threading.Thread(target=dao.finish_games, args=([(login, 10, login == logins[0]) for login in logins],))
+               for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for login in logins:
+        profile = dao.lookup_profile(login)
+        assert profile.total_time == 200
+        assert profile.session_count == 20
+        assert profile.win_count == (20 if login == logins[0] else 0)
+        assert profile.lose_count == (0 if login == logins[0] else 20)
+    dao.close()
+    os.remove(ProfileDao.DB_PATH)
+
+
+def test_dao_connection_pool():
+    if os.path.exists(ProfileDao.DB_PATH):
+        os.remove(ProfileDao.DB_PATH)
+    dao = ProfileDao(pool_size=2)
+    dao.insert_profile(BASE_PROFILE)
+
+    results = []
+
+    def lookup_many():
+        results.extend(dao.lookup_profile(BASE_PROFILE.login).login for _ in range(50))
+
+    threads = [threading.Thread(target=lookup_many) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [BASE_PROFILE.login] * 400
+    assert len(dao.pool.connections) <= 2
+    with dao.pool.connection() as connection:
+        assert connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+    dao.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        dao.lookup_profile(BASE_PROFILE.login)
+    os.remove(ProfileDao.DB_PATH)
+
+
+def test_dao_connection_pool_close():
+    if os.path.exists(ProfileDao.DB_PATH):
+        os.remove(ProfileDao.DB_PATH)
+    dao = ProfileDao(pool_size=1)
+    errors = []
+
+    def wait_for_connection():
+        try:
+            dao.lookup_auth(BASE_PROFILE.login)
+        except sqlite3.ProgrammingError as err:
+            errors.append(err)
+
+    dao.pool.acquire()  # Only connection of the pool, so that other threads wait for it
+    threads = [threading.Thread(target=wait_for_connection) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    dao.close()
+    for thread in threads:
+        thread.join(5)
+        assert not thread.is_alive()
+    assert len(errors) == 3
+    os.remove(ProfileDao.DB_PATH)
+
+
+def test_dao_get_logins_page():
+    if os.path.exists(ProfileDao.DB_PATH):
+        os.remove(ProfileDao.DB_PATH)
+    dao = ProfileDao()
+    for login in ['bob', 'alice', 'bobby', 'carol', 'bo']:
+        dao.insert_profile(Profile(login, 'x'))
+
+    assert dao.get_logins_page(limit=2) == (['alice', 'bo'], 'bo')
+    assert dao.get_logins_page('bo', limit=2) == (['bob', 'bobby'], 'bobby')
+    assert dao.get_logins_page('bobby', limit=2) == (['carol'], None)
+    assert dao.get_logins_page(prefix='bob') == (['bob', 'bobby'], None)
+    assert dao.get_logins_page('bob', prefix='bo', limit=1) == (['bobby'], None)
+    assert dao.get_logins_page(prefix='d') == ([], None)
+    dao.close()
+    os.remove(ProfileDao.DB_PATH)
+
+
+def test_dao_avatars():
+    if os.path.exists(ProfileDao.DB_PATH):
+        os.remove(ProfileDao.DB_PATH)
+    dao = ProfileDao()
+    dao.insert_profile(BASE_PROFILE)
+    dao.insert_profile(Profile('x', 'y'))
+    dao.insert_profile(Profile('z', 'w'))
+    assert dao.lookup_profile('x').image == get_default_avatar()
+
+    assert dao.lookup_auth(BASE_PROFILE.login) == BASE_PROFILE.password
+    assert dao.lookup_auth('nobody') is None
+    summary = dao.lookup_summary(BASE_PROFILE.login)
+    assert vars(summary) == {field: value for field, value in vars(BASE_PROFILE).items()
+                             if field not in ('password', 'image')}
+    assert get_report_key(summary) == get_report_key(BASE_PROFILE)
+    assert dao.lookup_summary('nobody') is None
+
+    with dao.pool.connection() as connection:
+        assert connection.execute('SELECT COUNT(*) FROM Avatars').fetchone()[0] == 2
+    dao.modify_profile('x', image=b'new avatar')
+    dao.modify_profile(BASE_PROFILE.login, image=b'new avatar')
+    assert dao.lookup_profile('x').image == dao.lookup_profile(BASE_PROFILE.login).image == b'new avatar'
+    assert dao.lookup_avatar('x') == (get_avatar_hash(b'new avatar'), b'new avatar')
+    assert dao.lookup_profile('x').avatar == get_avatar_hash(b'new avatar')
+    assert dao.lookup_avatar('nobody') is None
+    with dao.pool.connection() as connection:
+        assert connection.execute('SELECT COUNT(*) FROM Avatars').fetchone()[0] == 2  # Old image was removed
+    dao.close()
+    os.remove(ProfileDao.DB_PATH)
+
+
+IMAGE_COLUMN = '"image" BLOB NOT NULL'
+NULLABLE_AVATAR_COLUMN = '"avatar" STRING'
+NAME_COLUMN = '"name" STRING NOT NULL'
+NULLABLE_NAME_COLUMN = '"name" STRING'
+
+
+def test_dao_migrate_avatars():
+    if os.path.exists(ProfileDao.DB_PATH):
+        os.remove(ProfileDao.DB_PATH)
+    columns = '"login" STRING PRIMARY KEY, "password" STRING NOT NULL, "name" STRING NOT NULL, {}, ' \
+              '"gender" STRING NOT NULL, "mail" STRING NOT NULL, "total_time" INTEGER NOT NULL, ' \
+              '"session_count" INTEGER NOT NULL, "win_count" INTEGER NOT NULL, "lose_count" INTEGER NOT NULL'
+    connection = sqlite3.connect(ProfileDao.DB_PATH)
+    connection.execute(f'CREATE TABLE Profiles ({columns.format(IMAGE_COLUMN)})')
+    connection.execute("INSERT INTO Profiles VALUES ('a', 'b', 'c', x'64', 'e', 'f', 7, 8, 9, 10)")
+    connection.commit()
+    connection.close()
+    dao = ProfileDao()
+    assert vars(dao.lookup_profile('a')) == vars(BASE_PROFILE)
+    dao.close()
+
+    # Avatar column of databases migrated before it was NOT NULL, with profiles that lost their avatars
+    os.remove(ProfileDao.DB_PATH)
+    connection = sqlite3.connect(ProfileDao.DB_PATH)
+    connection.execute('CREATE TABLE Avatars ("hash" STRING PRIMARY KEY, "image" BLOB NOT NULL)')
+    connection.execute(f'CREATE TABLE Profiles ({columns.format(NULLABLE_AVATAR_COLUMN)})')
+    connection.execute("INSERT INTO Profiles VALUES ('x', 'y', '', NULL, '', '', 0, 0, 0, 0)")
+    connection.execute("INSERT INTO Profiles VALUES ('z', 'w', '', 'removed', '', '', 0, 0, 0, 0)")
+    connection.commit()
+    connection.close()
+    dao = ProfileDao()
+    for login in ['x', 'z']:
+        assert dao.lookup_profile(login).image == get_default_avatar()
+        assert dao.lookup_avatar(login) == (get_avatar_hash(get_default_avatar()), get_default_avatar())
+    with dao.pool.connection() as connection:
+        assert [row['notnull'] for row in connection.execute('PRAGMA table_info("Profiles")')
+                if row['name'] == 'avatar'] == [1]
+    dao.close()
+
+    # Migration that fails midway, here on a name that new schema does not allow, leaves the old schema intact
     os.remove(ProfileDao.DB_PATH)
+    connection = sqlite3.connect(ProfileDao.DB_PATH)
+    nullable_name_columns = columns.format(IMAGE_COLUMN).replace(NAME_COLUMN, NULLABLE_NAME_COLUMN)
+    connection.execute(f'CREATE TABLE Profiles ({nullable_name_columns})')
+    connection.execute("INSERT INTO Profiles VALUES ('a', 'b', NULL, x'64', 'e', 'f', 7, 8, 9, 10)")
+    connection.commit()
+    connection.close()
+    with pytest.raises(sqlite3.IntegrityError):
+        ProfileDao()
+    connection = sqlite3.connect(ProfileDao.DB_PATH)
+    assert [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")] == \
+        ['Profiles', 'Avatars', 'ReportRequests']
+    assert 'image' in [row[1] for row in connection.execute('PRAGMA table_info("Profiles")')]
+    assert connection.execute('SELECT login FROM Profiles').fetchall() == [('a',)]
+    connection.close()
+    os.remove(ProfileDao.DB_PATH)
+
+
+def test_session_cache():
+    now = [0]
+    cache = SessionCache(max_size=2, ttl=10, clock=lambda: now[0])
+    cache.put('token1', 'alice', 'hash1')
+    cache.put('token2', 'bob', 'hash2')
+    assert cache.get('token1') == ('alice', 'hash1')
+    cache.put('token3', 'alice', 'hash1')  # Least recently used token2 is evicted
+    assert cache.get('token2') is None
+    assert (cache.hit_count, cache.miss_count) == (1, 1)
+
+    cache.invalidate_login('alice')
+    assert len(cache) == 0
+    cache.put('token1', 'alice', 'hash1')
+    cache.invalidate('token1')
+    assert cache.get('token1') is None
+
+    cache.put('token1', 'alice', 'hash1')
+    now[0] = 9
+    assert cache.get('token1') == ('alice', 'hash1')
+    now[0] = 10
+    assert cache.get('token1') is None
+    assert len(cache) == 0 and cache.login_tokens == {}
+
+
+def test_page_loader(tmp_path):
+    (tmp_path / 'base.html').write_text('<main>{main}</main>')
+    (tmp_path / 'page.html').write_text('{{ text }}')
+    app = Flask(__name__, root_path=str(tmp_path), template_folder='.')
+    app.config['TEMPLATES_AUTO_RELOAD'] = True
+    setup_templates(app, str(tmp_path))
+    assert app.jinja_env.loader.list_pages() == ['page.html']
+    with app.app_context():
+        assert render_template('page.html', text='<b>') == '<main>&lt;b&gt;</main>'
+        os.utime(tmp_path / 'base.html', (0, 0))  # Modified base should be reloaded as well
+        (tmp_path / 'base.html').write_text('<div>{main}</div>')
+        assert render_template('page.html', text='a') == '<div>a</div>'
+
+
+def test_static_asset(tmp_path):
+    (tmp_path / 'ico.png').write_bytes(b'\x89PNG\r\n\x1a\nicon')
+    asset = StaticAsset(str(tmp_path / 'ico.png'))
+    app = Flask(__name__)
+    app.add_url_rule('/ico.png', 'ico', asset.response)
+    client = app.test_client()
+    response = client.get('/ico.png')
+    assert response.status_code == 200 and response.data == asset.data and response.mimetype == 'image/png'
+    assert response.cache_control.max_age > 0 and response.last_modified is not None
+    assert client.get('/ico.png', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    assert client.get('/ico.png', headers={'If-None-Match': '"other"'}).status_code == 200
+
+
+def test_load_secret(tmp_path, monkeypatch):
+    monkeypatch.delenv(SECRET_ENV, raising=False)
+    secret = load_secret(str(tmp_path / 'secret.key'))
+    assert len(secret) == 32
+    assert load_secret(str(tmp_path / 'secret.key')) == secret  # Every process gets the same secret
+    monkeypatch.setenv(SECRET_ENV, 'from environment')
+    assert load_secret(str(tmp_path / 'secret.key')) == 'from environment'
+
+
+def test_dao_reports():
+    if os.path.exists(ProfileDao.DB_PATH):
+        os.remove(ProfileDao.DB_PATH)
+    connection = sqlite3.connect(ProfileDao.DB_PATH)
+    connection.execute('CREATE TABLE "Reports" ("login" STRING PRIMARY KEY, "pdf" BLOB)')  # Reports kept in database
+    connection.close()
+    dao = ProfileDao()
+    with dao.pool.connection() as connection:
+        assert connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'Reports'").fetchone() is None
+    assert dao.start_report('key')
+    assert not dao.start_report('key')  # Already generated by someone else
+    assert dao.start_report('other key')
+    assert dao.lookup_report_failed('key') is False
+    dao.fail_report('key')
+    assert dao.lookup_report_failed('key') is True
+    assert dao.start_report('key')  # Failed report is generated again
+    dao.finish_report('key')
+    assert dao.lookup_report_failed('key') is None
+    assert dao.start_report('key')
+    dao.close()
+    os.remove(ProfileDao.DB_PATH)
+
+
+def test_report_cache(tmp_path):
+    cache = ReportCache(str(tmp_path), max_size=10)
+    key = get_report_key(BASE_PROFILE)
+    assert cache.get(key) is None and key not in cache
+    cache.put(key, b'pdf')
+    assert cache.get(key) == b'pdf' and key in cache
+
+    changed = Profile(**vars(BASE_PROFILE))
+    assert get_report_key(changed) == key
+    changed.win_count += 1
+    assert get_report_key(changed) != key
+    changed.win_count -= 1
+    changed.image = b'another avatar'
+    changed.avatar = get_avatar_hash(changed.image)
+    assert get_report_key(changed) != key
+
+    cache.put('a', b'1234')
+    os.utime(cache.get_path('a'), (0, 0))
+    os.utime(cache.get_path(key), (1, 1))
+    cache.put('b', b'1234')  # Exceeds max size, so least recently used report is removed
+    assert 'a' not in cache and key in cache and 'b' in cache
+    cache.get(key)
+    cache.put('c', b'1234')
+    assert key in cache and 'b' not in cache
+
+
+def test_app(tmp_path):
+    app = create_app(str(tmp_path / 'profiles.db'), '0' * 32, str(tmp_path / 'reports'))
+    client = app.test_client()
+    assert client.post('/register', data={'login': 'u', 'password': 'p'}).status_code == 200
+    assert client.post('/register', data={'login': 'u', 'password': 'p'}).status_code == 400
+    assert client.post('/authorize', data={'login': 'u', 'password': 'q'}).status_code == 400
+    assert b'JWT token' in client.post('/authorize', data={'login': 'u', 'password': 'p'}).data
+    assert b'/edit/u' in client.get('/profile/u').data
+    assert client.get('/all_profiles.json').json == {'logins': ['u'], 'next': None}
+    assert client.get('/ico.png').status_code == 200
+    assert b'not available' in client.get('/report/u.pdf').data
+
+    other_worker = create_app(str(tmp_path / 'profiles.db'), '0' * 32, str(tmp_path / 'reports')).test_client()
+    other_worker.set_cookie('jwt', client.get_cookie('jwt').value)
+    assert b'/edit/u' in other_worker.get('/profile/u').data
+
+
+def test_app_password_change_in_other_worker(tmp_path):
+    workers = [create_app(str(tmp_path / 'profiles.db'), '0' * 32, str(tmp_path / 'reports')).test_client()
+               for _ in range(2)]
+    workers[0].post('/register', data={'login': 'u', 'password': 'p'})
+    workers[0].post('/authorize', data={'login': 'u', 'password': 'p'})
+    old_token = workers[0].get_cookie('jwt').value
+    workers[1].set_cookie('jwt', old_token)
+    assert workers[1].get('/edit/u').status_code == 200  # Session of the old token is cached by the other worker
+
+    assert workers[0].post('/edit/u', data={'password': 'q', 'name': '', 'gender': '', 'mail': ''}).status_code == 200
+    assert workers[1].get('/edit/u').status_code == 403
+    workers[1].post('/authorize', data={'login': 'u', 'password': 'q'})
+    assert workers[1].get('/edit/u').status_code == 200
+
+
+def test_app_reports(tmp_path, monkeypatch):
+    requests = []
+
+    class FakeReportClient:
+        @staticmethod
+        def request(profile):
+            requests.append((profile.login, Future()))
+            return requests[-1][1]
+
+    monkeypatch.setattr(rest.app, 'get_report_client', FakeReportClient)
+    app = create_app(str(tmp_path / 'profiles.db'), '0' * 32, str(tmp_path / 'reports'))
+    client = app.test_client()
+    client.post('/register', data={'login': 'u', 'password': 'p'})
+    assert b'not available' in client.get('/report/u.pdf').data
+
+    assert b'Generating' in client.get('/report/u').data
+    assert b'Generating' in client.get('/report/u').data
+    assert len(requests) == 1  # Pending report is not requested again
+    assert client.get('/report/u.pdf').status_code == 202
+    requests[0][1].set_exception(TimeoutError())
+    assert client.get('/report/u.pdf').status_code == 500
+
+    assert b'Generating' in client.get('/report/u').data
+    assert len(requests) == 2  # Failed report is requested again
+    requests[1][1].set_result(b'pdf')
+    assert b'is ready' in client.get('/report/u').data
+    assert client.get('/report/u.pdf').data == b'pdf'
+
+    dao = app.extensions['rest_mafia'].dao
+    dao.modify_profile('u', name='new name')  # Report of new contents is requested
+    assert b'Generating' in client.get('/report/u').data
+    assert len(requests) == 3
+    # Web worker that requested the report is gone, so its claim expires and report is requested again
+    with dao.pool.connection() as connection:
+        connection.execute('UPDATE ReportRequests SET requested = requested - ?', (ProfileDao.REPORT_TIMEOUT + 1,))
+    assert client.get('/report/u.pdf').status_code == 500
+    assert b'Generating' in client.get('/report/u').data
+    assert len(requests) == 4
+    assert client.get('/report/u.pdf').status_code == 202
+
+
+def make_png(width: int, height: int, pixel: bytes) -> bytes:  # RGBA image of a single color
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    rows = b''.join(b'\0' + pixel * width for _ in range(height))
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+
+def test_worker_render():
+    worker.parsed_images.clear()
+    profile = Profile('a', 'b', image=make_png(4, 4, b'\xff\0\0\x80'))
+    pdf = worker.make_pdf_by_profile(profile)
+    assert pdf.startswith(b'%PDF') and b'/SMask' in pdf
+    assert list(worker.parsed_images) == [profile.avatar]
+    profile.login = 'another'
+    assert b'/SMask' in worker.make_pdf_by_profile(profile)  # Parsed avatar is reused, with its data
+    assert len(worker.parsed_images) == 1
+
+
+def test_worker_rejects_unrenderable():
+    class FakeChannel:
+        rejected = []
+        published = []
+
+        def basic_reject(self, delivery_tag, requeue):
+            self.rejected.append((delivery_tag, requeue))
+
+        def basic_publish(self, **kwargs):
+            self.published.append(kwargs)
+
+    class Method:
+        delivery_tag = 7
+
+    class Props:
+        correlation_id = 'id'
+
+    channel = FakeChannel()
+    gif = b'GIF89a\x01\x00\x01\x00\x00\x00\x00;'
+    for body in [b'malformed', encode_profile(Profile('a', 'b', image=gif))]:
+        worker.on_request(channel, Method, Props, body)
+    assert channel.rejected == [(7, False)] * 2
+    assert channel.published == []
+
+
+def test_profile_envelope():
+    profile = Profile('логин', 'password', 'name', image=make_png(2, 2, b'\0\0\0\0'), mail='a@b.c', total_time=5,
+                      session_count=6, win_count=7, lose_count=8)
+    data = encode_profile(profile)
+    assert data.endswith(profile.image) and b'password' not in data
+    decoded = decode_profile(data)
+    assert get_report_key(decoded) == get_report_key(profile) and decoded.image == profile.image
+
+    default = Profile('a', 'b')
+    assert len(encode_profile(default)) < 100  # Default avatar is not sent
+    assert decode_profile(encode_profile(default)).image == get_default_avatar()
+
+    with pytest.raises(ValueError):
+        decode_profile(data[:40])
+    with pytest.raises(ValueError):
+        decode_profile(data[:-1])  # Avatar does not match its hash
+    with pytest.raises(ValueError):
+        decode_profile(b'\2' + data[1:])
+
+
+def test_local_report_client():
+    with pytest.raises(ValueError):
+        make_report_client('carrier pigeon')
+    client = make_report_client('local')
+    assert isinstance(client, LocalReportClient)
+    try:
+        pdf = client.request(Profile('a', 'b', image=make_png(2, 2, b'\0\0\0\xff'))).result(timeout=30)
+        assert pdf.startswith(b'%PDF')
+    finally:
+        client.close()
+
+
+def hang_render(body: bytes) -> bytes:
+    time.sleep(1)
+    return b''
+
+
+def crash_render(body: bytes) -> bytes:
+    os._exit(1)
+
+
+def test_local_report_client_failures():
+    client = LocalReportClient(1)
+    client.TIMEOUT, client.POLL_INTERVAL = 0.1, 0.05
+    client.render_report = hang_render
+    try:
+        with pytest.raises(TimeoutError):
+            client.request(BASE_PROFILE).result(timeout=30)  # Hung render does not keep report pending
+        assert client.is_alive()
+        client.render_report = crash_render
+        with pytest.raises(BrokenProcessPool):
+            client.request(BASE_PROFILE).result(timeout=30)
+        assert not client.is_alive()  # So that get_report_client makes another one
+    finally:
+        client.close()
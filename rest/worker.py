@@ -1,43 +1,87 @@
 #!/usr/bin/env python
 
+import argparse
+import multiprocessing
+import multiprocessing.connection
 import os
+import tempfile
 import textwrap
-import uuid
+import time
+from collections import OrderedDict
+
 import pika
-from pdf_report import QueueReader
 from fpdf import FPDF
 
-from rest.profile_dao import Profile
+from rest.profile_dao import Profile, get_avatar_hash
+from rest.profile_envelope import QUEUE_NAME, decode_profile
+from rest.static_assets import guess_image_type
+
 
+A4_WIDTH_MM = 210
+PT_TO_MM = 0.35
+FONTSIZE_PT = 26
+FONTSIZE_MM = FONTSIZE_PT * PT_TO_MM
+MARGIN_BOTTOM_MM = 10
+CHARACTER_WIDTH_MM = 7 * PT_TO_MM
+WIDTH_TEXT = int(A4_WIDTH_MM // CHARACTER_WIDTH_MM)
+MAX_PARSED_IMAGES = 256
+PREFETCH_COUNT = 16  # Reports received by each worker in advance, so that it never waits for the broker
+RESTART_DELAY = 1  # Seconds before a worker that exited is started again, so that a lost broker is not hammered
 
-def text_to_pdf(text, image):
-    a4_width_mm = 210
-    pt_to_mm = 0.35
-    fontsize_pt = 26
-    fontsize_mm = fontsize_pt * pt_to_mm
-    margin_bottom_mm = 10
-    character_width_mm = 7 * pt_to_mm
-    width_text = int(a4_width_mm // character_width_mm)
 
+def make_template() -> FPDF:  # Blank configured report, which is cheaper to make again than to deepcopy
     pdf = FPDF(orientation='P', unit='mm', format='A4')
-    pdf.set_auto_page_break(True, margin=margin_bottom_mm)
+    pdf.set_auto_page_break(True, margin=MARGIN_BOTTOM_MM)
+    pdf.set_font(family='Courier', size=FONTSIZE_PT)
+    return pdf
+
+
+# Parsing of a PNG with alpha channel takes most of the time of a report, and most players share few avatars.
+# Parsed info is put into images of every report, whose layout is that of fpdf 1.7.2, pinned in requirements
+parsed_images: OrderedDict[str, dict] = OrderedDict()  # Avatar hash -> image info of FPDF
+
+
+def parse_image(image: bytes) -> dict:
+    # fpdf only reads images from files, so image is written to a temporary one while it is placed once
+    image_type = 'jpg' if guess_image_type(image) == 'image/jpeg' else 'png'
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, f'avatar.{image_type}')
+        with open(path, 'wb') as file:
+            file.write(image)
+        parser = FPDF()
+        parser.add_page()
+        parser.image(path, type=image_type)
+        return parser.images[path]
+
+
+def get_image_info(avatar: str, image: bytes) -> dict:
+    if avatar in parsed_images:
+        parsed_images.move_to_end(avatar)
+    else:
+        parsed_images[avatar] = parse_image(image)
+        if len(parsed_images) > MAX_PARSED_IMAGES:
+            parsed_images.popitem(last=False)
+    # FPDF deletes image data once it is written, so every report gets its own copy of info
+    return dict(parsed_images[avatar])
+
+
+def text_to_pdf(text, image, avatar=None):
+    avatar = get_avatar_hash(image) if avatar is None else avatar
+    pdf = make_template()
     pdf.add_page()
-
-    name = uuid.uuid4().__str__()
-    open(f'{name}.png', 'wb+').write(image)
-    pdf.image(f'{name}.png', w=100, h=100)
-    os.remove(f'{name}.png')
-    pdf.set_font(family='Courier', size=fontsize_pt)
+    pdf.images[avatar] = get_image_info(avatar, image)
+    pdf.images[avatar]['i'] = len(pdf.images)
+    pdf.image(avatar, w=100, h=100)
     splitted = text.split('\n')
 
     for line in splitted:
-        lines = textwrap.wrap(line, width_text)
+        lines = textwrap.wrap(line, WIDTH_TEXT)
 
         if len(lines) == 0:
             pdf.ln()
 
         for wrap in lines:
-            pdf.cell(0, fontsize_mm, wrap, ln=1)
+            pdf.cell(0, FONTSIZE_MM, wrap, ln=1)
 
     return pdf.output('', 'S').encode('latin-1')
 
@@ -55,19 +99,22 @@ Sessions played: {profile.session_count}
 Games won: {profile.win_count}
 Games lost: {profile.lose_count}
 '''
-    return text_to_pdf(text, profile.image)
+    return text_to_pdf(text, profile.image, profile.avatar)
 
 
-connection = pika.BlockingConnection(
-    pika.ConnectionParameters(host='localhost'))
-
-channel = connection.channel()
-channel.queue_declare(queue=QueueReader.QUEUE_NAME, durable=True)
+def render_report(body: bytes) -> bytes:  # Request of website, however it was delivered
+    return make_pdf_by_profile(decode_profile(body))
 
 
 def on_request(ch, method, props, body):
-    profile = Profile(**eval(body))
-    pdf = make_pdf_by_profile(profile)
+    try:
+        pdf = render_report(body)
+    except Exception as err:
+        # Request that is malformed, or has an avatar that fpdf cannot read, e.g. a GIF, fails the same way again.
+        # So it is dropped rather than redelivered to kill other workers, and its client times out
+        print(f'ERROR: Report request {props.correlation_id} could not be rendered: {err!r}')
+        ch.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
+        return
     ch.basic_publish(exchange='',
                      routing_key=props.reply_to,
                      properties=props,
@@ -75,8 +122,39 @@ def on_request(ch, method, props, body):
     ch.basic_ack(delivery_tag=method.delivery_tag)
 
 
-channel.basic_qos(prefetch_count=1)
-channel.basic_consume(queue=QueueReader.QUEUE_NAME, on_message_callback=on_request)
+def consume(host: str, prefetch_count: int):
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+    channel = connection.channel()
+    channel.queue_declare(queue=QUEUE_NAME, durable=True)
+    channel.basic_qos(prefetch_count=prefetch_count)
+    channel.basic_consume(queue=QUEUE_NAME, on_message_callback=on_request)
+
+    print(f" [x] Worker {os.getpid()} awaiting requests")
+    channel.start_consuming()
+
+
+def start_worker(host: str, prefetch_count: int) -> multiprocessing.Process:
+    worker = multiprocessing.Process(target=consume, args=(host, prefetch_count))
+    worker.start()
+    return worker
+
+
+def run_workers(worker_count: int, host: str, prefetch_count: int):
+    # Rendering is CPU-bound, so reports are rendered by separate processes rather than threads
+    workers = [start_worker(host, prefetch_count) for _ in range(worker_count)]
+    while True:
+        multiprocessing.connection.wait([worker.sentinel for worker in workers])
+        time.sleep(RESTART_DELAY)
+        for i, worker in enumerate(workers):
+            if not worker.is_alive():
+                print(f'ERROR: Worker {worker.pid} exited with code {worker.exitcode}, starting another one')
+                workers[i] = start_worker(host, prefetch_count)
+
 
-print(" [x] Awaiting requests")
-channel.start_consuming()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates PDF reports requested by website')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes consuming reports')
+    parser.add_argument('--prefetch', type=int, default=PREFETCH_COUNT, help='Reports prefetched by each process')
+    parser.add_argument('--host', default='localhost', help='Host of RabbitMQ')
+    args = parser.parse_args()
+    run_workers(args.workers, args.host, args.prefetch)
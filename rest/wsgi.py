@@ -0,0 +1,9 @@
+from rest.app import create_app
+
+
+# Entry point of web server, which is run apart from voice server, e.g. `gunicorn -w 4 -b 0.0.0.0:80 rest.wsgi:app`
+app = create_app()
+
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=80)
@@ -0,0 +1,85 @@
+import timeit
+
+import numpy as np
+
+from voice_chat.codec import CodecType, CODECS, SAMPLE_DTYPE, SAMPLE_RATE
+from voice_chat.converter import StrConverter, StrListConverter
+from voice_chat.protocol import parse_frame, VOICE_DATA_SIZE, VoiceMessage, ConnectedMessage, DisconnectedMessage, \
+    ListRequestMessage, ListResponseMessage, RoomChangeMessage, ShutdownMessage, GameStartingMessage, \
+    ConnectedResponseMessage, UdpRequestMessage, UdpOfferMessage, CodecRequestMessage, CodecResponseMessage, Capability
+
+
+NAME_COUNT = 1000
+REPEAT = 5
+NUMBER = 200
+MESSAGE_NUMBER = 20000
+
+MESSAGES = [
+    VoiceMessage('speaker', b'\x01' * VOICE_DATA_SIZE),
+    VoiceMessage('speaker', b'\x07' * 259, CodecType.ADPCM),
+    ConnectedMessage('Вася Пупкин'),
+    DisconnectedMessage('Роберт'),
+    ListRequestMessage(),
+    ListResponseMessage([f'player_{i}' for i in range(20)]),
+    RoomChangeMessage(42),
+    ShutdownMessage(),
+    GameStartingMessage(12345),
+    ConnectedResponseMessage(error='Incorrect JWT token'),
+    UdpRequestMessage(),
+    UdpOfferMessage(12345, 2 ** 32 - 1),
+    CodecRequestMessage([CodecType.ADPCM, CodecType.MU_LAW, CodecType.PCM], Capability.VAD),
+    CodecResponseMessage(CodecType.MU_LAW),
+]
+
+
+def encode_with_eval(names: list[str]) -> bytes:  # Encoding of name lists before StrListConverter
+    return StrConverter.encode(str(names))
+
+
+def decode_with_eval(raw: bytes) -> list[str]:
+    return eval(StrConverter.decode(raw))
+
+
+def measure(func, *args, number: int = NUMBER) -> float:  # Best time of a single call in microseconds
+    return min(timeit.repeat(lambda: func(*args), repeat=REPEAT, number=number)) / number * 1e6
+
+
+def bench_name_list(name_count: int = NAME_COUNT):
+    names = [f'player_{i}_игрок' for i in range(name_count)]
+    eval_raw = encode_with_eval(names)
+    binary_raw = StrListConverter.encode(names)
+    assert decode_with_eval(eval_raw) == StrListConverter.decode(binary_raw) == names
+
+    print(f'List of {name_count} names: eval {len(eval_raw)} bytes, binary {len(binary_raw)} bytes')
+    for name, encode, decode, raw in [('eval', encode_with_eval, decode_with_eval, eval_raw),
+                                      ('binary', StrListConverter.encode, StrListConverter.decode, binary_raw)]:
+        print(f'{name:>8}: encode {measure(encode, names):8.1f}us, decode {measure(decode, raw):8.1f}us')
+
+
+def bench_messages():
+    print(f'{"Message":>26} {"encode":>10} {"pack_into":>10} {"parse":>10}')
+    for message in MESSAGES:
+        raw = memoryview(message.encode())
+        buf = bytearray(len(raw))
+        assert vars(parse_frame(raw)[0]) == vars(message)
+        encode_time = measure(message.encode, number=MESSAGE_NUMBER)
+        pack_time = measure(message.pack_into, buf, number=MESSAGE_NUMBER)
+        parse_time = measure(parse_frame, raw, number=MESSAGE_NUMBER)
+        print(f'{type(message).__name__:>26} {encode_time:8.2f}us {pack_time:8.2f}us {parse_time:8.2f}us')
+
+
+def bench_codecs():
+    t = np.arange(VOICE_DATA_SIZE // 2) / SAMPLE_RATE
+    pcm = (8000 * np.sin(2 * np.pi * 440 * t) + 2000 * np.sin(2 * np.pi * 1234 * t)).astype(SAMPLE_DTYPE).tobytes()
+    print(f'{"Codec":>14} {"ratio":>6} {"encode":>10} {"decode":>10}')
+    for codec in CODECS.values():
+        data = codec.encode(pcm)
+        encode_time = measure(codec.encode, pcm)
+        decode_time = measure(codec.decode, data)
+        print(f'{type(codec).__name__:>14} {len(pcm) / len(data):6.2f} {encode_time:8.1f}us {decode_time:8.1f}us')
+
+
+if __name__ == '__main__':
+    bench_name_list()
+    bench_messages()
+    bench_codecs()
@@ -1,28 +1,128 @@
 import random
 import socket
+import threading
 import time
 
+from voice_chat.protocol import encode_voice_header
+from voice_chat.send_queue import SendQueue, OverflowPolicy
+from voice_chat.codec import CodecType
+from voice_chat.vad import VoiceActivityDetector
+
+
+def sendmsg_all(sock: socket.socket, buffers):
+    views = [memoryview(buf).cast('B') for buf in buffers]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if views:
+            views[0] = views[0][sent:]
+
 
 class Profile:
+    CLOSE_TIMEOUT = 1
+
     name: str
     sock: socket.socket
     addr: str
     room: int
+    voice_header: bytes
+    voice_seq: int  # Of voice frames relayed from this client
+    codec: int  # Negotiated for voice sent by this client
+    capabilities: int  # Capability flags, which client negotiated along with its codec
+    vad: VoiceActivityDetector  # Used unless client suppresses silence itself
+    send_queue: SendQueue or None
+    writer: threading.Thread or None
+    closing: bool  # Set once client is being disconnected for overflowing its queue
+
+    udp_addr: tuple or None
+    udp_seq: int  # Of the last voice datagram received from this client
+    send_datagram: callable  # (datagram, addr)
 
     def __init__(self, name, sock, addr):
         self.name = name
         self.sock = sock
         self.addr = addr
         self.room = 0
+        self.voice_header = encode_voice_header(name)
+        self.voice_seq = 0
+        self.codec = CodecType.PCM
+        self.capabilities = 0
+        self.vad = VoiceActivityDetector()
+        self.send_queue = None
+        self.writer = None
+        self.closing = False
+        self.udp_addr = None
+        self.udp_seq = 0
+        self.send_datagram = None
+
+    def start_sending(self, send_queue: SendQueue):
+        self.send_queue = send_queue
+        self.writer = threading.Thread(target=self.write_queued, daemon=True)
+        self.writer.start()
+
+    def send(self, *buffers, droppable=False):
+        if self.send_queue is None:
+            self.write(buffers)
+        elif not self.send_queue.put(buffers, droppable) and not self.closing:
+            print(f'ERROR: {self.name} cannot keep up with sent data. Disconnecting...')
+            self.closing = True
+            self.sock.shutdown(socket.SHUT_RDWR)  # Wakes up the reading thread, which disconnects the client
+
+    def send_voice(self, voice_header: bytes, voice_data: memoryview, datagram: bytes):
+        if self.udp_addr is not None:
+            self.send_datagram(datagram, self.udp_addr)
+        else:
+            self.send(voice_header, voice_data, droppable=True)
+
+    def write(self, buffers: tuple):
+        if len(buffers) == 1:
+            self.sock.sendall(buffers[0])
+        else:
+            sendmsg_all(self.sock, buffers)
+
+    def write_queued(self):
+        try:
+            buffers = self.send_queue.get()
+            while buffers is not None:
+                self.write(buffers)
+                buffers = self.send_queue.get()
+        except socket.error as err:
+            print(f'ERROR Could not send data to {self.name}:', err)
+        finally:
+            self.sock.close()
+
+    def close(self):
+        if self.send_queue is None:
+            self.sock.close()
+            return
+        self.send_queue.close()
+        if threading.current_thread() != self.writer:
+            self.writer.join(self.CLOSE_TIMEOUT)
 
 
 class ClientManager:
     clients: dict[int, Profile]
     name_id: dict[str, int]
+    udp_token_id: dict[int, int]
 
-    def __init__(self):
+    send_policy: str
+    max_voice_frames: int
+    max_overflows: int
+    dropped_count: int  # Of already disconnected clients
+    overflow_count: int
+
+    def __init__(self, send_policy: str = OverflowPolicy.DROP_OLDEST,
+                 max_voice_frames: int = SendQueue.MAX_VOICE_FRAMES, max_overflows: int = SendQueue.MAX_OVERFLOWS):
         self.clients = {}
         self.name_id = {}
+        self.udp_token_id = {}
+        self.send_policy = send_policy
+        self.max_voice_frames = max_voice_frames
+        self.max_overflows = max_overflows
+        self.dropped_count = 0
+        self.overflow_count = 0
         random.seed(time.time_ns())
 
     def __getitem__(self, ind):
@@ -36,10 +136,27 @@ class ClientManager:
         client_id = self.gen_client_id()
         while client_id in self.clients:
             client_id = self.gen_client_id()
+        profile.start_sending(SendQueue(self.send_policy, self.max_voice_frames, self.max_overflows))
         self.clients[client_id] = profile
         self.name_id[profile.name] = client_id
         return client_id
 
+    def gen_udp_token(self, client_id: int) -> int:
+        token = self.gen_client_id()
+        while token in self.udp_token_id:
+            token = self.gen_client_id()
+        self.udp_token_id[token] = client_id
+        return token
+
     def disconnect_client(self, client_id: int):
-        self.clients[client_id].sock.close()
+        profile = self.clients[client_id]
+        for token in [token for token, token_client_id in self.udp_token_id.items() if token_client_id == client_id]:
+            del self.udp_token_id[token]
+        profile.close()
+        self.dropped_count += profile.send_queue.dropped_count
+        self.overflow_count += profile.send_queue.overflow_count
         del self.clients[client_id]
+
+    def get_send_stats(self) -> dict[int, tuple[int, int]]:  # client_id -> (dropped_count, overflow_count)
+        return {client_id: (profile.send_queue.dropped_count, profile.send_queue.overflow_count)
+                for client_id, profile in list(self.clients.items())}
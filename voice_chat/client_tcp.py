@@ -1,6 +1,8 @@
 import socket
+import sys
 import threading
 import os
+import time
 import pyaudio
 import keyboard
 
@@ -8,11 +10,20 @@ from protocol import (
     MessageType,
     VoiceMessage,
     ConnectedMessage,
+    UdpRequestMessage,
+    CodecRequestMessage,
+    Capability,
     get_message,
+    FrameReader,
+    encode_voice_datagram,
+    decode_relayed_voice_datagram,
     VOICE_DATA_SIZE,
 )
 
 from client_console import VoiceMode, ClientConsole
+from jitter_buffer import JitterBuffer, evict_idle
+from codec import Codec, CodecType, get_codec, PcmCodec, PREFERRED_CODECS, SAMPLE_RATE
+from vad import VoiceActivityDetector, VoiceActivity
 from mafia.client import MafiaClient
 from mafia.common import WAIT_TIME_TO_START
 
@@ -20,16 +31,37 @@ from mafia.common import WAIT_TIME_TO_START
 class Client:
     RETRY_LIMIT = 3
     NAME_LEN_LIMIT = 200
+    RATE = SAMPLE_RATE
+    FRAME_DURATION = VOICE_DATA_SIZE / 2 / RATE
+    UDP_KEEPALIVE_INTERVAL = 2
+    SENDER_IDLE_TIMEOUT = 10  # Seconds without voice, after which jitter buffer of a sender is dropped
+    MAX_DATAGRAM_SIZE = 64 * 1024
 
     sock: socket.socket
     console: ClientConsole
     cur_speaker: str
     mafia_client: MafiaClient or None
+    codec: Codec  # Used to encode voice sent to server
+    vad: VoiceActivityDetector
+
+    use_udp: bool
+    udp_sock: socket.socket or None
+    udp_token: int
+    udp_seq: int
+    jitter_buffers: dict[str, JitterBuffer]
+    jitter_lock: threading.Lock
 
     def __init__(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.cur_speaker = ''
         self.mafia_client = None
+        self.codec = PcmCodec()
+        self.vad = VoiceActivityDetector()
+        self.use_udp = '--udp' in sys.argv
+        self.udp_sock = None
+        self.udp_seq = 0
+        self.jitter_buffers = {}
+        self.jitter_lock = threading.Lock()
 
         while 1:
             try:
@@ -56,7 +88,7 @@ class Client:
 
         audio_format = pyaudio.paInt16
         channels = 1
-        rate = 20000
+        rate = self.RATE
 
         # initialise microphone recording
         self.audio = pyaudio.PyAudio()
@@ -66,6 +98,10 @@ class Client:
                                                 input=True, frames_per_buffer=VOICE_DATA_SIZE)
 
         print('Connected to server')
+        # Silence is never sent, since voice is either pushed to talk or sent on detected voice activity
+        self.sock.sendall(CodecRequestMessage(PREFERRED_CODECS, Capability.VAD).encode())
+        if self.use_udp:
+            self.sock.sendall(UdpRequestMessage().encode())
 
         # start threads
         threading.Thread(target=self.send_data_to_server).start()
@@ -74,16 +110,17 @@ class Client:
         self.console.start()
 
     def receive_server_data(self):
+        reader = FrameReader(self.sock)
         retry_count = 0
         while True:
             try:
-                msg = get_message(self.sock)
+                msg = reader.get_message()
                 if msg.message_type == MessageType.VOICE:
                     assert msg.name != ''
-                    if msg.name != self.cur_speaker:
-                        self.cur_speaker = msg.name
-                        print(f'{self.cur_speaker} is talking...')
-                    self.playing_stream.write(msg.data)
+                    try:
+                        self.play(msg.name, get_codec(msg.codec).decode(msg.data))
+                    except ValueError as err:
+                        print('Discarded voice frame:', err)
 
                 elif msg.message_type == MessageType.CONNECTED:
                     assert msg.name != ''
@@ -108,6 +145,12 @@ class Client:
                     self.console.bind_mafia_client(self.mafia_client)
                     self.mafia_client.start(self.target_ip, self.name)
 
+                elif msg.message_type == MessageType.CODEC_RESPONSE:
+                    self.codec = get_codec(msg.codec)
+
+                elif msg.message_type == MessageType.UDP_OFFER:
+                    self.start_udp(msg.port, msg.token)
+
                 retry_count = 0
             except socket.error as err:
                 print('Could not receive server data:', err)
@@ -120,13 +163,76 @@ class Client:
                 else:
                     print(f'Retrying {retry_count}/3')
 
+    def play(self, name: str, data: bytes):
+        if name != self.cur_speaker:
+            self.cur_speaker = name
+            print(f'{self.cur_speaker} is talking...')
+        self.playing_stream.write(data)
+
+    def start_udp(self, port: int, token: int):
+        udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_sock.connect((self.target_ip, port))
+        self.udp_token = token
+        self.udp_sock = udp_sock
+        print('Voice is sent over UDP')
+        threading.Thread(target=self.send_udp_keepalives).start()
+        threading.Thread(target=self.receive_udp_data).start()
+        threading.Thread(target=self.play_udp_data).start()
+
+    def send_udp_keepalives(self):
+        # Sent on a timer rather than when nothing is received, so that NAT mapping is kept while others talk as well
+        while True:
+            try:
+                self.udp_sock.send(encode_voice_datagram(self.udp_token, self.udp_seq))
+            except socket.error as err:
+                print('Could not send keepalive datagram:', err)
+            time.sleep(self.UDP_KEEPALIVE_INTERVAL)
+
+    def receive_udp_data(self):
+        while True:
+            try:
+                datagram = self.udp_sock.recv(self.MAX_DATAGRAM_SIZE)
+                seq, msg = decode_relayed_voice_datagram(memoryview(datagram))
+                with self.jitter_lock:
+                    if msg.name not in self.jitter_buffers:
+                        self.jitter_buffers[msg.name] = JitterBuffer()
+                    self.jitter_buffers[msg.name].push(seq, get_codec(msg.codec).decode(msg.data))
+            except (socket.error, ValueError) as err:
+                print('Could not receive voice datagram:', err)
+
+    def play_udp_data(self):
+        while True:
+            with self.jitter_lock:
+                evict_idle(self.jitter_buffers, self.SENDER_IDLE_TIMEOUT)
+                frames = [(name, jitter_buffer.pop()) for name, jitter_buffer in self.jitter_buffers.items()]
+            frames = [(name, data) for name, data in frames if data is not None]
+            if not frames:
+                time.sleep(self.FRAME_DURATION)
+            for name, data in frames:
+                self.play(name, data)
+
+    def send_voice(self, codec: Codec, pcm: bytes):
+        data = codec.encode(pcm)
+        if self.udp_sock is not None:
+            self.udp_seq += 1
+            self.udp_sock.send(encode_voice_datagram(self.udp_token, self.udp_seq, codec.codec_type, data))
+        else:
+            self.sock.sendall(VoiceMessage(data=data, codec=codec.codec_type).encode())
+
     def send_data_to_server(self):
         retry_count = 0
         while True:
             try:
                 data = self.recording_stream.read(VOICE_DATA_SIZE // 2)
-                if self.console.mode != VoiceMode.PUSH_TO_TALK or keyboard.is_pressed('v'):
-                    self.sock.sendall(VoiceMessage(data=data).encode())
+                if self.console.mode == VoiceMode.PUSH_TO_TALK:
+                    if keyboard.is_pressed('v'):
+                        self.send_voice(self.codec, data)
+                else:
+                    activity = self.vad.process(data)
+                    if activity == VoiceActivity.SPEECH:
+                        self.send_voice(self.codec, data)
+                    elif activity == VoiceActivity.SILENCE_START:
+                        self.send_voice(get_codec(CodecType.COMFORT_NOISE), data)
                 retry_count = 0
             except socket.error as err:
                 print('ERROR: Could not send data to server because of socket:', err)
@@ -0,0 +1,214 @@
+from bisect import bisect_right
+
+import numpy as np
+
+from voice_chat.converter import UIntConverter
+
+
+SAMPLE_DTYPE = np.dtype('<i2')  # 16-bit PCM, as recorded by pyaudio.paInt16
+SAMPLE_RATE = 20000
+
+
+class CodecType:
+    PCM: int = 0
+    MU_LAW: int = 1
+    ADPCM: int = 2
+    COMFORT_NOISE: int = 3  # Not negotiated, since it only replaces silent frames
+
+
+class Codec:
+    codec_type: int
+
+    def encode(self, pcm: bytes) -> bytes:
+        raise NotImplementedError('encode is not defined!')
+
+    def decode(self, data: bytes) -> bytes:
+        raise NotImplementedError('decode is not defined!')
+
+    def is_valid(self, data: bytes) -> bool:  # Whether data received from a client can be decoded
+        return True
+
+    def check(self, data: bytes):
+        if not self.is_valid(data):
+            raise ValueError(f'Found malformed voice data of {len(data)} bytes for codec {self.codec_type}')
+
+
+class PcmCodec(Codec):
+    codec_type: int = CodecType.PCM
+
+    def encode(self, pcm: bytes) -> bytes:
+        return pcm
+
+    def decode(self, data: bytes) -> bytes:
+        self.check(data)
+        return data
+
+    def is_valid(self, data: bytes) -> bool:
+        return len(data) % SAMPLE_DTYPE.itemsize == 0
+
+
+class MuLawCodec(Codec):  # G.711, 2x compression
+    codec_type: int = CodecType.MU_LAW
+    BIAS = 0x84
+    CLIP = 32635
+
+    encode_table: np.ndarray  # uint16 view of a sample -> encoded byte
+    decode_table: np.ndarray  # encoded byte -> sample
+
+    def __init__(self):
+        samples = np.arange(2 ** 16, dtype=np.uint16).view(np.int16).astype(np.int32)
+        magnitude = np.minimum(np.abs(samples), self.CLIP) + self.BIAS
+        exponent = np.floor(np.log2(magnitude)).astype(np.int32) - 7
+        mantissa = (magnitude >> (exponent + 3)) & 0x0F
+        sign = (samples < 0).astype(np.int32) << 7
+        self.encode_table = (~(sign | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8)
+
+        encoded = ~np.arange(256, dtype=np.int32)
+        magnitude = ((((encoded & 0x0F) << 3) + self.BIAS) << ((encoded >> 4) & 0x07)) - self.BIAS
+        self.decode_table = np.where(encoded & 0x80, -magnitude, magnitude).astype(SAMPLE_DTYPE)
+
+    def encode(self, pcm: bytes) -> bytes:
+        return self.encode_table[np.frombuffer(pcm, dtype='<u2')].tobytes()
+
+    def decode(self, data: bytes) -> bytes:
+        return self.decode_table[np.frombuffer(data, dtype=np.uint8)].tobytes()
+
+
+class AdpcmCodec(Codec):  # IMA ADPCM, 4x compression of samples, 3.95x of a frame with its 3-byte header
+    codec_type: int = CodecType.ADPCM
+    PREDICTOR_SIZE = 2
+    INDEX_SIZE = 1
+
+    INDEX_TABLE = [-1, -1, -1, -1, 2, 4, 6, 8] * 2
+    STEP_TABLE = [
+        7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45, 50, 55, 60, 66, 73, 80, 88, 97,
+        107, 118, 130, 143, 157, 173, 190, 209, 230, 253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796,
+        876, 963, 1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327, 3660, 4026, 4428,
+        4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385,
+        24623, 27086, 29794, 32767,
+    ]
+
+    # IMA ADPCM is sequential, since every sample is predicted from the previous one, so it cannot be vectorised
+    # like mu-law. Instead every (step index, nibble) pair is looked up in tables built once, as state = index * 16
+    diff_table: list[int]  # state + nibble -> signed change of predictor
+    next_state_table: list[int]  # state + nibble -> next state
+    thresholds_table: list[list[int]]  # step index -> least change of signal encoded by nibble magnitude 1..7
+
+    def __init__(self):
+        self.diff_table, self.next_state_table, self.thresholds_table = [], [], []
+        for index, step in enumerate(self.STEP_TABLE):
+            for nibble in range(16):
+                diff = (step >> 3) + self.get_magnitude_diff(step, nibble & 7)
+                self.diff_table.append(-diff if nibble & 8 else diff)
+                self.next_state_table.append(min(max(index + self.INDEX_TABLE[nibble], 0), 88) * 16)
+            self.thresholds_table.append([self.get_magnitude_diff(step, magnitude) for magnitude in range(1, 8)])
+
+    @staticmethod
+    def get_magnitude_diff(step: int, magnitude: int) -> int:
+        return (step if magnitude & 4 else 0) + (step >> 1 if magnitude & 2 else 0) \
+            + (step >> 2 if magnitude & 1 else 0)
+
+    # Each frame starts with predictor and step index, so it can be decoded even if previous frames were lost
+    def encode(self, pcm: bytes) -> bytes:
+        samples = np.frombuffer(pcm, dtype=SAMPLE_DTYPE).tolist()
+        if len(samples) % 2 == 1:
+            samples.append(samples[-1])
+        predictor, index = samples[0], self.initial_index(samples)
+        header = UIntConverter.encode(predictor & 0xFFFF, self.PREDICTOR_SIZE) \
+            + UIntConverter.encode(index, self.INDEX_SIZE)
+
+        diff_table, next_state_table, thresholds_table = self.diff_table, self.next_state_table, self.thresholds_table
+        state = index * 16
+        nibbles = bytearray(len(samples))
+        for i, sample in enumerate(samples):
+            # Thresholds grow with magnitude, so magnitude is the count of thresholds that the change reaches
+            diff = sample - predictor
+            if diff < 0:
+                nibble = 8 | bisect_right(thresholds_table[state >> 4], -diff)
+            else:
+                nibble = bisect_right(thresholds_table[state >> 4], diff)
+            state += nibble
+            predictor += diff_table[state]
+            if predictor > 32767:
+                predictor = 32767
+            elif predictor < -32768:
+                predictor = -32768
+            state = next_state_table[state]
+            nibbles[i] = nibble
+        nibbles = np.frombuffer(nibbles, dtype=np.uint8)
+        return header + (nibbles[::2] | nibbles[1::2] << 4).tobytes()
+
+    def decode(self, data: bytes) -> bytes:
+        self.check(data)
+        header_size = self.PREDICTOR_SIZE + self.INDEX_SIZE
+        predictor = UIntConverter.decode(data[:self.PREDICTOR_SIZE])
+        predictor = predictor - 2 ** 16 if predictor >= 2 ** 15 else predictor
+        state = min(UIntConverter.decode(data[self.PREDICTOR_SIZE:header_size]), 88) * 16
+
+        packed = np.frombuffer(data, dtype=np.uint8, offset=header_size)
+        nibbles = np.empty(len(packed) * 2, dtype=np.uint8)
+        nibbles[::2], nibbles[1::2] = packed & 0x0F, packed >> 4
+
+        diff_table, next_state_table = self.diff_table, self.next_state_table
+        samples = []
+        for nibble in nibbles.tolist():
+            state += nibble
+            predictor += diff_table[state]
+            if predictor > 32767:
+                predictor = 32767
+            elif predictor < -32768:
+                predictor = -32768
+            samples.append(predictor)
+            state = next_state_table[state]
+        return np.array(samples, dtype=SAMPLE_DTYPE).tobytes()
+
+    def is_valid(self, data: bytes) -> bool:
+        return len(data) >= self.PREDICTOR_SIZE + self.INDEX_SIZE
+
+    def initial_index(self, samples: list[int]) -> int:  # Step that fits the first change of the signal
+        first_diff = abs(samples[1] - samples[0]) if len(samples) > 1 else 0
+        index = 0
+        while index < 88 and self.STEP_TABLE[index] < first_diff:
+            index += 1
+        return index
+
+
+class ComfortNoiseCodec(Codec):  # Keeps only noise level and length of a silent frame
+    codec_type: int = CodecType.COMFORT_NOISE
+    LEVEL_SIZE = 1
+    LEVEL_STEP = 8
+    SAMPLE_COUNT_SIZE = 2
+
+    def encode(self, pcm: bytes) -> bytes:
+        samples = np.frombuffer(pcm, dtype=SAMPLE_DTYPE).astype(np.float32)
+        rms = float(np.sqrt(np.mean(samples * samples))) if len(samples) else 0
+        return UIntConverter.encode(min(round(rms / self.LEVEL_STEP), 255), self.LEVEL_SIZE) \
+            + UIntConverter.encode(len(samples), self.SAMPLE_COUNT_SIZE)
+
+    def decode(self, data: bytes) -> bytes:
+        self.check(data)
+        rms = UIntConverter.decode(data[:self.LEVEL_SIZE]) * self.LEVEL_STEP
+        sample_count = UIntConverter.decode(data[self.LEVEL_SIZE:self.LEVEL_SIZE + self.SAMPLE_COUNT_SIZE])
+        noise = np.random.default_rng().normal(0, rms, sample_count)
+        return np.clip(noise, -32768, 32767).astype(SAMPLE_DTYPE).tobytes()
+
+    def is_valid(self, data: bytes) -> bool:
+        return len(data) == self.LEVEL_SIZE + self.SAMPLE_COUNT_SIZE
+
+
+CODECS: dict[int, Codec] = {codec.codec_type: codec
+                            for codec in [PcmCodec(), MuLawCodec(), AdpcmCodec(), ComfortNoiseCodec()]}
+PREFERRED_CODECS = [CodecType.ADPCM, CodecType.MU_LAW, CodecType.PCM]
+
+
+def get_codec(codec_type: int) -> Codec:
+    if codec_type not in CODECS:
+        raise ValueError(f'Found unknown codec: {codec_type}')
+    return CODECS[codec_type]
+
+
+def choose_codec(supported: list[int], preferred: list[int] = PREFERRED_CODECS) -> int:
+    for codec_type in preferred:
+        if codec_type in supported:
+            return codec_type
+    return CodecType.PCM
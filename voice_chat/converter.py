@@ -1,3 +1,8 @@
+import functools
+import struct
+from itertools import accumulate
+
+
 class UIntConverter:
     @staticmethod
     def encode(uint: int, length: int) -> bytes:
@@ -8,6 +13,70 @@ class UIntConverter:
         return int.from_bytes(raw, byteorder='big', signed=False)
 
 
+class VarIntConverter:  # LEB128, so that small numbers take a single byte
+    @staticmethod
+    def encode(uint: int) -> bytes:
+        if uint < 0:
+            raise ValueError(f'Cannot encode negative number as varint: {uint}')
+        enc = bytearray()
+        while uint >= 0x80:
+            enc.append(uint & 0x7F | 0x80)
+            uint >>= 7
+        enc.append(uint)
+        return bytes(enc)
+
+    @staticmethod
+    def decode(raw: bytes, pos: int = 0) -> (int, int):  # Returns number and position right after it
+        uint = 0
+        shift = 0
+        while True:
+            if pos >= len(raw):
+                raise ValueError('Found truncated varint')
+            byte = raw[pos]
+            pos += 1
+            uint |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return uint, pos
+            shift += 7
+
+
+class SIntConverter:  # Zigzag varint, so that small negative numbers are short as well
+    @staticmethod
+    def encode(sint: int) -> bytes:
+        return VarIntConverter.encode(sint * 2 if sint >= 0 else -sint * 2 - 1)
+
+    @staticmethod
+    def decode(raw: bytes, pos: int = 0) -> (int, int):
+        uint, pos = VarIntConverter.decode(raw, pos)
+        return uint >> 1 if uint % 2 == 0 else -(uint >> 1) - 1, pos
+
+
+class StructConverter:  # Fixed layout of several numbers, packed and unpacked in a single call
+    layout: struct.Struct
+
+    def __init__(self, fmt: str):
+        try:
+            self.layout = struct.Struct(fmt)
+        except struct.error as err:
+            raise ValueError(f'Could not build struct: {err}')
+
+    @property
+    def size(self) -> int:
+        return self.layout.size
+
+    def encode(self, *values) -> bytes:
+        try:
+            return self.layout.pack(*values)
+        except struct.error as err:
+            raise ValueError(f'Could not pack struct: {err}')
+
+    def decode(self, raw: bytes, pos: int = 0) -> tuple:
+        try:
+            return self.layout.unpack_from(raw, pos)
+        except struct.error as err:
+            raise ValueError(f'Could not unpack struct: {err}')
+
+
 class StrConverter:
     @staticmethod
     def encode(string: str) -> bytes:
@@ -18,11 +87,73 @@ class StrConverter:
         return raw.decode('UTF-8')
 
 
-class ArrayConverter:
+class StrListConverter:
+    # Count, then byte lengths of all strings as a single struct, then all strings one after another
+    LENGTH_FORMAT = 'H'
+    LENGTH_SIZE = struct.calcsize(LENGTH_FORMAT)
+
+    @staticmethod
+    def encode(strings: list[str]) -> bytes:
+        encoded = [StrConverter.encode(string) for string in strings]
+        lengths = [len(enc) for enc in encoded]
+        count = VarIntConverter.encode(len(encoded))
+        return b''.join([count, StrListConverter.lengths_converter(len(encoded)).encode(*lengths), *encoded])
+
+    @staticmethod
+    def decode(raw: bytes) -> list[str]:
+        count, pos = VarIntConverter.decode(raw)
+        if count * StrListConverter.LENGTH_SIZE > len(raw) - pos:  # Checked before a layout is built for the count
+            raise ValueError(f'Found string list of {count} strings with only {len(raw) - pos} bytes left')
+        lengths_converter = StrListConverter.lengths_converter(count)
+        lengths = lengths_converter.decode(raw, pos)
+        pos += lengths_converter.size
+        if pos + sum(lengths) != len(raw):
+            raise ValueError('Found string list with wrong length')
+        raw = bytes(raw)
+        offsets = list(accumulate(lengths, initial=pos))
+        return [raw[start:end].decode('UTF-8') for start, end in zip(offsets, offsets[1:])]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def lengths_converter(count: int) -> StructConverter:
+        return StructConverter(f'>{count}{StrListConverter.LENGTH_FORMAT}')
+
+
+class ArrayConverter:  # Every element is tagged with its type, since arrays may mix numbers and strings
+    INT_TAG = 0
+    STR_TAG = 1
+
     @staticmethod
     def encode(arr: list) -> bytes:
-        return StrConverter.encode(str(arr))
+        enc = [VarIntConverter.encode(len(arr))]
+        for elem in arr:
+            if isinstance(elem, int):
+                enc.append(bytes([ArrayConverter.INT_TAG]) + SIntConverter.encode(elem))
+            elif isinstance(elem, str):
+                string = StrConverter.encode(elem)
+                enc.append(bytes([ArrayConverter.STR_TAG]) + VarIntConverter.encode(len(string)) + string)
+            else:
+                raise ValueError(f'Cannot encode array element of type {type(elem).__name__}')
+        return b''.join(enc)
 
     @staticmethod
     def decode(raw: bytes) -> list:
-        return eval(StrConverter.decode(raw))
+        count, pos = VarIntConverter.decode(raw)
+        arr = []
+        for _ in range(count):
+            if pos >= len(raw):
+                raise ValueError('Found truncated array')
+            tag = raw[pos]
+            if tag == ArrayConverter.INT_TAG:
+                elem, pos = SIntConverter.decode(raw, pos + 1)
+            elif tag == ArrayConverter.STR_TAG:
+                length, pos = VarIntConverter.decode(raw, pos + 1)
+                if pos + length > len(raw):
+                    raise ValueError('Found truncated array')
+                elem, pos = StrConverter.decode(raw[pos:pos + length]), pos + length
+            else:
+                raise ValueError(f'Found unknown array element tag: {tag}')
+            arr.append(elem)
+        if pos != len(raw):
+            raise ValueError('Found array with trailing data')
+        return arr
@@ -0,0 +1,65 @@
+from time import monotonic
+
+
+class JitterBuffer:
+    DEPTH = 3  # Frames buffered before playback starts, about 75ms of audio
+    MAX_SIZE = 16
+
+    depth: int
+    max_size: int
+    frames: dict[int, bytes]
+    next_seq: int or None
+    playing: bool
+    late_count: int
+    lost_count: int
+    pushed_at: float  # Monotonic time of the last pushed frame
+
+    def __init__(self, depth: int = DEPTH, max_size: int = MAX_SIZE):
+        self.depth = depth
+        self.max_size = max_size
+        self.frames = {}
+        self.next_seq = None
+        self.playing = False
+        self.late_count = 0
+        self.lost_count = 0
+        self.pushed_at = monotonic()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def push(self, seq: int, data: bytes):
+        self.pushed_at = monotonic()
+        if self.next_seq is not None and seq < self.next_seq or seq in self.frames:
+            self.late_count += 1
+            return
+        self.frames[seq] = data
+        if len(self.frames) > self.max_size:  # Playback fell behind, so the oldest frame is dropped
+            del self.frames[min(self.frames)]
+            self.skip_to(min(self.frames))
+
+    def skip_to(self, seq: int):
+        if self.next_seq is not None:
+            self.lost_count += max(seq - self.next_seq, 0)
+        self.next_seq = seq
+
+    def pop(self) -> bytes or None:  # Next frame to be played, or None if there is nothing to play right now
+        if not self.playing:
+            if len(self.frames) < self.depth:
+                return None
+            self.playing = True
+            self.skip_to(min(self.frames))
+
+        if not self.frames:
+            self.playing = False  # Buffer is drained, so wait until it is filled again
+            return None
+        data = self.frames.pop(self.next_seq, None)
+        if data is None:
+            self.lost_count += 1
+        self.next_seq += 1
+        return data
+
+
+def evict_idle(jitter_buffers: dict[str, JitterBuffer], timeout: float):  # Of senders that have not spoken for a while
+    now = monotonic()
+    for name in [name for name, jitter_buffer in jitter_buffers.items() if now - jitter_buffer.pushed_at > timeout]:
+        del jitter_buffers[name]
@@ -0,0 +1,44 @@
+import threading
+from collections import deque
+
+import numpy as np
+
+from voice_chat.codec import SAMPLE_DTYPE
+
+
+class Mixer:
+    MAX_PENDING_FRAMES = 4  # Frames of a speaker that arrived ahead of the mixing clock, about 100ms of audio
+
+    max_pending_frames: int
+    pending: dict[int, deque[np.ndarray]]  # client_id -> frames waiting to be mixed
+    lock: threading.Lock
+
+    def __init__(self, max_pending_frames: int = MAX_PENDING_FRAMES):
+        self.max_pending_frames = max_pending_frames
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def add(self, client_id: int, pcm: bytes):
+        samples = np.frombuffer(pcm, dtype=SAMPLE_DTYPE).copy()  # PCM may be a view into the reading buffer
+        with self.lock:
+            frames = self.pending.setdefault(client_id, deque())
+            frames.append(samples)
+            if len(frames) > self.max_pending_frames:
+                frames.popleft()
+
+    def remove(self, client_id: int):
+        with self.lock:
+            self.pending.pop(client_id, None)
+
+    def take(self) -> dict[int, np.ndarray]:  # One frame of every speaker for the current tick
+        with self.lock:
+            frames = {client_id: pending.popleft() for client_id, pending in self.pending.items()}
+            self.pending = {client_id: pending for client_id, pending in self.pending.items() if pending}
+        return frames
+
+    @staticmethod
+    def mix(frames: list[np.ndarray]) -> bytes:
+        mixed = np.zeros(max(len(frame) for frame in frames), dtype=np.int32)
+        for frame in frames:
+            mixed[:len(frame)] += frame
+        return np.clip(mixed, -32768, 32767).astype(SAMPLE_DTYPE).tobytes()
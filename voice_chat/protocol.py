@@ -1,6 +1,10 @@
 from __future__ import annotations
 
-from voice_chat.converter import UIntConverter, StrConverter, ArrayConverter
+import socket
+import struct
+
+from voice_chat.converter import StrConverter, StrListConverter
+from voice_chat.codec import CodecType
 
 
 MESSAGE_TYPE_SIZE = 1
@@ -8,8 +12,21 @@ ROOM_TYPE_SIZE = 1
 ERROR_SIZE = 1
 CLIENT_NAME_SIZE = 2  # NAME_LIMIT is smaller than 256^CLIENT_NAME_SIZE since each symbol in name may take up to 4 bytes
 PORT_SIZE = 2
+UDP_TOKEN_SIZE = 4
+VOICE_SEQ_SIZE = 4
 NAMES_LIST_SIZE = 4
-VOICE_DATA_SIZE = 1024
+CODEC_SIZE = 1
+CODEC_LIST_SIZE = 1
+CAPABILITIES_SIZE = 1
+VOICE_LEN_SIZE = 2
+VOICE_DATA_SIZE = 1024  # Of a recorded PCM chunk, encoded data may be shorter
+
+
+UINT_FORMATS = {1: 'B', 2: 'H', 4: 'I'}
+
+
+def layout(*sizes: int) -> struct.Struct:  # Big-endian unsigned fields of given sizes
+    return struct.Struct('>' + ''.join(UINT_FORMATS[size] for size in sizes))
 
 
 class MessageType:
@@ -22,45 +39,154 @@ class MessageType:
     ROOM_CHANGE: int = 6
     GAME_STARTED: int = 7
     CONNECTED_RESPONSE: int = 8
+    UDP_REQUEST: int = 9
+    UDP_OFFER: int = 10
+    CODEC_REQUEST: int = 11
+    CODEC_RESPONSE: int = 12
+
+
+class Capability:  # Flags that client sends along with its codecs
+    VAD: int = 1  # Client suppresses silence itself, so server should not detect voice activity again
 
 
 class Message:
     message_type: int
-
-    def encode(self):
-        raise NotImplementedError('encode is not defined!')
+    LAYOUT: struct.Struct = layout(MESSAGE_TYPE_SIZE)  # Fixed-size part of a frame: message type, then fields()
+    HAS_TAIL: bool = False  # If set, fixed-size part ends with length of tail(), which follows it
+
+    def fields(self) -> tuple:
+        return ()
+
+    def tail(self) -> bytes:
+        return b''
+
+    @classmethod
+    def from_fields(cls, *fields) -> Message:  # Gets fields() and tail(), if there is one
+        return cls(*fields)
+
+    def encode(self) -> bytes:
+        if not self.HAS_TAIL:
+            return self.LAYOUT.pack(self.message_type, *self.fields())
+        tail = self.tail()
+        return self.LAYOUT.pack(self.message_type, *self.fields(), len(tail)) + tail
+
+    def size(self) -> int:
+        return self.LAYOUT.size + len(self.tail())
+
+    def pack_into(self, buf, offset: int = 0) -> int:  # Returns offset right after the frame
+        if not self.HAS_TAIL:
+            self.LAYOUT.pack_into(buf, offset, self.message_type, *self.fields())
+            return offset + self.LAYOUT.size
+        tail = self.tail()
+        self.LAYOUT.pack_into(buf, offset, self.message_type, *self.fields(), len(tail))
+        offset += self.LAYOUT.size
+        buf[offset:offset + len(tail)] = tail
+        return offset + len(tail)
+
+    @classmethod
+    def parse(cls, buf: memoryview) -> (Message or None, int):  # Same as parse_frame, once message type is known
+        fixed_size = cls.LAYOUT.size
+        if len(buf) < fixed_size:
+            return None, fixed_size
+        _, *fields = cls.LAYOUT.unpack_from(buf)
+        if not cls.HAS_TAIL:
+            return cls.from_fields(*fields), fixed_size
+        size = fixed_size + fields[-1]
+        if len(buf) < size:
+            return None, size
+        return cls.from_fields(*fields[:-1], buf[fixed_size:size]), size
+
+
+VOICE_HEADER_LAYOUT = layout(MESSAGE_TYPE_SIZE, CLIENT_NAME_SIZE)
+VOICE_DATA_LAYOUT = layout(CODEC_SIZE, VOICE_LEN_SIZE)
 
 
 class VoiceMessage(Message):
     message_type: int = MessageType.VOICE
     name: str  # We should not give away client_id, since hackers can use it to fake profiles
     data: bytes
+    codec: int
 
-    def __init__(self, name: str = '', data: bytes = b''):
+    def __init__(self, name: str = '', data: bytes = b'', codec: int = CodecType.PCM):
         self.name = name
         self.data = data
-        assert len(self.data) == VOICE_DATA_SIZE, f'Wrong data size: Expected {VOICE_DATA_SIZE}, got {len(self.data)}'
+        self.codec = codec
+        assert len(self.data) < 256 ** VOICE_LEN_SIZE, f'Too much data: {len(self.data)}'
 
     def encode(self):
         enc_name = StrConverter.encode(self.name)
-        return UIntConverter.encode(self.message_type, MESSAGE_TYPE_SIZE) \
-            + UIntConverter.encode(len(enc_name), CLIENT_NAME_SIZE) \
-            + enc_name \
-            + self.data
+        return b''.join([VOICE_HEADER_LAYOUT.pack(self.message_type, len(enc_name)), enc_name,
+                         VOICE_DATA_LAYOUT.pack(self.codec, len(self.data)), self.data])
+
+    def size(self) -> int:
+        return VOICE_HEADER_LAYOUT.size + len(StrConverter.encode(self.name)) + VOICE_DATA_LAYOUT.size + len(self.data)
+
+    def pack_into(self, buf, offset: int = 0) -> int:
+        enc_name = StrConverter.encode(self.name)
+        VOICE_HEADER_LAYOUT.pack_into(buf, offset, self.message_type, len(enc_name))
+        offset += VOICE_HEADER_LAYOUT.size
+        buf[offset:offset + len(enc_name)] = enc_name
+        offset += len(enc_name)
+        VOICE_DATA_LAYOUT.pack_into(buf, offset, self.codec, len(self.data))
+        offset += VOICE_DATA_LAYOUT.size
+        buf[offset:offset + len(self.data)] = self.data
+        return offset + len(self.data)
+
+    @classmethod
+    def parse(cls, buf: memoryview) -> (Message or None, int):
+        name, size = parse_name(buf)
+        if name is None:
+            return None, size
+        codec, data, data_size = parse_voice_data(buf[size:])
+        if data is None:
+            return None, size + data_size
+        return VoiceMessage(name, data, codec), size + data_size
+
+
+def encode_voice_header(name: str) -> bytes:  # Everything in VoiceMessage that precedes codec and data
+    enc_name = StrConverter.encode(name)
+    return VOICE_HEADER_LAYOUT.pack(MessageType.VOICE, len(enc_name)) + enc_name
+
+
+def encode_voice_data(codec: int, data: bytes) -> bytes:
+    return VOICE_DATA_LAYOUT.pack(codec, len(data)) + data
+
+
+def parse_name(buf: memoryview) -> (str or None, int):  # Of a message that starts with message type and name
+    if len(buf) < VOICE_HEADER_LAYOUT.size:
+        return None, VOICE_HEADER_LAYOUT.size
+    size = VOICE_HEADER_LAYOUT.size + VOICE_HEADER_LAYOUT.unpack_from(buf)[1]
+    if len(buf) < size:
+        return None, size
+    return str(buf[VOICE_HEADER_LAYOUT.size:size], 'UTF-8'), size
+
+
+def parse_voice_data(buf: memoryview) -> (int or None, memoryview or None, int):  # (codec, data, size) or needed size
+    if len(buf) < VOICE_DATA_LAYOUT.size:
+        return None, None, VOICE_DATA_LAYOUT.size
+    codec, len_data = VOICE_DATA_LAYOUT.unpack_from(buf)
+    size = VOICE_DATA_LAYOUT.size + len_data
+    if len(buf) < size:
+        return None, None, size
+    data = buf[VOICE_DATA_LAYOUT.size:size]
+    return codec, data.toreadonly() if isinstance(data, memoryview) else data, size
 
 
 class ConnectedMessage(Message):
     message_type: int = MessageType.CONNECTED
+    LAYOUT: struct.Struct = layout(MESSAGE_TYPE_SIZE, CLIENT_NAME_SIZE)
+    HAS_TAIL: bool = True
     name: str
 
     def __init__(self, name: str):
         self.name = name
 
-    def encode(self):
-        enc_name = StrConverter.encode(self.name)
-        return UIntConverter.encode(self.message_type, MESSAGE_TYPE_SIZE) \
-            + UIntConverter.encode(len(enc_name), CLIENT_NAME_SIZE) \
-            + enc_name
+    def tail(self) -> bytes:
+        return StrConverter.encode(self.name)
+
+    @classmethod
+    def from_fields(cls, tail: memoryview) -> Message:
+        return cls(str(tail, 'UTF-8'))
 
 
 class DisconnectedMessage(ConnectedMessage):
@@ -70,107 +196,260 @@ class DisconnectedMessage(ConnectedMessage):
 class ListRequestMessage(Message):
     message_type: int = MessageType.LIST_REQUEST
 
-    def encode(self):
-        return UIntConverter.encode(self.message_type, MESSAGE_TYPE_SIZE)
-
 
 class ListResponseMessage(Message):
     message_type: int = MessageType.LIST_RESPONSE
+    LAYOUT: struct.Struct = layout(MESSAGE_TYPE_SIZE, NAMES_LIST_SIZE)
+    HAS_TAIL: bool = True
     names: list[str]
 
     def __init__(self, names: list[str]):
         self.names = names
 
-    def encode(self):
-        names_enc = ArrayConverter.encode(self.names)
-        return UIntConverter.encode(self.message_type, MESSAGE_TYPE_SIZE) \
-            + UIntConverter.encode(len(names_enc), NAMES_LIST_SIZE) \
-            + names_enc
+    def tail(self) -> bytes:
+        return StrListConverter.encode(self.names)
+
+    @classmethod
+    def from_fields(cls, tail: memoryview) -> Message:
+        return cls(StrListConverter.decode(tail))
 
 
 class RoomChangeMessage(Message):
     message_type: int = MessageType.ROOM_CHANGE
+    LAYOUT: struct.Struct = layout(MESSAGE_TYPE_SIZE, ROOM_TYPE_SIZE)
     room_id: int
 
     def __init__(self, room_id: int):
         self.room_id = room_id
 
-    def encode(self):
-        return UIntConverter.encode(self.message_type, MESSAGE_TYPE_SIZE) \
-            + UIntConverter.encode(self.room_id, ROOM_TYPE_SIZE)
+    def fields(self) -> tuple:
+        return (self.room_id,)
 
 
 class ShutdownMessage(Message):
     message_type: int = MessageType.SHUTDOWN
 
-    def encode(self):
-        return UIntConverter.encode(self.message_type, MESSAGE_TYPE_SIZE)
-
 
 class GameStartingMessage(Message):
     message_type: int = MessageType.GAME_STARTED
+    LAYOUT: struct.Struct = layout(MESSAGE_TYPE_SIZE, PORT_SIZE)
     port: int
 
     def __init__(self, port):
         self.port = port
 
-    def encode(self):
-        return UIntConverter.encode(self.message_type, MESSAGE_TYPE_SIZE) \
-            + UIntConverter.encode(self.port, PORT_SIZE)
+    def fields(self) -> tuple:
+        return (self.port,)
 
 
 class ConnectedResponseMessage(Message):
     message_type: int = MessageType.CONNECTED_RESPONSE
+    LAYOUT: struct.Struct = layout(MESSAGE_TYPE_SIZE, ERROR_SIZE)
+    HAS_TAIL: bool = True
     error: str
 
     def __init__(self, error):
         self.error = error
 
-    def encode(self):
-        error_enc = StrConverter.encode(self.error)
-        return UIntConverter.encode(self.message_type, MESSAGE_TYPE_SIZE) \
-            + UIntConverter.encode(len(error_enc), ERROR_SIZE) \
-            + error_enc
+    def tail(self) -> bytes:
+        return StrConverter.encode(self.error)
+
+    @classmethod
+    def from_fields(cls, tail: memoryview) -> Message:
+        return cls(str(tail, 'UTF-8'))
+
+
+class UdpRequestMessage(Message):
+    message_type: int = MessageType.UDP_REQUEST
+
+
+class UdpOfferMessage(Message):
+    message_type: int = MessageType.UDP_OFFER
+    LAYOUT: struct.Struct = layout(MESSAGE_TYPE_SIZE, PORT_SIZE, UDP_TOKEN_SIZE)
+    port: int
+    token: int  # Identifies client's datagrams, so it should not be given away as well
+
+    def __init__(self, port: int, token: int):
+        self.port = port
+        self.token = token
+
+    def fields(self) -> tuple:
+        return (self.port, self.token)
+
+
+class CodecRequestMessage(Message):
+    message_type: int = MessageType.CODEC_REQUEST
+    LAYOUT: struct.Struct = layout(MESSAGE_TYPE_SIZE, CAPABILITIES_SIZE, CODEC_LIST_SIZE)
+    HAS_TAIL: bool = True
+    codecs: list[int]  # Supported by client
+    capabilities: int  # Capability flags
+
+    def __init__(self, codecs: list[int], capabilities: int = 0):
+        self.codecs = codecs
+        self.capabilities = capabilities
+
+    def fields(self) -> tuple:
+        return (self.capabilities,)
+
+    def tail(self) -> bytes:
+        return bytes(self.codecs)
+
+    @classmethod
+    def from_fields(cls, capabilities: int, tail: memoryview) -> Message:
+        return cls(list(tail), capabilities)
+
+
+class CodecResponseMessage(Message):
+    message_type: int = MessageType.CODEC_RESPONSE
+    LAYOUT: struct.Struct = layout(MESSAGE_TYPE_SIZE, CODEC_SIZE)
+    codec: int  # Client should use it to encode its voice
+
+    def __init__(self, codec: int):
+        self.codec = codec
+
+    def fields(self) -> tuple:
+        return (self.codec,)
+
+
+MESSAGE_CLASSES: dict[int, type[Message]] = {message_class.message_type: message_class for message_class in [
+    VoiceMessage, ConnectedMessage, DisconnectedMessage, ShutdownMessage, ListRequestMessage, ListResponseMessage,
+    RoomChangeMessage, GameStartingMessage, ConnectedResponseMessage, UdpRequestMessage, UdpOfferMessage,
+    CodecRequestMessage, CodecResponseMessage,
+]}
+
+DATAGRAM_HEADER_LAYOUT = layout(UDP_TOKEN_SIZE, VOICE_SEQ_SIZE)
+VOICE_SEQ_LAYOUT = layout(VOICE_SEQ_SIZE)
+
+
+# Voice datagrams are sent by client as token, seq, codec and data
+def encode_voice_datagram(token: int, seq: int, codec: int or None = None, data: bytes = b'') -> bytes:
+    header = DATAGRAM_HEADER_LAYOUT.pack(token, seq)
+    if codec is None:  # Keepalive
+        return header
+    return b''.join([header, VOICE_DATA_LAYOUT.pack(codec, len(data)), data])
+
+
+def decode_voice_datagram(datagram: memoryview) -> (int, int, VoiceMessage or None):
+    if len(datagram) < DATAGRAM_HEADER_LAYOUT.size:
+        raise ValueError('Found malformed voice datagram')
+    token, seq = DATAGRAM_HEADER_LAYOUT.unpack_from(datagram)
+    if len(datagram) == DATAGRAM_HEADER_LAYOUT.size:
+        return token, seq, None
+    codec, data, size = parse_voice_data(datagram[DATAGRAM_HEADER_LAYOUT.size:])
+    if data is None or DATAGRAM_HEADER_LAYOUT.size + size != len(datagram):
+        raise ValueError('Found malformed voice datagram')
+    return token, seq, VoiceMessage(data=data, codec=codec)
+
+
+# And relayed by server as seq and encoded VoiceMessage
+def encode_relayed_voice_datagram(seq: int, voice_header: bytes, codec: int, data: bytes) -> bytes:
+    return b''.join([VOICE_SEQ_LAYOUT.pack(seq), voice_header, VOICE_DATA_LAYOUT.pack(codec, len(data)), data])
+
+
+def decode_relayed_voice_datagram(datagram: memoryview) -> (int, VoiceMessage):
+    if len(datagram) < VOICE_SEQ_SIZE:
+        raise ValueError('Found malformed voice datagram')
+    seq, = VOICE_SEQ_LAYOUT.unpack_from(datagram)
+    msg, size = parse_frame(datagram[VOICE_SEQ_SIZE:])
+    if msg is None or msg.message_type != MessageType.VOICE or VOICE_SEQ_SIZE + size != len(datagram):
+        raise ValueError('Found malformed voice datagram')
+    return seq, msg
+
+
+def recv_exactly(sock, length: int) -> bytes:  # socket.socket or MockSocket
+    data = sock.recv(length)
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed by peer')
+        data += chunk
+    return data
 
 
 def get_message(sock):  # socket.socket or MockSocket
-    message_type = UIntConverter.decode(sock.recv(MESSAGE_TYPE_SIZE))
-
-    if message_type == MessageType.VOICE:
-        len_name = UIntConverter.decode(sock.recv(CLIENT_NAME_SIZE))
-        name = StrConverter.decode(sock.recv(len_name))
-        return VoiceMessage(name, sock.recv(VOICE_DATA_SIZE))
-
-    elif message_type == MessageType.CONNECTED:
-        len_name = UIntConverter.decode(sock.recv(CLIENT_NAME_SIZE))
-        return ConnectedMessage(StrConverter.decode(sock.recv(len_name)))
-
-    elif message_type == MessageType.DISCONNECTED:
-        len_name = UIntConverter.decode(sock.recv(CLIENT_NAME_SIZE))
-        return DisconnectedMessage(StrConverter.decode(sock.recv(len_name)))
-
-    elif message_type == MessageType.LIST_REQUEST:
-        return ListRequestMessage()
-
-    elif message_type == MessageType.LIST_RESPONSE:
-        len_names = UIntConverter.decode(sock.recv(NAMES_LIST_SIZE))
-        names = ArrayConverter.decode(sock.recv(len_names))
-        return ListResponseMessage(names)
-
-    elif message_type == MessageType.ROOM_CHANGE:
-        room = UIntConverter.decode(sock.recv(ROOM_TYPE_SIZE))
-        return RoomChangeMessage(room)
-
-    elif message_type == MessageType.SHUTDOWN:
-        return ShutdownMessage()
-
-    elif message_type == MessageType.GAME_STARTED:
-        port = UIntConverter.decode(sock.recv(PORT_SIZE))
-        return GameStartingMessage(port)
-
-    elif message_type == MessageType.CONNECTED_RESPONSE:
-        error_len = UIntConverter.decode(sock.recv(ERROR_SIZE))
-        error = StrConverter.decode(sock.recv(error_len))
-        return ConnectedResponseMessage(error)
-    else:
-        assert False, f'Found unknown message_type: {message_type}'
+    frame = recv_exactly(sock, MESSAGE_TYPE_SIZE)
+    msg, size = parse_frame(frame)
+    while msg is None:
+        frame += recv_exactly(sock, size - len(frame))
+        msg, size = parse_frame(frame)
+    return msg
+
+
+def parse_frame(buf: memoryview) -> (Message or None, int):  # (message, its size) or (None, bytes needed for it)
+    if len(buf) < MESSAGE_TYPE_SIZE:
+        return None, MESSAGE_TYPE_SIZE
+    message_class = MESSAGE_CLASSES.get(buf[0])
+    if message_class is None:
+        raise ValueError(f'Found unknown message_type: {buf[0]}')
+    return message_class.parse(buf)
+
+
+class FrameReader:
+    # Voice data is handed out as a view into the buffer, so it is only valid until the next read
+    BUFFER_SIZE = 64 * 1024
+    MIN_READ_SIZE = 4 * 1024
+
+    sock: socket.socket or None
+    buffer: bytearray
+    view: memoryview
+    start: int
+    end: int
+    needed: int
+
+    def __init__(self, sock=None, buffer_size: int = BUFFER_SIZE):
+        self.sock = sock
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.needed = 0
+
+    def get_buffer(self) -> memoryview:
+        if self.start == self.end:
+            self.start = self.end = 0
+        free_needed = max(self.needed - (self.end - self.start), self.MIN_READ_SIZE)
+        if len(self.buffer) - self.end < free_needed:
+            pending = self.end - self.start
+            if pending + free_needed > len(self.buffer):
+                # Messages may still reference the old buffer, so it is replaced instead of resized
+                buffer = bytearray(max(2 * len(self.buffer), pending + free_needed))
+                buffer[:pending] = self.view[self.start:self.end]
+                self.buffer, self.view = buffer, memoryview(buffer)
+            else:
+                self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes: int):
+        self.end += nbytes
+
+    def feed(self, data: bytes):
+        self.needed = max(self.needed, self.end - self.start + len(data))
+        buf = self.get_buffer()
+        buf[:len(data)] = data
+        self.buffer_updated(len(data))
+
+    def next_message(self) -> Message or None:
+        msg, size = parse_frame(self.view[self.start:self.end])
+        if msg is None:
+            self.needed = size
+            return None
+        self.start += size
+        self.needed = 0
+        return msg
+
+    def __iter__(self):
+        msg = self.next_message()
+        while msg is not None:
+            yield msg
+            msg = self.next_message()
+
+    def get_message(self) -> Message:
+        msg = self.next_message()
+        while msg is None:
+            nbytes = self.sock.recv_into(self.get_buffer())
+            if nbytes == 0:
+                raise ConnectionError('Connection closed by peer')
+            self.buffer_updated(nbytes)
+            msg = self.next_message()
+        return msg
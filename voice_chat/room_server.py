@@ -1,75 +1,195 @@
 import socket
 import threading
-from time import sleep
-
-from client_manager import ClientManager
-from protocol import MessageType, Message,\
-    ListResponseMessage, ConnectedMessage, DisconnectedMessage, GameStartingMessage
+from time import monotonic, sleep
+
+from voice_chat.client_manager import ClientManager
+from voice_chat.codec import CodecType, get_codec, SAMPLE_RATE
+from voice_chat.mixer import Mixer
+from voice_chat.vad import VoiceActivity
+from voice_chat.protocol import MessageType, Message, Capability, \
+    ListResponseMessage, ConnectedMessage, DisconnectedMessage, GameStartingMessage, VoiceMessage, \
+    encode_voice_header, encode_relayed_voice_datagram, VOICE_SEQ_SIZE, VOICE_DATA_SIZE
 from mafia.servicer import build_server
 from mafia.common import WAIT_TIME_TO_START, Phase
+from rest.profile_dao import ProfileDao
 
 
 class RoomServer:
     RETRY_LIMIT = 3
     MIN_PLAYER_COUNT = 4
+    SUPPRESS_SILENCE = True  # Of clients that did not negotiate Capability.VAD
+    MIX_INTERVAL = VOICE_DATA_SIZE / 2 / SAMPLE_RATE  # Duration of a single voice frame
+    # Mixed frames are sent under a fixed name, so that listeners keep one jitter buffer however speakers change
+    MIX_NAME = '/mix'
 
     client_manager: ClientManager
+    dao: ProfileDao
     client_ids: set[int]
+    lock: threading.Lock  # Of client_ids, which are changed by clients' threads and read by game and mixing
     game_starting: bool
+    mixer: Mixer or None  # Set if voice of concurrent speakers is mixed into a single frame for every listener
+    mix_seq: int
+    mix_header: bytes
+    mixing: bool  # Set while ticker of mixing runs, which stops once room is empty
+    finish_decided_phases: bool  # Of games, see MafiaGame
 
     phase: Phase
     mafia: list[str]
     dead: set[str]
     finish_thread: threading.Thread
 
-    def __init__(self, client_manager: ClientManager, room_id: int):
+    def __init__(self, client_manager: ClientManager, room_id: int, dao: ProfileDao, mix_voice: bool = False,
+                 finish_decided_phases: bool = False):
         self.client_manager = client_manager
+        self.dao = dao
         self.client_ids = set()
+        self.lock = threading.Lock()
         self.mafia_game = None
         self.game_starting = False
+        self.mixer = Mixer() if mix_voice else None
+        self.mix_seq = 0
+        self.mix_header = encode_voice_header(self.MIX_NAME)
+        self.mixing = False
+        self.finish_decided_phases = finish_decided_phases
         self.port = 10000 + room_id
 
         self.phase = Phase.DAY
         self.dead = set()
         self.mafia = []
 
+    def get_client_ids(self) -> list[int]:
+        with self.lock:
+            return list(self.client_ids)
+
     def add_client(self, client_id: int):
-        self.client_ids.add(client_id)
+        with self.lock:
+            self.client_ids.add(client_id)
+            client_count = len(self.client_ids)
+            start_mixing = self.mixer is not None and not self.mixing
+            if start_mixing:
+                self.mixing = True
         self.handle_message(client_id, ConnectedMessage(self.client_manager[client_id].name))
         if self.game_starting:
-            self.client_manager[client_id].sock.sendall(GameStartingMessage(self.port).encode())
-        if len(self.client_ids) == self.MIN_PLAYER_COUNT and self.mafia_game is None:
-            self.launch_game()
+            self.client_manager[client_id].send(GameStartingMessage(self.port).encode())
+        if client_count == self.MIN_PLAYER_COUNT and self.mafia_game is None:
+            threading.Thread(target=self.launch_game).start()
+        if start_mixing:
+            self.start_mixing()
 
     def launch_game(self):
         self.game_starting = True
-        for client_id in self.client_ids:
-            self.client_manager[client_id].sock.sendall(GameStartingMessage(self.port).encode())
+        for client_id in self.get_client_ids():
+            self.client_manager[client_id].send(GameStartingMessage(self.port).encode())
         sleep(WAIT_TIME_TO_START)
         self.game_starting = False
-        self.mafia_game = build_server([self.client_manager[cid].name for cid in self.client_ids], self.port, self)
+        self.mafia_game = build_server([self.client_manager[cid].name for cid in self.get_client_ids()], self.port,
+                                       self, self.finish_decided_phases)
         self.mafia_game.start()
 
     def remove_client(self, client_id: int):
-        self.client_ids.remove(client_id)
+        with self.lock:
+            self.client_ids.remove(client_id)
+        if self.mixer is not None:
+            self.mixer.remove(client_id)
         self.handle_message(client_id, DisconnectedMessage(self.client_manager[client_id].name))
 
-    def broadcast(self, sender_id, msg_bytes):
+    def broadcast(self, sender_id, *buffers, droppable=False):
         client_ids = self.get_clients_to_broadcast(sender_id)
         for client_id in client_ids:
             if client_id != sender_id:
                 try:
-                    self.client_manager[client_id].sock.sendall(msg_bytes)
+                    self.client_manager[client_id].send(*buffers, droppable=droppable)
                 except socket.error as err:
                     print(f'ERROR Could not broadcast message to client {client_id}:', err)
 
+    def broadcast_voice(self, sender_id, msg: VoiceMessage):
+        sender = self.client_manager[sender_id]
+        sender.voice_seq += 1
+        # Data is copied once into a datagram, since it is only a view into the reading buffer and may be queued
+        datagram = encode_relayed_voice_datagram(sender.voice_seq, sender.voice_header, msg.codec, msg.data)
+        voice_data = memoryview(datagram)[VOICE_SEQ_SIZE + len(sender.voice_header):]
+        for client_id in self.get_clients_to_broadcast(sender_id):
+            if client_id != sender_id:
+                try:
+                    self.client_manager[client_id].send_voice(sender.voice_header, voice_data, datagram)
+                except socket.error as err:
+                    print(f'ERROR Could not broadcast voice to client {client_id}:', err)
+
+    def start_mixing(self):  # Once mixing is set by add_client
+        threading.Thread(target=self.run_mixing, daemon=True).start()
+
+    def keep_mixing(self) -> bool:
+        # Decided under the lock of add_client, so that a ticker is started again only once this one has stopped
+        with self.lock:
+            self.mixing = len(self.client_ids) > 0
+            return self.mixing
+
+    def run_mixing(self):
+        next_tick = monotonic()
+        while self.keep_mixing():
+            self.mix_voice()
+            next_tick += self.MIX_INTERVAL
+            sleep(max(next_tick - monotonic(), 0))
+
+    def mix_voice(self):
+        frames = self.mixer.take()
+        if not frames:
+            return
+        self.mix_seq += 1
+        audiences = {speaker_id: set(self.get_clients_to_broadcast(speaker_id))
+                     for speaker_id in frames if speaker_id in self.client_manager.clients}
+        # Listeners who hear the same speakers and use the same codec share a single encoded frame
+        mixed_frames = {}
+        for client_id in self.get_client_ids():
+            speaker_ids = tuple(sorted(speaker_id for speaker_id, audience in audiences.items()
+                                       if speaker_id != client_id and client_id in audience))
+            if not speaker_ids or client_id not in self.client_manager.clients:
+                continue
+            listener = self.client_manager[client_id]
+            key = (speaker_ids, listener.codec)
+            if key not in mixed_frames:
+                mixed_frames[key] = self.encode_mixed_frame(speaker_ids, listener.codec, frames)
+            try:
+                listener.send_voice(*mixed_frames[key])
+            except socket.error as err:
+                print(f'ERROR Could not send mixed voice to client {client_id}:', err)
+
+    def encode_mixed_frame(self, speaker_ids: tuple, codec: int, frames: dict) -> (bytes, memoryview, bytes):
+        data = get_codec(codec).encode(Mixer.mix([frames[speaker_id] for speaker_id in speaker_ids]))
+        datagram = encode_relayed_voice_datagram(self.mix_seq, self.mix_header, codec, data)
+        return self.mix_header, memoryview(datagram)[VOICE_SEQ_SIZE + len(self.mix_header):], datagram
+
+    def suppress_silence(self, sender_id, msg: VoiceMessage) -> VoiceMessage or None:
+        sender = self.client_manager[sender_id]
+        if not self.SUPPRESS_SILENCE or sender.capabilities & Capability.VAD or msg.codec == CodecType.COMFORT_NOISE:
+            return msg
+        pcm = get_codec(msg.codec).decode(msg.data)
+        activity = sender.vad.process(pcm)
+        if activity == VoiceActivity.SPEECH:
+            return msg
+        elif activity == VoiceActivity.SILENCE_START:
+            return VoiceMessage(data=get_codec(CodecType.COMFORT_NOISE).encode(pcm), codec=CodecType.COMFORT_NOISE)
+        return None
+
     def handle_message(self, sender_id: int, msg: Message):
-        if msg.message_type in [MessageType.VOICE, MessageType.CONNECTED, MessageType.DISCONNECTED]:
+        if msg.message_type == MessageType.VOICE:
+            if msg.codec not in [self.client_manager[sender_id].codec, CodecType.COMFORT_NOISE]:
+                return  # Listeners only expect negotiated codecs, and could fail on unknown ones
+            if not get_codec(msg.codec).is_valid(msg.data):
+                return  # Frame could not be decoded for VAD or mixing, nor by listeners
+            msg = self.suppress_silence(sender_id, msg)
+            if msg is None:
+                return
+            if self.mixer is None:
+                self.broadcast_voice(sender_id, msg)
+            elif msg.codec != CodecType.COMFORT_NOISE:  # Listeners of a mix hear silence once speaker stops anyway
+                self.mixer.add(sender_id, get_codec(msg.codec).decode(msg.data))
+        elif msg.message_type in [MessageType.CONNECTED, MessageType.DISCONNECTED]:
             msg.name = self.client_manager[sender_id].name
             self.broadcast(sender_id, msg.encode())
         elif msg.message_type == MessageType.LIST_REQUEST:
-            names = sorted([self.client_manager[client_id].name for client_id in self.client_ids])
-            self.client_manager[sender_id].sock.sendall(ListResponseMessage(names).encode())
+            names = sorted([self.client_manager[client_id].name for client_id in self.get_client_ids()])
+            self.client_manager[sender_id].send(ListResponseMessage(names).encode())
         else:
             print(f'Discarded message with unknown message type: {msg.message_type}')
 
@@ -77,7 +197,7 @@ class RoomServer:
         if self.client_manager[sender_id].name in self.dead:
             return set()
         if self.phase == Phase.DAY:
-            return set(filter(lambda cl_id: cl_id in self.client_manager.clients, self.client_ids))
+            return set(filter(lambda cl_id: cl_id in self.client_manager.clients, self.get_client_ids()))
         elif self.phase == Phase.NIGHT:
             if self.client_manager[sender_id].name in self.mafia:
                 return [self.client_manager.name_id[name] for name in self.mafia]
@@ -93,6 +213,9 @@ class RoomServer:
     def notify_dead(self, name: str):
         self.dead.add(name)
 
+    def notify_results(self, total_time: int, results: dict[str, bool]):
+        self.dao.finish_games([(name, total_time, won) for name, won in results.items()])
+
     def notify_finish(self):
         self.finish_thread = threading.Thread(target=self.finish)
 
@@ -0,0 +1,91 @@
+import threading
+from collections import deque
+
+
+class OverflowPolicy:
+    DROP_OLDEST = 'drop_oldest'  # Drop the oldest queued voice frame
+    COALESCE = 'coalesce'  # Drop every queued voice frame, so that listener jumps straight to the newest one
+    DISCONNECT = 'disconnect'  # Drop the oldest queued voice frame, but disconnect after too many overflows
+
+
+class SendQueue:
+    MAX_VOICE_FRAMES = 8  # About 200ms of audio
+    MAX_OVERFLOWS = 100
+
+    policy: str
+    max_voice_frames: int
+    max_overflows: int
+
+    frames: deque[tuple[tuple, bool]]  # (buffers, droppable)
+    voice_frame_count: int
+    dropped_count: int
+    overflow_count: int
+    closed: bool
+    condition: threading.Condition
+
+    def __init__(self, policy: str = OverflowPolicy.DROP_OLDEST, max_voice_frames: int = MAX_VOICE_FRAMES,
+                 max_overflows: int = MAX_OVERFLOWS):
+        self.policy = policy
+        self.max_voice_frames = max_voice_frames
+        self.max_overflows = max_overflows
+        self.frames = deque()
+        self.voice_frame_count = 0
+        self.dropped_count = 0
+        self.overflow_count = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, buffers: tuple, droppable: bool = False) -> bool:  # Returns False if client should be disconnected
+        with self.condition:
+            if self.closed:
+                return True
+            self.frames.append((buffers, droppable))
+            if droppable:
+                self.voice_frame_count += 1
+                if self.voice_frame_count > self.max_voice_frames:
+                    self.overflow_count += 1
+                    if self.policy == OverflowPolicy.COALESCE:
+                        self.drop_voice_frames(self.voice_frame_count - 1)
+                    else:
+                        self.drop_voice_frames(1)
+            self.condition.notify()
+            return self.policy != OverflowPolicy.DISCONNECT or self.overflow_count <= self.max_overflows
+
+    def drop_voice_frames(self, count: int):
+        kept = deque()
+        for buffers, droppable in self.frames:
+            if droppable and count > 0:
+                count -= 1
+                self.voice_frame_count -= 1
+                self.dropped_count += 1
+            else:
+                kept.append((buffers, droppable))
+        self.frames = kept
+
+    def pop(self) -> tuple:
+        buffers, droppable = self.frames.popleft()
+        if droppable:
+            self.voice_frame_count -= 1
+        return buffers
+
+    def get(self) -> tuple or None:  # Blocks until there is a frame to send, returns None once closed and empty
+        with self.condition:
+            while not self.frames and not self.closed:
+                self.condition.wait()
+            if not self.frames:
+                return None
+            return self.pop()
+
+    def get_nowait(self) -> tuple or None:
+        with self.condition:
+            if not self.frames:
+                return None
+            return self.pop()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
@@ -0,0 +1,224 @@
+import asyncio
+import functools
+import socket
+import threading
+
+from voice_chat.protocol import MessageType, ConnectedResponseMessage, FrameReader
+from voice_chat.client_manager import Profile
+from voice_chat.send_queue import SendQueue
+from voice_chat.room_server import RoomServer
+from voice_chat.server_tcp import Server
+
+
+class AsyncProfile(Profile):
+    transport: asyncio.Transport
+    loop: asyncio.AbstractEventLoop
+    loop_thread: int
+    writing_paused: bool
+
+    def __init__(self, name, transport, addr, loop):
+        super().__init__(name, transport.get_extra_info('socket'), addr)
+        self.transport = transport
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.writing_paused = False
+
+    def start_sending(self, send_queue: SendQueue):
+        # Frames are written straight to the transport, and only queued while it is over its high-water mark
+        self.send_queue = send_queue
+
+    def send(self, *buffers, droppable=False):
+        # Transport may keep views after writelines, so views into reused buffers, e.g. of FrameReader, are copied.
+        # Views of FrameReader are read-only, so only views into immutable bytes are kept
+        buffers = tuple(bytes(buf) if isinstance(buf, memoryview) and not isinstance(buf.obj, bytes) else buf
+                        for buf in buffers)
+        # Room servers may also send from game threads, and transports are not thread-safe
+        if threading.get_ident() != self.loop_thread:
+            self.loop.call_soon_threadsafe(functools.partial(self.send, *buffers, droppable=droppable))
+        elif self.send_queue is None or (not self.writing_paused and len(self.send_queue) == 0):
+            self.transport.writelines(buffers)
+        elif not self.send_queue.put(buffers, droppable) and not self.closing:
+            print(f'ERROR: {self.name} cannot keep up with sent data. Disconnecting...')
+            self.closing = True
+            self.transport.abort()
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        self.flush()
+
+    def flush(self):
+        while not self.writing_paused:
+            buffers = self.send_queue.get_nowait()
+            if buffers is None:
+                break
+            self.transport.writelines(buffers)
+
+    def close(self):
+        if threading.get_ident() != self.loop_thread:
+            self.loop.call_soon_threadsafe(self.close)
+            return
+        if self.send_queue is not None:
+            self.send_queue.close()
+            buffers = self.send_queue.get_nowait()
+            while buffers is not None:
+                self.transport.writelines(buffers)
+                buffers = self.send_queue.get_nowait()
+        self.transport.close()
+
+
+class ClientProtocol(asyncio.BufferedProtocol):
+    WRITE_BUFFER_LIMIT = 64 * 1024
+
+    server: 'AsyncServer'
+    reader: FrameReader
+    transport: asyncio.Transport or None
+    profile: AsyncProfile or None
+    client_id: int or None
+    authorizing: bool
+
+    def __init__(self, server):
+        self.server = server
+        self.reader = FrameReader()
+        self.transport = None
+        self.profile = None
+        self.client_id = None
+        self.authorizing = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.WRITE_BUFFER_LIMIT)
+        transport.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def get_buffer(self, sizehint):
+        return self.reader.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.reader.buffer_updated(nbytes)
+        self.process_messages()
+
+    def process_messages(self):
+        try:
+            while not self.authorizing:
+                msg = self.reader.next_message()
+                if msg is None:
+                    break
+                if self.client_id is None:
+                    self.start_authorization(msg)
+                else:
+                    self.server.route_message(self.client_id, msg)
+        except ValueError as err:
+            print(f'ERROR could not handle client {self.client_id}:', err)
+            self.transport.close()
+
+    def start_authorization(self, msg):
+        if msg.message_type != MessageType.CONNECTED or msg.name is None or msg.name == '':
+            self.transport.write(ConnectedResponseMessage(error='Invalid ConnectedMessage').encode())
+            self.transport.close()
+            return
+        self.authorizing = True
+        self.transport.pause_reading()
+        asyncio.get_running_loop().create_task(self.authorize(msg.name))
+
+    async def authorize(self, jwt_token):
+        loop = asyncio.get_running_loop()
+        login = await loop.run_in_executor(None, self.server.authorize, jwt_token)
+        if self.transport.is_closing():
+            return
+        if login is None:
+            self.transport.write(ConnectedResponseMessage(error='Incorrect JWT token').encode())
+            self.transport.close()
+            return
+        self.transport.write(ConnectedResponseMessage(error='').encode())
+
+        self.profile = AsyncProfile(login, self.transport, self.transport.get_extra_info('peername'), loop)
+        self.client_id = self.server.client_manager.add_client(self.profile)
+        print(f'{login} with client_id={self.client_id} has connected to the server!')
+        self.authorizing = False
+        self.transport.resume_reading()
+        self.process_messages()
+
+    def pause_writing(self):
+        if self.profile is not None:
+            self.profile.pause_writing()
+
+    def resume_writing(self):
+        if self.profile is not None:
+            self.profile.resume_writing()
+
+    def connection_lost(self, exc):
+        if self.client_id is None:
+            return
+        if self.client_id not in self.server.client_manager.clients:
+            print(f'ClientProtocol({self.client_id}): connection closed, since client_manager deleted profile')
+            return
+        if exc is not None:
+            print(f'ERROR could not handle client {self.client_id}:', exc)
+        self.server.drop_client(self.client_id)
+
+
+class VoiceDatagramProtocol(asyncio.DatagramProtocol):
+    server: 'AsyncServer'
+
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.handle_datagram(memoryview(data), addr)
+
+    def error_received(self, exc):
+        print('ERROR could not receive datagram:', exc)
+
+
+class AsyncRoomServer(RoomServer):
+    loop: asyncio.AbstractEventLoop
+    next_tick: float
+
+    def start_mixing(self):
+        # Mixing runs on the event loop, so that mixed frames are written without hopping between threads
+        self.loop = asyncio.get_running_loop()
+        self.next_tick = self.loop.time()
+        self.schedule_mixing()
+
+    def schedule_mixing(self):
+        self.next_tick += self.MIX_INTERVAL
+        self.loop.call_later(max(self.next_tick - self.loop.time(), 0), self.mix_and_schedule)
+
+    def mix_and_schedule(self):
+        if self.keep_mixing():
+            self.mix_voice()
+            self.schedule_mixing()
+
+
+class AsyncServer(Server):
+    BACKLOG = 100
+
+    udp_transport: asyncio.DatagramTransport
+
+    def create_room(self, room_id: int) -> RoomServer:
+        return AsyncRoomServer(self.client_manager, room_id, self.dao, self.mix_voice, self.finish_decided_phases)
+
+    def serve(self):
+        threading.Thread(target=asyncio.run, args=(self.accept_connections_async(),)).start()
+
+    def send_datagram(self, datagram: bytes, addr):
+        self.udp_transport.sendto(datagram, addr)
+
+    async def accept_connections_async(self):
+        self.sock.setblocking(False)
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: ClientProtocol(self), sock=self.sock, backlog=self.BACKLOG)
+        self.udp_transport, _ = await loop.create_datagram_endpoint(lambda: VoiceDatagramProtocol(self),
+                                                                    sock=self.udp_sock)
+
+        print('Running on IP: ' + self.server_ip)
+        print('Running on port: ' + str(self.port))
+
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    server = AsyncServer()
@@ -1,7 +1,7 @@
 import os
 
-from protocol import ShutdownMessage
-from client_manager import ClientManager
+from voice_chat.protocol import ShutdownMessage
+from voice_chat.client_manager import ClientManager
 
 
 class ServerConsole:
@@ -10,6 +10,7 @@ You can use this console to type one or more of the following commands:
 help - print this message text
 shutdown - shutdown this server
 disconnect {client_id} - disconnect client by client_id
+stats - print how many voice frames were dropped for clients that could not keep up
 '''
 
     client_manager: ClientManager
@@ -24,7 +25,7 @@ disconnect {client_id} - disconnect client by client_id
         print('Disconnecting clients')
         client_ids = list(self.client_manager.clients.items())
         for client_id, client in client_ids:
-            client.sock.sendall(ShutdownMessage().encode())
+            client.send(ShutdownMessage().encode())
             self.client_manager.disconnect_client(client_id)
         print('Shutting down the server')
         os._exit(0)
@@ -33,6 +34,14 @@ disconnect {client_id} - disconnect client by client_id
         self.client_manager.disconnect_client(client_id)
         print(f'Disconnected client with client_id={client_id}')
 
+    def print_stats(self):
+        send_stats = self.client_manager.get_send_stats()
+        for client_id, (dropped_count, overflow_count) in send_stats.items():
+            print(f'{client_id}: dropped {dropped_count} voice frames in {overflow_count} overflows')
+        dropped_total = self.client_manager.dropped_count + sum(dropped for dropped, _ in send_stats.values())
+        overflow_total = self.client_manager.overflow_count + sum(overflows for _, overflows in send_stats.values())
+        print(f'Total: dropped {dropped_total} voice frames in {overflow_total} overflows')
+
     def start(self):
         self.console_help()
         while True:
@@ -42,6 +51,8 @@ disconnect {client_id} - disconnect client by client_id
             elif cmd.startswith('disconnect'):
                 client_id = int(cmd.removeprefix('disconnect '))
                 self.disconnect(client_id)
+            elif cmd == 'stats':
+                self.print_stats()
             elif cmd == 'shutdown':
                 self.shutdown()
             else:
@@ -1,31 +1,36 @@
-import jwt
 import socket
 import sys
 import threading
 
-from protocol import get_message, MessageType, ConnectedResponseMessage
-from client_manager import Profile, ClientManager
-from server_console import ServerConsole
-from room_server import RoomServer
-from rest.app import app, dao, secret, get_hash
+from voice_chat.protocol import get_message, MessageType, ConnectedResponseMessage, FrameReader, \
+    UdpOfferMessage, CodecResponseMessage, decode_voice_datagram
+from voice_chat.codec import choose_codec, PREFERRED_CODECS
+from voice_chat.client_manager import Profile, ClientManager
+from voice_chat.server_console import ServerConsole
+from voice_chat.room_server import RoomServer
+from rest.auth import load_secret, verify_token
+from rest.profile_dao import ProfileDao
 
 
 class Server:
     RETRY_LIMIT = 3
+    MAX_DATAGRAM_SIZE = 64 * 1024
+    VOICE_CODECS = PREFERRED_CODECS
 
     server_ip: str
     sock: socket.socket
+    udp_sock: socket.socket
     client_manager: ClientManager
     room_server: dict[int, RoomServer]
-    web_server: threading.Thread
-
-    @staticmethod
-    def launch_web_server():
-        app.run(host='0.0.0.0', port=80)
+    mix_voice: bool
+    finish_decided_phases: bool
+    dao: ProfileDao
+    secret: str
 
     def __init__(self):
-        self.web_server = threading.Thread(target=self.launch_web_server)
-        self.web_server.start()
+        # Web server is launched on its own (see rest/wsgi.py), so that it does not slow down relaying of voice
+        self.dao = ProfileDao()
+        self.secret = load_secret()
         self.server_ip = socket.gethostbyname(socket.gethostname())
         while 1:
             try:
@@ -33,18 +38,32 @@ class Server:
 
                 self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.sock.bind((self.server_ip, self.port))
+                self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.udp_sock.bind((self.server_ip, self.port))
 
                 break
             except socket.error as err:
                 print("Couldn't bind to that port:", err)
 
+        self.mix_voice = '--mix' in sys.argv
+        self.finish_decided_phases = '--finish-decided' in sys.argv
         self.client_manager = ClientManager()
         self.server_console = ServerConsole(self.client_manager)
-        self.room_server = {0: RoomServer(self.client_manager, 0)}
+        self.room_server = {0: self.create_room(0)}
 
-        threading.Thread(target=self.accept_connections).start()
+        self.serve()
         self.server_console.start()
 
+    def serve(self):
+        threading.Thread(target=self.accept_connections).start()
+        threading.Thread(target=self.receive_datagrams).start()
+
+    def create_room(self, room_id: int) -> RoomServer:
+        return RoomServer(self.client_manager, room_id, self.dao, self.mix_voice, self.finish_decided_phases)
+
+    def authorize(self, jwt_token: str) -> str or None:
+        return verify_token(self.dao, self.secret, jwt_token)
+
     def accept_connections(self):
         self.sock.listen(100)
 
@@ -56,52 +75,92 @@ class Server:
 
             msg = get_message(client_sock)
 
-            login_pass = None
-            login_success = False
             if msg.message_type != MessageType.CONNECTED or msg.name is None or msg.name == '':
                 client_sock.sendall(ConnectedResponseMessage(error='Invalid ConnectedMessage').encode())
                 client_sock.close()
                 continue
-            else:
-                jwt_token = msg.name
-                try:
-                    login_pass = jwt.decode(jwt_token, secret, algorithms=["HS256"])
-                    print(login_pass)
-                    if 'login' in login_pass and 'password' in login_pass:
-                        login_profile = dao.lookup_profile(login_pass['login'])
-                        print(login_profile.password, get_hash(login_pass['password']))
-                        if login_profile is not None and login_profile.password == get_hash(login_pass['password']):
-                            login_success = True
-                except jwt.DecodeError:
-                    pass
-            if not login_success:
+
+            login = self.authorize(msg.name)
+            if login is None:
                 client_sock.sendall(ConnectedResponseMessage(error='Incorrect JWT token').encode())
                 client_sock.close()
                 continue
             else:
                 client_sock.sendall(ConnectedResponseMessage(error='').encode())
 
-            msg.name = login_pass['login']
-            client_id = self.client_manager.add_client(Profile(msg.name, client_sock, addr))
-            print(f'{msg.name} with client_id={client_id} has connected to the server!')
+            client_id = self.client_manager.add_client(Profile(login, client_sock, addr))
+            print(f'{login} with client_id={client_id} has connected to the server!')
             threading.Thread(target=self.handle_client, args=(client_id,)).start()
 
+    def route_message(self, client_id, msg):
+        profile = self.client_manager[client_id]
+        if msg.message_type == MessageType.CODEC_REQUEST:
+            profile.codec = choose_codec(msg.codecs, self.VOICE_CODECS)
+            profile.capabilities = msg.capabilities
+            profile.send(CodecResponseMessage(profile.codec).encode())
+        elif msg.message_type == MessageType.UDP_REQUEST:
+            profile.send(UdpOfferMessage(self.port, self.client_manager.gen_udp_token(client_id)).encode())
+        elif msg.message_type == MessageType.ROOM_CHANGE:
+            print(f'Client {client_id} changed room_id from {profile.room} to {msg.room_id}')
+            if client_id in self.room_server[profile.room].client_ids:
+                self.room_server[profile.room].remove_client(client_id)
+            if msg.room_id not in self.room_server:
+                self.room_server[msg.room_id] = self.create_room(msg.room_id)
+            self.room_server[msg.room_id].add_client(client_id)
+            profile.room = msg.room_id
+        else:
+            self.room_server[profile.room].handle_message(client_id, msg)
+
+    def send_datagram(self, datagram: bytes, addr):
+        self.udp_sock.sendto(datagram, addr)
+
+    def handle_datagram(self, datagram: memoryview, addr):
+        try:
+            token, seq, msg = decode_voice_datagram(datagram)
+        except ValueError:
+            return
+        client_id = self.client_manager.udp_token_id.get(token)
+        if client_id is None or client_id not in self.client_manager.clients:
+            return
+        profile = self.client_manager[client_id]
+        if profile.udp_addr != addr:
+            print(f'Client {client_id} is using UDP address {addr} for voice')
+            profile.send_datagram = self.send_datagram
+            profile.udp_addr = addr
+        if msg is None:  # Keepalive
+            return
+        if seq <= profile.udp_seq:  # Arrived too late, since a newer datagram was already relayed
+            return
+        profile.udp_seq = seq
+        try:
+            self.route_message(client_id, msg)
+        except ValueError as err:  # Datagram is dropped, since a single thread receives datagrams of every client
+            print(f'ERROR: Client {client_id} sent malformed datagram: {err}')
+
+    def receive_datagrams(self):
+        buffer = bytearray(self.MAX_DATAGRAM_SIZE)
+        view = memoryview(buffer)
+        while True:
+            try:
+                nbytes, addr = self.udp_sock.recvfrom_into(buffer)
+                self.handle_datagram(view[:nbytes], addr)
+            except socket.error as err:
+                print('ERROR could not receive datagram:', err)
+
+    def drop_client(self, client_id):
+        profile = self.client_manager[client_id]
+        if client_id in self.room_server[profile.room].client_ids:
+            self.room_server[profile.room].remove_client(client_id)
+        self.client_manager.disconnect_client(client_id)
+        print(f'Client {client_id} disconnected')
+
     def handle_client(self, client_id):
-        profile = self.client_manager.clients[client_id]
+        reader = FrameReader(self.client_manager.clients[client_id].sock)
         retry_count = 0
         while True:
             try:
-                msg = get_message(profile.sock)
-                if msg.message_type == MessageType.ROOM_CHANGE:
-                    print(f'Client {client_id} changed room_id from {profile.room} to {msg.room_id}')
-                    if client_id in self.room_server[profile.room].client_ids:
-                        self.room_server[profile.room].remove_client(client_id)
-                    if msg.room_id not in self.room_server:
-                        self.room_server[msg.room_id] = RoomServer(self.client_manager, msg.room_id)
-                    self.room_server[msg.room_id].add_client(client_id)
-                    self.client_manager[client_id].room = msg.room_id
-                else:
-                    self.room_server[profile.room].handle_message(client_id, msg)
+                msg = reader.get_message()
+                self.route_message(client_id, msg)
                 retry_count = 0
             except socket.error as err:
                 if client_id not in self.client_manager.clients:
@@ -111,12 +170,15 @@ class Server:
                 retry_count += 1
                 if retry_count > self.RETRY_LIMIT:
                     print(f'ERROR: Amount of retries exceeded. Disconnecting client {client_id}...')
-                    self.room_server[profile.room].remove_client(client_id)
-                    self.client_manager.disconnect_client(client_id)
-                    print(f'Client {client_id} disconnected')
+                    self.drop_client(client_id)
                     sys.exit(1)
                 else:
                     print(f'Retrying {retry_count}/3')
+            except ValueError as err:
+                print(f'ERROR: Client {client_id} sent malformed data: {err}. Disconnecting...')
+                self.drop_client(client_id)
+                sys.exit(1)
 
 
-server = Server()
+if __name__ == '__main__':
+    server = Server()
@@ -1,8 +1,26 @@
-from voice_chat.converter import UIntConverter, StrConverter, ArrayConverter
+import socket
+
+import pytest
+import numpy as np
+
+from voice_chat.client_manager import Profile, ClientManager
+from voice_chat.room_server import RoomServer
+from voice_chat.server_tcp import Server
+from voice_chat.server_async import AsyncProfile
+from voice_chat.send_queue import SendQueue, OverflowPolicy
+from voice_chat.jitter_buffer import JitterBuffer, evict_idle
+from voice_chat.codec import CodecType, CODECS, get_codec, choose_codec, SAMPLE_DTYPE
+from voice_chat.vad import VoiceActivityDetector, VoiceActivity
+from voice_chat.mixer import Mixer
+from voice_chat.converter import UIntConverter, StrConverter, ArrayConverter, VarIntConverter, SIntConverter, \
+    StrListConverter, StructConverter
 from voice_chat.protocol import (
-    get_message, MessageType, VOICE_DATA_SIZE,
+    get_message, FrameReader, MessageType, VOICE_DATA_SIZE, encode_voice_header,
     VoiceMessage, ConnectedMessage, DisconnectedMessage, ShutdownMessage, ConnectedResponseMessage,
     RoomChangeMessage, ListRequestMessage, ListResponseMessage, GameStartingMessage,
+    UdpRequestMessage, UdpOfferMessage, encode_voice_datagram, decode_voice_datagram,
+    encode_relayed_voice_datagram, decode_relayed_voice_datagram, encode_voice_data,
+    CodecRequestMessage, CodecResponseMessage, Capability,
 )
 
 
@@ -22,17 +40,56 @@ def test_array_converter():
     assert ArrayConverter.decode(enc) == arr
 
 
+def test_varint_converter():
+    for num in [0, 1, 127, 128, 300, 2 ** 32, 2 ** 70]:
+        enc = VarIntConverter.encode(num)
+        assert VarIntConverter.decode(b'x' + enc, 1) == (num, len(enc) + 1)
+        assert SIntConverter.decode(SIntConverter.encode(-num))[0] == -num
+    assert len(VarIntConverter.encode(127)) == 1
+    assert len(SIntConverter.encode(-64)) == 1
+    with pytest.raises(ValueError):
+        VarIntConverter.decode(b'\x80\x80')
+
+
+def test_str_list_converter():
+    for names in [[], ['a'], ['', 'bob', 'игрок', '🙂' * 50, "it's [1, 2]"]]:
+        enc = StrListConverter.encode(names)
+        assert StrListConverter.decode(enc) == names
+        assert StrListConverter.decode(memoryview(enc)) == names
+        for malformed in [enc[:-1], enc + b'x']:
+            with pytest.raises(ValueError):
+                StrListConverter.decode(malformed)
+    for count in [3, 2 ** 62]:  # Count that does not fit into data, or even into a struct
+        with pytest.raises(ValueError):
+            StrListConverter.decode(VarIntConverter.encode(count) + b'\x00\x01a')
+    with pytest.raises(ValueError):
+        StructConverter(f'>{2 ** 62}H')
+    with pytest.raises(ValueError):
+        ArrayConverter.decode(StrConverter.encode(str([1, 'a'])))
+
+
 class MockSocket:
     data: bytes
+    chunk_size: int or None
 
-    def __init__(self, data: bytes):
+    def __init__(self, data: bytes, chunk_size: int or None = None):
         self.data = data
+        self.chunk_size = chunk_size
+        self.recv_count = 0
 
     def recv(self, length: int) -> bytes:
+        if self.chunk_size is not None:
+            length = min(length, self.chunk_size)
         result = self.data[:length]
         self.data = self.data[length:]
+        self.recv_count += 1
         return result
 
+    def recv_into(self, buffer: memoryview) -> int:
+        result = self.recv(len(buffer))
+        buffer[:len(result)] = result
+        return len(result)
+
 
 def test_voice_message():
     data = b'\x0f' * VOICE_DATA_SIZE
@@ -121,3 +178,346 @@ def test_simple_message():
         msg = get_message(sock)
         assert msg.message_type == message.message_type
         assert len(sock.data) == 0
+
+
+ALL_MESSAGES = [
+    VoiceMessage('speaker', b'\x01' * VOICE_DATA_SIZE),
+    ConnectedMessage('Вася Пупкин'),
+    DisconnectedMessage('Роберт'),
+    RoomChangeMessage(42),
+    ListRequestMessage(),
+    ListResponseMessage(['a', 'bb', 'cccc']),
+    ShutdownMessage(),
+    GameStartingMessage(12345),
+    ConnectedResponseMessage(error='I am error'),
+    UdpRequestMessage(),
+    UdpOfferMessage(12345, 2 ** 32 - 1),
+    VoiceMessage('speaker', b'\x07' * 259, CodecType.ADPCM),
+    VoiceMessage('', b'', CodecType.MU_LAW),
+    CodecRequestMessage([CodecType.ADPCM, CodecType.PCM]),
+    CodecRequestMessage([CodecType.MU_LAW], Capability.VAD),
+    CodecResponseMessage(CodecType.MU_LAW),
+]
+
+
+def test_pack_into():
+    encoded = b''.join(message.encode() for message in ALL_MESSAGES)
+    buf = bytearray(len(encoded) + 1)
+    offset = 1
+    for message in ALL_MESSAGES:
+        assert message.size() == len(message.encode())
+        offset = message.pack_into(buf, offset)
+    assert offset == len(buf)
+    assert buf[1:] == encoded
+
+
+def test_get_message_short_reads():
+    for message in ALL_MESSAGES:
+        sock = MockSocket(message.encode(), chunk_size=3)
+        msg = get_message(sock)
+        assert vars(msg) == vars(message)
+        assert len(sock.data) == 0
+
+
+def test_frame_reader():
+    for chunk_size in [1, 7, 1000, None]:
+        sock = MockSocket(b''.join(message.encode() for message in ALL_MESSAGES), chunk_size=chunk_size)
+        reader = FrameReader(sock)
+        for message in ALL_MESSAGES:
+            msg = reader.get_message()
+            assert msg.message_type == message.message_type
+            assert vars(msg) == vars(message)
+        assert len(sock.data) == 0
+
+
+def test_frame_reader_batches_reads():
+    frames = 100
+    voice_message = VoiceMessage('speaker', b'\x02' * VOICE_DATA_SIZE)
+    sock = MockSocket(voice_message.encode() * frames)
+    reader = FrameReader(sock)
+    for _ in range(frames):
+        assert reader.get_message().data == voice_message.data
+    assert sock.recv_count < frames // 10
+
+
+def test_frame_reader_grows_buffer():
+    names = [str(i) * 10 for i in range(1000)]
+    reader = FrameReader(buffer_size=16)
+    encoded = ListResponseMessage(names).encode()
+    for i in range(0, len(encoded), 100):
+        assert reader.next_message() is None
+        reader.feed(encoded[i:i + 100])
+    assert reader.next_message().names == names
+    assert reader.next_message() is None
+
+
+def test_voice_header():
+    data = b'\x03' * VOICE_DATA_SIZE
+    voice_message = VoiceMessage('Роберт', data)
+    assert encode_voice_header('Роберт') + encode_voice_data(CodecType.PCM, data) == voice_message.encode()
+
+
+def test_profile_send_buffers():
+    server_sock, client_sock = socket.socketpair()
+    profile = Profile('Роберт', server_sock, None)
+    data = b'\x04' * VOICE_DATA_SIZE
+    for _ in range(10):
+        profile.send(profile.voice_header, memoryview(encode_voice_data(CodecType.PCM, data)))
+    profile.close()
+
+    reader = FrameReader(client_sock)
+    for _ in range(10):
+        msg = reader.get_message()
+        assert msg.name == 'Роберт'
+        assert msg.data == data
+    client_sock.close()
+
+
+class ShutdownCountingSocket:
+    shutdown_count = 0
+
+    def shutdown(self, how):
+        self.shutdown_count += 1
+
+
+def test_profile_shuts_down_once_on_overflow():
+    sock = ShutdownCountingSocket()
+    profile = Profile('Роберт', sock, None)
+    profile.send_queue = SendQueue(OverflowPolicy.DISCONNECT, max_voice_frames=1, max_overflows=0)
+    for _ in range(5):
+        profile.send(b'voice', droppable=True)
+    assert profile.closing
+    assert sock.shutdown_count == 1
+
+
+class RecordingTransport:
+    def __init__(self):
+        self.written = []
+
+    def get_extra_info(self, name):
+        return None
+
+    def writelines(self, buffers):
+        self.written.append(buffers)
+
+
+def test_async_profile_copies_queued_views():
+    transport = RecordingTransport()
+    profile = AsyncProfile('Роберт', transport, None, None)
+    profile.start_sending(SendQueue())
+    profile.pause_writing()
+    reader = FrameReader()
+    reader.feed(VoiceMessage('speaker', b'\x01' * VOICE_DATA_SIZE).encode())
+    data = reader.next_message().data
+    profile.send(profile.voice_header, data, droppable=True)
+    reader.feed(VoiceMessage('speaker', b'\x02' * VOICE_DATA_SIZE).encode())
+    reader.next_message()  # Overwrites the buffer that data is a view into
+    profile.resume_writing()
+    assert [bytes(buf) for buf in transport.written[0]] == [profile.voice_header, b'\x01' * VOICE_DATA_SIZE]
+
+
+def fill_send_queue(policy: str) -> SendQueue:
+    queue = SendQueue(policy, max_voice_frames=3, max_overflows=2)
+    queue.put((b'control',))
+    for i in range(5):
+        assert queue.put((b'voice', bytes([i])), droppable=True)
+    queue.put((b'control',))
+    return queue
+
+
+def drain_send_queue(queue: SendQueue) -> list[tuple]:
+    frames = []
+    buffers = queue.get_nowait()
+    while buffers is not None:
+        frames.append(buffers)
+        buffers = queue.get_nowait()
+    return frames
+
+
+def test_send_queue_drop_oldest():
+    queue = fill_send_queue(OverflowPolicy.DROP_OLDEST)
+    assert drain_send_queue(queue) == [(b'control',), (b'voice', b'\x02'), (b'voice', b'\x03'), (b'voice', b'\x04'),
+                                       (b'control',)]
+    assert queue.dropped_count == 2
+    assert queue.overflow_count == 2
+
+
+def test_send_queue_coalesce():
+    queue = fill_send_queue(OverflowPolicy.COALESCE)
+    assert drain_send_queue(queue) == [(b'control',), (b'voice', b'\x03'), (b'voice', b'\x04'), (b'control',)]
+    assert queue.dropped_count == 3
+    assert queue.overflow_count == 1
+
+
+def test_send_queue_disconnect():
+    queue = fill_send_queue(OverflowPolicy.DISCONNECT)
+    assert queue.dropped_count == 2
+    assert queue.overflow_count == 2
+    assert not queue.put((b'voice', b'\x05'), droppable=True)
+
+
+def test_send_queue_close():
+    queue = SendQueue()
+    queue.put((b'a',))
+    queue.close()
+    assert queue.get() == (b'a',)
+    assert queue.get() is None
+
+
+def test_voice_datagrams():
+    data = b'\x05' * 259
+    token, seq, msg = decode_voice_datagram(memoryview(encode_voice_datagram(123456, 42, CodecType.ADPCM, data)))
+    assert (token, seq, msg.codec, msg.data) == (123456, 42, CodecType.ADPCM, data)
+    assert decode_voice_datagram(memoryview(encode_voice_datagram(123456, 42))) == (123456, 42, None)
+
+    datagram = encode_relayed_voice_datagram(42, encode_voice_header('Роберт'), CodecType.ADPCM, data)
+    seq, msg = decode_relayed_voice_datagram(memoryview(datagram))
+    assert (seq, msg.name, msg.codec, msg.data) == (42, 'Роберт', CodecType.ADPCM, data)
+
+
+def test_jitter_buffer_reorders():
+    jitter_buffer = JitterBuffer(depth=3)
+    for seq in [2, 1]:
+        jitter_buffer.push(seq, bytes([seq]))
+        assert jitter_buffer.pop() is None
+    jitter_buffer.push(4, b'\x04')
+    assert jitter_buffer.pop() == b'\x01'
+    jitter_buffer.push(3, b'\x03')
+    jitter_buffer.push(1, b'\x01')
+    assert [jitter_buffer.pop() for _ in range(3)] == [b'\x02', b'\x03', b'\x04']
+    assert jitter_buffer.late_count == 1
+    assert jitter_buffer.pop() is None
+
+
+def test_jitter_buffer_losses():
+    jitter_buffer = JitterBuffer(depth=2, max_size=4)
+    for seq in [1, 3, 4]:
+        jitter_buffer.push(seq, bytes([seq]))
+    assert [jitter_buffer.pop() for _ in range(4)] == [b'\x01', None, b'\x03', b'\x04']
+    assert jitter_buffer.lost_count == 1
+
+    for seq in range(5, 11):
+        jitter_buffer.push(seq, bytes([seq]))
+    assert len(jitter_buffer) == 4
+    assert jitter_buffer.pop() == b'\x07'
+    assert jitter_buffer.lost_count == 3
+
+
+def test_jitter_buffer_evict_idle():
+    jitter_buffers = {'talking': JitterBuffer(), 'silent': JitterBuffer()}
+    jitter_buffers['silent'].pushed_at -= 60
+    jitter_buffers['talking'].push(1, b'\x01')
+    evict_idle(jitter_buffers, timeout=10)
+    assert list(jitter_buffers) == ['talking']
+
+
+def make_voice_pcm() -> bytes:
+    t = np.arange(VOICE_DATA_SIZE // 2) / 20000
+    return (8000 * np.sin(2 * np.pi * 440 * t) + 2000 * np.sin(2 * np.pi * 1234 * t)).astype(SAMPLE_DTYPE).tobytes()
+
+
+def test_codecs():
+    pcm = make_voice_pcm()
+    samples = np.frombuffer(pcm, dtype=SAMPLE_DTYPE).astype(float)
+    compression = {CodecType.PCM: 1, CodecType.MU_LAW: 2, CodecType.ADPCM: 3.9}
+    for codec_type, codec in CODECS.items():
+        assert get_codec(codec_type) is codec
+        if codec_type == CodecType.COMFORT_NOISE:
+            continue
+        data = codec.encode(pcm)
+        assert len(pcm) / len(data) >= compression[codec_type]
+        decoded = np.frombuffer(codec.decode(data), dtype=SAMPLE_DTYPE).astype(float)
+        assert len(decoded) == len(samples)
+        noise = np.mean((decoded - samples) ** 2)
+        assert noise == 0 or 10 * np.log10(np.mean(samples ** 2) / noise) > 25
+
+
+def test_codecs_reject_malformed_data():
+    for codec_type, malformed in [(CodecType.PCM, b'\x01' * 3), (CodecType.ADPCM, b'\x01' * 2),
+                                  (CodecType.COMFORT_NOISE, b'\x01')]:
+        assert not get_codec(codec_type).is_valid(malformed)
+        with pytest.raises(ValueError):
+            get_codec(codec_type).decode(malformed)
+    assert get_codec(CodecType.MU_LAW).decode(b'\x01' * 3) is not None
+
+
+class RecordingProfile(Profile):
+    def __init__(self, name):
+        super().__init__(name, None, None)
+        self.datagrams = []
+        self.send_datagram = lambda datagram, addr: self.datagrams.append(datagram)
+
+    def start_sending(self, send_queue: SendQueue):
+        self.send_queue = send_queue
+
+
+def test_server_drops_malformed_datagrams():
+    server = Server.__new__(Server)  # Without binding sockets and starting console
+    server.client_manager = ClientManager()
+    server.room_server = {0: RoomServer(server.client_manager, 0, None)}
+    sender_id = server.client_manager.add_client(RecordingProfile('sender'))
+    listener_id = server.client_manager.add_client(RecordingProfile('listener'))
+    for client_id in [sender_id, listener_id]:
+        server.room_server[0].add_client(client_id)
+    sender, listener = server.client_manager[sender_id], server.client_manager[listener_id]
+    sender.udp_addr = ('sender', 1)
+    listener.udp_addr = ('listener', 1)
+    token = server.client_manager.gen_udp_token(sender_id)
+
+    data = get_codec(CodecType.ADPCM).encode(make_voice_pcm())
+    for seq, (codec, malformed) in enumerate([(CodecType.ADPCM, data[:2]), (CodecType.PCM, b'\x01' * 3)], 1):
+        sender.codec = codec
+        server.handle_datagram(memoryview(encode_voice_datagram(token, seq, codec, malformed)), sender.udp_addr)
+    assert listener.datagrams == []
+    sender.codec = CodecType.ADPCM
+    server.handle_datagram(memoryview(encode_voice_datagram(token, 3, CodecType.ADPCM, data)), sender.udp_addr)
+    assert len(listener.datagrams) == 1
+    _, msg = decode_relayed_voice_datagram(memoryview(listener.datagrams[0]))
+    assert (msg.name, msg.codec, msg.data) == ('sender', CodecType.ADPCM, data)
+
+
+def test_choose_codec():
+    assert choose_codec([CodecType.PCM, CodecType.MU_LAW, CodecType.ADPCM]) == CodecType.ADPCM
+    assert choose_codec([CodecType.MU_LAW]) == CodecType.MU_LAW
+    assert choose_codec([CodecType.ADPCM], [CodecType.MU_LAW, CodecType.PCM]) == CodecType.PCM
+
+
+def test_vad():
+    vad = VoiceActivityDetector()
+    speech = make_voice_pcm()
+    silence = np.random.default_rng(0).normal(0, 30, len(speech) // 2).astype(SAMPLE_DTYPE).tobytes()
+    assert vad.process(silence) == VoiceActivity.SILENCE
+    assert vad.process(speech) == VoiceActivity.SPEECH
+    assert vad.process(speech[:-1]) == VoiceActivity.SPEECH  # Partial sample is ignored
+    for _ in range(VoiceActivityDetector.HANGOVER_FRAMES - 1):
+        assert vad.process(silence) == VoiceActivity.SPEECH
+    assert vad.process(silence) == VoiceActivity.SILENCE_START
+    assert vad.process(silence) == VoiceActivity.SILENCE
+
+
+def test_comfort_noise():
+    codec = get_codec(CodecType.COMFORT_NOISE)
+    silence = np.random.default_rng(0).normal(0, 100, 512).astype(SAMPLE_DTYPE).tobytes()
+    data = codec.encode(silence)
+    assert len(data) == 3
+    noise = np.frombuffer(codec.decode(data), dtype=SAMPLE_DTYPE).astype(float)
+    assert len(noise) == 512
+    assert 50 < np.sqrt(np.mean(noise ** 2)) < 150
+
+
+def test_mixer():
+    mixer = Mixer(max_pending_frames=2)
+    for value in [1, 2, 3]:
+        mixer.add(0, np.full(4, value * 10000, dtype=SAMPLE_DTYPE).tobytes())
+    mixer.add(1, np.full(2, -5000, dtype=SAMPLE_DTYPE).tobytes())
+
+    frames = mixer.take()
+    assert sorted(frames) == [0, 1]
+    assert frames[0].tolist() == [20000] * 4  # The oldest frame was dropped
+    mixed = np.frombuffer(Mixer.mix(list(frames.values())), dtype=SAMPLE_DTYPE)
+    assert mixed.tolist() == [15000, 15000, 20000, 20000]
+
+    frames = mixer.take()
+    assert list(frames) == [0]
+    assert np.frombuffer(Mixer.mix([frames[0], frames[0]]), dtype=SAMPLE_DTYPE).tolist() == [32767] * 4
+    assert mixer.take() == {}
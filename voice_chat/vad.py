@@ -0,0 +1,49 @@
+import numpy as np
+
+from voice_chat.codec import SAMPLE_DTYPE
+
+
+class VoiceActivity:
+    SPEECH = 0
+    SILENCE_START = 1  # First silent frame, so listeners should be told that speaker stopped
+    SILENCE = 2
+
+
+class VoiceActivityDetector:
+    ENERGY_THRESHOLD = 400  # RMS of a 16-bit sample, below which frame is never speech
+    NOISE_FLOOR_RATIO = 3  # Speech should be this much louder than background noise
+    ZERO_CROSSING_THRESHOLD = 0.3  # Voiced speech rarely crosses zero in more than 30% of samples
+    HANGOVER_FRAMES = 8  # About 200ms, so that ends of words are not cut off
+    NOISE_FLOOR_ADAPTATION = 0.05
+
+    noise_floor: float
+    hangover: int
+    speaking: bool
+
+    def __init__(self):
+        self.noise_floor = 0
+        self.hangover = 0
+        self.speaking = False
+
+    def is_speech(self, samples: np.ndarray) -> bool:
+        rms = float(np.sqrt(np.mean(samples * samples))) if len(samples) else 0
+        zero_crossings = np.count_nonzero(np.diff(np.signbit(samples))) / max(len(samples) - 1, 1)
+        threshold = max(self.ENERGY_THRESHOLD, self.noise_floor * self.NOISE_FLOOR_RATIO)
+        if rms >= threshold * 2:
+            return True
+        speech = rms >= threshold and zero_crossings < self.ZERO_CROSSING_THRESHOLD
+        if not speech:
+            self.noise_floor += (rms - self.noise_floor) * self.NOISE_FLOOR_ADAPTATION
+        return speech
+
+    def process(self, pcm: bytes) -> int:  # VoiceActivity
+        pcm = pcm[:len(pcm) - len(pcm) % SAMPLE_DTYPE.itemsize]  # Partial sample is ignored
+        samples = np.frombuffer(pcm, dtype=SAMPLE_DTYPE).astype(np.float32)
+        if self.is_speech(samples):
+            self.hangover = self.HANGOVER_FRAMES
+        elif self.hangover > 0:
+            self.hangover -= 1
+        was_speaking, self.speaking = self.speaking, self.hangover > 0
+        if self.speaking:
+            return VoiceActivity.SPEECH
+        return VoiceActivity.SILENCE_START if was_speaking else VoiceActivity.SILENCE